@@ -0,0 +1,113 @@
+# encoding: utf-8
+"""
+    Synthetic CSV files for the benchmarks: a wide file, a long file, and files
+    in the encodings, delimiters and header styles our publishers use.
+    Files are generated once into a directory and reused while their parameters
+    stay the same.
+
+    python bench/corpora.py --directory /tmp/csvmetadata-bench
+    python bench/corpora.py --full
+
+The long file has LONG_ROWS rows unless --long-rows is given; --full makes it
+FULL_LONG_ROWS rows long, which takes a while to generate and about 600 MB of disk.
+"""
+
+import os
+import json
+import codecs
+import random
+import argparse
+import tempfile
+
+from profiler_benchmark import GENERATORS
+
+DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(), "csvmetadata-bench")
+
+#Rows of the long file by default and with --full
+LONG_ROWS = 100000
+FULL_LONG_ROWS = 10000000
+
+#(name, encoding, delimiter, columns, rows, header style)
+#rows=None stands for the --long-rows count
+CORPORA = (
+    ("narrow", "utf-8", ",", 8, 10000, "plain"),
+    ("wide", "utf-8", ",", 5000, 100, "plain"),
+    ("long", "utf-8", ",", 8, None, "plain"),
+    ("utf8_bom_semicolon", "utf-8-sig", ";", 12, 10000, "plain"),
+    ("utf16_tab", "utf-16", "\t", 12, 10000, "plain"),
+    ("cp1257_semicolon", "windows-1257", ";", 12, 10000, "plain"),
+    ("pipe", "utf-8", "|", 12, 10000, "plain"),
+    ("quoted_headers", "utf-8", ",", 20, 10000, "quoted"),
+)
+
+
+def make_headers(columns, style):
+    if style == "quoted":
+        #Header values with delimiters, quotes and line breaks have to be quoted, and span several lines
+        return [u'"Kolonna {0}, ""{0}.""\nmērvienība"'.format(i) for i in range(columns)]
+    return [u"col{}".format(i) for i in range(columns)]
+
+
+def write_corpus(path, encoding, delimiter, columns, rows, style, seed=0, block_rows=10000):
+    random.seed(seed)
+    generators = [GENERATORS[i % len(GENERATORS)] for i in range(columns)]
+    delimiter = delimiter.decode("ascii") if isinstance(delimiter, bytes) else delimiter
+    temp_path = path + ".part"
+    with open(temp_path, "wb") as f:
+        #Long files are written in blocks, an incremental encoder only writes the UTF-16 BOM once
+        encoder = codecs.getincrementalencoder(encoding)()
+        f.write(encoder.encode(delimiter.join(make_headers(columns, style)) + u"\n"))
+        written = 0
+        while written < rows:
+            count = min(block_rows, rows - written)
+            lines = []
+            for i in range(written, written + count):
+                lines.append(delimiter.join(generator(i).decode("utf-8") for generator in generators))
+            f.write(encoder.encode(u"\n".join(lines) + u"\n"))
+            written += count
+    os.rename(temp_path, path)
+
+
+def build_corpora(directory=DEFAULT_DIRECTORY, long_rows=LONG_ROWS, names=None):
+    """
+        Generates the corpora that aren't there yet into the directory.
+        Returns a dict of name: {"path", "encoding", "delimiter", "columns", "rows", "style"}.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    corpora = {}
+    for name, encoding, delimiter, columns, rows, style in CORPORA:
+        if names and name not in names:
+            continue
+        rows = long_rows if rows is None else rows
+        description = {"encoding": encoding, "delimiter": delimiter, "columns": columns, "rows": rows, "style": style}
+        path = os.path.join(directory, name + ".csv")
+        description_path = path + ".json"
+        try:
+            with open(description_path) as f:
+                existing = json.load(f)
+        except (IOError, ValueError):
+            existing = None
+        if existing != description or not os.path.isfile(path):
+            print("Generating {} ({} columns, {} rows, {})".format(name, columns, rows, encoding))
+            write_corpus(path, encoding, delimiter, columns, rows, style)
+            with open(description_path, "w") as f:
+                json.dump(description, f)
+        description["path"] = path
+        corpora[name] = description
+    return corpora
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--directory", default=DEFAULT_DIRECTORY)
+    parser.add_argument("--long-rows", type=int, default=None)
+    parser.add_argument("--full", action="store_true", help="generate a {} row long file".format(FULL_LONG_ROWS))
+    args = parser.parse_args()
+    long_rows = args.long_rows or (FULL_LONG_ROWS if args.full else LONG_ROWS)
+    for name, corpus in sorted(build_corpora(args.directory, long_rows).items()):
+        print("{:>20}: {:8.1f} MB {}".format(name, os.path.getsize(corpus["path"]) / 1048576.0, corpus["path"]))
+
+
+if __name__ == "__main__":
+    main()
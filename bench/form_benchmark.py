@@ -0,0 +1,111 @@
+# encoding: utf-8
+"""
+    Compares decoding of CSV metadata form data into CSVW column descriptions
+    the way form_to_csvw used to do it (sorting all form keys, checkbox loop per
+    column, cmp-based ordering) with the compiled FormSchema lookups.
+
+    python bench/form_benchmark.py --columns 1000 --repeat 5
+"""
+
+import os
+import time
+import argparse
+from collections import OrderedDict
+
+from ckanext.csvmetadata.schema import load_form_schema, DATATYPE_BOUNDS
+
+SCHEMA_PATH = os.path.join(os.path.dirname(__file__), "..", "ckanext", "csvmetadata", "form_schema.json")
+
+DATATYPES = ("string", "decimal", "date", "latitude", "longitude", "X", "Y", "boolean")
+
+
+def make_form(columns):
+    form_data = {}
+    for i in range(columns):
+        form_data["{}-name".format(i)] = "col{}".format(i)
+        form_data["{}-titles".format(i)] = "Column {}".format(i)
+        form_data["{}-dc:description".format(i)] = "Description of column {}".format(i)
+        form_data["{}-datatype".format(i)] = DATATYPES[i % len(DATATYPES)]
+        form_data["{}-length".format(i)] = ""
+        form_data["{}-resource".format(i)] = ""
+        form_data["{}-columnReference".format(i)] = ""
+        if i % 2:
+            form_data["{}-required".format(i)] = ""
+        if i == 0:
+            form_data["{}-primaryKey".format(i)] = ""
+    return form_data
+
+
+def finish_column(column):
+    base = column.pop("datatype")
+    length = column.pop("length")
+    column["datatype"] = OrderedDict((("dc:title", base), ("base", base), ("length", length)))
+    if base in DATATYPE_BOUNDS:
+        column["datatype"]["base"], column["datatype"]["minimum"], column["datatype"]["maximum"] = DATATYPE_BOUNDS[base]
+    column.pop("resource")
+    column.pop("columnReference")
+
+
+def decode_previous(form_data, column_count, checkbox_ids):
+    """
+        The previous form_to_csvw implementation, for reference.
+    """
+    columns = [OrderedDict() for i in range(column_count)]
+    form_elements = sorted(form_data.keys())
+    for key in form_elements:
+        try:
+            header_num_str, form_field_name = key.split("-", 1)
+            header_num = int(header_num_str)
+        except:
+            pass
+        else:
+            columns[header_num][form_field_name] = form_data[key]
+    for column in columns:
+        for checkbox_id in checkbox_ids:
+            if checkbox_id in column.keys():
+                column[checkbox_id] = True
+    for column in columns:
+        finish_column(column)
+    order = [u'name', u'titles', u'dc:description', u'datatype', u'length', u'required', u'primaryKey', u'foreignKeys']
+    cmp = lambda x, y: 1 if x in order and y in order and order.index(x) > order.index(y) else -1
+    return [OrderedDict(sorted(column.items(), cmp=cmp, key=lambda x: x[0])) for column in columns]
+
+
+def decode_compiled(form_data, column_count, form_schema):
+    columns = form_schema.decode_form(form_data, column_count)
+    for column in columns:
+        finish_column(column)
+    return [form_schema.order_column(column) for column in columns]
+
+
+def timed(function, args, repeat):
+    best = None
+    for i in range(repeat):
+        started = time.time()
+        result = function(*args)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--columns", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    form_schema = load_form_schema(SCHEMA_PATH)
+    form_data = make_form(args.columns)
+    print("{} columns, {} form fields".format(args.columns, len(form_data)))
+
+    previous, previous_time = timed(decode_previous, (form_data, args.columns, form_schema.checkbox_ids), args.repeat)
+    compiled, compiled_time = timed(decode_compiled, (form_data, args.columns, form_schema), args.repeat)
+    if [list(column.items()) for column in previous] != [list(column.items()) for column in compiled]:
+        print("WARNING: results differ")
+
+    print("previous: {:.1f} ms".format(previous_time * 1000))
+    print("compiled: {:.1f} ms ({:.1f}x)".format(compiled_time * 1000, previous_time / compiled_time))
+
+
+if __name__ == "__main__":
+    main()
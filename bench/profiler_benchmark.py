@@ -0,0 +1,75 @@
+# encoding: utf-8
+"""
+    Compares column profiling speed of the pure Python and the batched
+    (pandas/NumPy) profiler backends on a synthetic CSV file.
+
+    python bench/profiler_benchmark.py --rows 1000000 --columns 12
+"""
+
+import time
+import random
+import argparse
+from StringIO import StringIO
+
+from ckanext.csvmetadata import profiler
+
+CSV_INFO = {"delimiter": ",", "quoteChar": '"', "encoding": "utf-8"}
+
+#Cell generators for the kinds of columns our publishers have
+GENERATORS = (
+    lambda i: str(i),
+    lambda i: "{:.5f}".format(56 + random.random() * 2),
+    lambda i: "{:.5f}".format(21 + random.random() * 7),
+    lambda i: str(random.randint(160000, 450000)),
+    lambda i: "2017-{:02d}-{:02d}".format(random.randint(1, 12), random.randint(1, 28)),
+    lambda i: random.choice(("true", "false")),
+    lambda i: "Rīga {}".format(random.randint(1, 100)),
+    lambda i: "" if random.random() < 0.1 else str(random.randint(1, 10 ** 6)),
+)
+
+
+def make_csv(rows, columns):
+    headers = ["col{}".format(i) for i in range(columns)]
+    generators = [GENERATORS[i % len(GENERATORS)] for i in range(columns)]
+    lines = [",".join(headers)]
+    for i in range(rows):
+        lines.append(",".join(generator(i) for generator in generators))
+    return headers, "\n".join(lines) + "\n"
+
+
+def run(backend, headers, data):
+    started = time.time()
+    profile = profiler.profile_csv(lambda: StringIO(data), headers, CSV_INFO, backend=backend)
+    elapsed = time.time() - started
+    return profile, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--columns", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    headers, data = make_csv(args.rows, args.columns)
+    print("{} rows, {} columns, {:.1f} MB".format(args.rows, args.columns, len(data) / 1048576.0))
+
+    backends = ["python"]
+    if profiler.pd is not None:
+        backends.append("batch")
+    else:
+        print("pandas is not installed, skipping the batched backend")
+
+    results = {}
+    for backend in backends:
+        profile, elapsed = run(backend, headers, data)
+        results[backend] = profile.suggestions()
+        print("{:>8}: {:8.2f}s {:12.0f} rows/s".format(backend, elapsed, profile.rows_profiled / elapsed))
+
+    if len(results) > 1 and results["python"] != results["batch"]:
+        print("Backends disagree on suggestions!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+# encoding: utf-8
+"""
+    Local stand-ins for what the CSV metadata page talks to: a web server that
+    serves the benchmark corpora with a configurable latency, and a CKAN action
+    layer that keeps packages in memory, so that the page can be load-tested
+    without a CKAN database or remote hosts.
+"""
+
+import os
+import time
+import uuid
+import hashlib
+import datetime
+import threading
+import posixpath
+import SocketServer
+import BaseHTTPServer
+from urllib import unquote
+from urlparse import urlparse
+
+
+class FileRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+        Serves files from server.directory, like a publisher's web server would:
+        with ETag and Last-Modified, conditional and range requests.
+        Each response waits server.latency seconds before it starts.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        name = posixpath.basename(unquote(urlparse(self.path).path))
+        path = os.path.join(self.server.directory, name)
+        if not name or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        stat = os.stat(path)
+        etag = '"{}"'.format(hashlib.md5("{}-{}".format(stat.st_mtime, stat.st_size)).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        start, end = 0, stat.st_size
+        range_header = self.headers.get("Range")
+        if range_header and range_header.startswith("bytes="):
+            first, last = range_header[len("bytes="):].split("-", 1)
+            start = int(first)
+            end = min(int(last) + 1, stat.st_size) if last else stat.st_size
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end - 1, stat.st_size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/json" if name.endswith(".json") else "text/csv")
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", self.date_time_string(stat.st_mtime))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start
+            try:
+                while remaining > 0:
+                    block = f.read(min(65536, remaining))
+                    if not block:
+                        break
+                    self.wfile.write(block)
+                    remaining -= len(block)
+            except IOError:
+                #Clients only read the beginning of most files and hang up
+                pass
+
+
+class FileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+        Stand-in web server for the benchmark corpora, started on a free local port:
+
+            server = FileServer(directory, latency=0.05)
+            server.start()
+            url = server.url("narrow.csv")
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, directory, latency=0.0, host="127.0.0.1", port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), FileRequestHandler)
+        self.directory = directory
+        self.latency = latency
+        self._thread = None
+
+    def handle_error(self, request, client_address):
+        #Clients hang up as soon as they have read what they need, that's not worth a traceback
+        pass
+
+    def url(self, name):
+        return "http://{}:{}/{}".format(self.server_address[0], self.server_address[1], name)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeActions(object):
+    """
+        ckanapi's `action` attribute stand-in: ckan.action.<name>(**data_dict).
+    """
+    def __init__(self, ckan):
+        self._ckan = ckan
+
+    def __getattr__(self, name):
+        function = getattr(self._ckan, "action_" + name, None)
+        if function is None:
+            raise AttributeError("Fake CKAN has no {} action".format(name))
+
+        def call(**data_dict):
+            time.sleep(self._ckan.latency)
+            self._ckan.calls[name] = self._ckan.calls.get(name, 0) + 1
+            return function(**data_dict)
+        return call
+
+
+class FakeCKAN(object):
+    """
+        In-memory stand-in for the CKAN action layer (LocalCKAN), with
+        the actions the CSV metadata page uses. Uploaded CSVW files are written
+        to the file server's directory, so that the page can fetch them back.
+        Each action call takes at least latency seconds.
+    """
+    def __init__(self, file_server, latency=0.0):
+        self.file_server = file_server
+        self.latency = latency
+        self.packages = {}
+        self.datastore = {}
+        self.calls = {}
+        self._lock = threading.Lock()
+        self.action = FakeActions(self)
+
+    def add_package(self, name, csv_names):
+        """
+            Adds a package with a CSV resource for each of the corpus files.
+        """
+        now = datetime.datetime.utcnow().isoformat()
+        pkg_dict = {"id": str(uuid.uuid4()), "name": name, "title": name.title(),
+                    "license_url": "http://creativecommons.org/licenses/by/4.0/", "tags": [{"name": "bench"}],
+                    "organization": {"name": "bench", "title": "Benchmark"},
+                    "metadata_modified": now, "resources": []}
+        for csv_name in csv_names:
+            pkg_dict["resources"].append({"id": str(uuid.uuid4()), "package_id": pkg_dict["id"],
+                                          "name": csv_name, "format": "CSV", "url_type": None,
+                                          "url": self.file_server.url(csv_name), "created": now,
+                                          "last_modified": None, "conformsTo": None})
+        self.packages[pkg_dict["id"]] = pkg_dict
+        return pkg_dict
+
+    def add_datastore_table(self, resource_id, fields):
+        """
+            Marks the resource as loaded into the DataStore, with a table of
+            the given fields (dictionaries with id and type, like datastore_search returns).
+        """
+        pkg_dict, resource = self._resource(resource_id)
+        self.datastore[resource_id] = [{"id": "_id", "type": "int"}] + list(fields)
+        resource["datastore_active"] = True
+
+    def _resource(self, resource_id):
+        for pkg_dict in self.packages.values():
+            for resource in pkg_dict["resources"]:
+                if resource["id"] == resource_id:
+                    return pkg_dict, resource
+        raise KeyError(resource_id)
+
+    def _store_upload(self, resource, upload):
+        name = "{}-{}".format(resource["id"], os.path.basename(getattr(upload, "name", "upload.json")))
+        with open(os.path.join(self.file_server.directory, name), "wb") as f:
+            f.write(upload.read())
+        resource["url"] = self.file_server.url(name)
+
+    def action_package_show(self, id):
+        return self.packages[id]
+
+    def action_datastore_search(self, resource_id, limit=100, **params):
+        if resource_id not in self.datastore:
+            raise KeyError("Resource {} has no DataStore table".format(resource_id))
+        return {"resource_id": resource_id, "fields": self.datastore[resource_id], "records": [], "limit": limit}
+
+    def action_resource_create(self, package_id, upload=None, **fields):
+        with self._lock:
+            pkg_dict = self.packages[package_id]
+            resource = dict(fields, id=str(uuid.uuid4()), package_id=package_id, url_type="upload",
+                            format="JSON", created=datetime.datetime.utcnow().isoformat(), last_modified=None)
+            if upload is not None:
+                self._store_upload(resource, upload)
+            pkg_dict["resources"].append(resource)
+            pkg_dict["metadata_modified"] = datetime.datetime.utcnow().isoformat()
+            return resource
+
+    def action_resource_patch(self, id, upload=None, **fields):
+        with self._lock:
+            pkg_dict, resource = self._resource(id)
+            if upload is not None:
+                #Uploads get their URL from the stored file
+                fields.pop("url", None)
+                self._store_upload(resource, upload)
+            resource.update(fields)
+            pkg_dict["metadata_modified"] = datetime.datetime.utcnow().isoformat()
+            return resource
@@ -0,0 +1,299 @@
+# encoding: utf-8
+"""
+    Benchmark and load-test suite for the CSV metadata page. Runs against
+    generated corpora (see corpora.py), served by a local stand-in web server
+    with the given latency, and an in-memory stand-in for the CKAN action layer
+    (see standins.py). Needs CKAN installed, like the extension itself.
+
+    Microbenchmarks time sniffing, get_csv_sample, form_to_csvw, csvw_to_form,
+    streaming CSV reading and validation. The end-to-end part requests the
+    metadata page data (GET), also for resources in the DataStore, and saves
+    CSVW (POST) from --concurrency threads, reporting p50/p95/p99 latency and throughput.
+
+    python bench/suite.py --latency 0.05 --concurrency 8 --requests 200
+    python bench/suite.py --full
+    python bench/suite.py --save-baseline
+    python bench/suite.py --compare --tolerance 0.2
+
+--save-baseline stores the results in bench/baselines.json (or --baseline),
+--compare exits with status 1 if anything got slower than the stored baseline
+by more than --tolerance. Baselines are only comparable on the same machine.
+The long corpus has corpora.LONG_ROWS rows unless --long-rows is given;
+--full runs with the corpora.FULL_LONG_ROWS row file, which takes a while to generate.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import platform
+import itertools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from ckanext.csvmetadata import plugin, fetch, validation
+from ckanext.csvmetadata.csv_unicode import CSVStreamReader
+
+from corpora import build_corpora, make_headers, DEFAULT_DIRECTORY, LONG_ROWS, FULL_LONG_ROWS
+from standins import FileServer, FakeCKAN
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+#Corpora that are small enough to sniff and fetch many times
+SAMPLE_CORPORA = ("narrow", "wide", "utf8_bom_semicolon", "utf16_tab", "cp1257_semicolon", "pipe", "quoted_headers")
+
+
+def percentile(sorted_values, p):
+    #Nearest-rank percentile
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def summarize(durations, wall_time=None):
+    durations = sorted(durations)
+    summary = {"count": len(durations),
+               "mean": sum(durations) / len(durations),
+               "p50": percentile(durations, 50),
+               "p95": percentile(durations, 95),
+               "p99": percentile(durations, 99)}
+    if wall_time:
+        summary["throughput"] = len(durations) / wall_time
+    return summary
+
+
+def measure(function, repeat):
+    durations = []
+    for i in range(repeat):
+        started = time.time()
+        function(i)
+        durations.append(time.time() - started)
+    return summarize(durations)
+
+
+def load(function, requests, concurrency):
+    """
+        Calls function(i) for i in range(requests) from concurrency threads.
+        Failed calls are counted, not timed.
+    """
+    def timed(i):
+        started = time.time()
+        try:
+            function(i)
+        except Exception as e:
+            return None, repr(e)
+        return time.time() - started, None
+
+    pool = ThreadPool(concurrency)
+    started = time.time()
+    try:
+        results = pool.map(timed, range(requests), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    wall_time = time.time() - started
+    durations = [duration for duration, error in results if error is None]
+    errors = [error for duration, error in results if error is not None]
+    if not durations:
+        raise Exception("All requests failed, first error: {}".format(errors[0]))
+    summary = summarize(durations, wall_time)
+    summary["errors"] = len(errors)
+    return summary
+
+
+class Bench(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.corpora = build_corpora(args.directory, args.long_rows)
+        self.server = FileServer(args.directory, latency=args.latency)
+        self.server.start()
+        self.ckan = FakeCKAN(self.server, latency=args.action_latency)
+        self.pkg_dict = self.ckan.add_package("bench", [name + ".csv" for name in sorted(self.corpora)])
+        self.resources = dict((resource["name"][:-len(".csv")], resource) for resource in self.pkg_dict["resources"])
+        #The same files again, this time loaded into the DataStore
+        self.datastore_pkg_dict = self.ckan.add_package("bench-datastore", [name + ".csv" for name in SAMPLE_CORPORA])
+        for resource in self.datastore_pkg_dict["resources"]:
+            corpus = self.corpora[resource["name"][:-len(".csv")]]
+            headers = make_headers(corpus["columns"], corpus["style"])
+            self.ckan.add_datastore_table(resource["id"], [{"id": header, "type": "numeric" if i % 2 else "text"}
+                                                           for i, header in enumerate(headers)])
+
+        #What CSVMetadataPlugin.configure would set up
+        plugin.form_schema_path = os.path.join(os.path.dirname(plugin.__file__), "form_schema.json")
+        plugin.ckan_site_url = "http://localhost"
+        plugin.ckan_api = self.ckan
+        self.controller = plugin.ResourceCSVController()
+        self.results = {}
+        self.unique = itertools.count()
+
+    def cold_url(self, url):
+        #A URL the sniffing cache hasn't seen, the stand-in server ignores the query
+        return "{}?n={}".format(url, next(self.unique))
+
+    def report(self, name, summary):
+        self.results[name] = summary
+        line = "{:<32} p50 {:9.2f} ms  p95 {:9.2f} ms  p99 {:9.2f} ms".format(
+            name, summary["p50"] * 1000, summary["p95"] * 1000, summary["p99"] * 1000)
+        if "throughput" in summary:
+            line += "  {:8.1f} req/s".format(summary["throughput"])
+        if summary.get("errors"):
+            line += "  {} errors".format(summary["errors"])
+        if "rows_per_second" in summary:
+            line += "  {:12.0f} rows/s".format(summary["rows_per_second"])
+        print(line)
+
+    def csv_info(self, name):
+        status, csv_headers, csv_info = self.controller.get_csv_sample(self.cold_url(self.resources[name]["url"]))
+        if status != "ok":
+            raise Exception("Can't sniff corpus {}: {}".format(name, status))
+        return csv_headers, csv_info
+
+    def form_data(self, name):
+        csv_headers, csv_info = self.csv_info(name)
+        return self.controller.values_to_form(csv_headers, csv_info, {})
+
+    def micro(self):
+        repeat = self.args.repeat
+        for name in SAMPLE_CORPORA:
+            with open(self.corpora[name]["path"], "rb") as f:
+                content = self.controller.read_csv_head(f.read)
+            self.report("sniff:" + name, measure(lambda i: self.controller.sniff_csv_sample(content, None), repeat))
+            url = self.resources[name]["url"]
+            self.report("csv_sample_cold:" + name,
+                        measure(lambda i: self.controller.get_csv_sample(self.cold_url(url)), repeat))
+            self.report("csv_sample_warm:" + name,
+                        measure(lambda i: self.controller.get_csv_sample(url), repeat))
+
+        resource = self.resources["wide"]
+        form_data = self.form_data("wide")
+        self.report("form_to_csvw:wide", measure(
+            lambda i: self.controller.form_to_csvw(dict(form_data), self.pkg_dict, resource), repeat))
+        csvw_dict = json.loads(self.controller.form_to_csvw(dict(form_data), self.pkg_dict, resource))
+        self.report("csvw_to_form:wide", measure(lambda i: self.controller.csvw_to_form(csvw_dict), repeat))
+
+        corpus = self.corpora["long"]
+        summary = measure(lambda i: self.read_rows(corpus), 1)
+        summary["rows_per_second"] = corpus["rows"] / summary["p50"]
+        self.report("stream_read:long", summary)
+
+        form_data = self.form_data("long")
+        csvw_dict = json.loads(self.controller.form_to_csvw(dict(form_data), self.pkg_dict, self.resources["long"]))
+        summary = measure(lambda i: validation.validate_file(corpus["path"], csvw_dict), 1)
+        summary["rows_per_second"] = corpus["rows"] / summary["p50"]
+        self.report("validate:long", summary)
+
+    def read_rows(self, corpus):
+        with open(corpus["path"], "rb") as f:
+            for row in CSVStreamReader(f.read, corpus["delimiter"]):
+                pass
+
+    def page_get(self, i, cold=False):
+        resource = self.resources[SAMPLE_CORPORA[i % len(SAMPLE_CORPORA)]]
+        if cold:
+            resource = dict(resource, url=self.cold_url(resource["url"]))
+        status, csv_headers, csv_info, values, json_url = self.controller.get_page_data(resource, self.pkg_dict)
+        if status != "ok":
+            raise Exception("Page status {}".format(status))
+
+    def page_get_datastore(self, i):
+        resources = self.datastore_pkg_dict["resources"]
+        resource = resources[i % len(resources)]
+        status, csv_headers, csv_info, values, json_url = self.controller.get_page_data(resource,
+                                                                                       self.datastore_pkg_dict)
+        if status != "ok":
+            raise Exception("Page status {}".format(status))
+
+    def page_post(self, forms, i):
+        name, form_data = forms[i % len(forms)]
+        resource = self.resources[name]
+        csvw_string = self.controller.form_to_csvw(dict(form_data), self.pkg_dict, resource)
+        filename = self.controller.make_json_filename(self.controller.filename_from_url(resource["url"]))
+        plugin.save_csvw(self.pkg_dict["id"], resource["id"], csvw_string, filename, self.pkg_dict)
+
+    def end_to_end(self):
+        args = self.args
+        self.report("page_get_cold", load(lambda i: self.page_get(i, cold=True), args.requests, args.concurrency))
+        self.report("page_get_warm", load(self.page_get, args.requests, args.concurrency))
+        self.report("page_get_datastore", load(self.page_get_datastore, args.requests, args.concurrency))
+        forms = [(name, self.form_data(name)) for name in SAMPLE_CORPORA]
+        self.report("page_post", load(lambda i: self.page_post(forms, i), args.requests, args.concurrency))
+        #Now that the resources have CSVW files, GET fetches and decodes them instead of profiling
+        self.report("page_get_with_csvw", load(self.page_get, args.requests, args.concurrency))
+
+    def environment(self):
+        args = self.args
+        return {"python": platform.python_version(), "platform": platform.platform(),
+                "cpus": multiprocessing.cpu_count(), "long_rows": args.long_rows, "latency": args.latency,
+                "action_latency": args.action_latency, "concurrency": args.concurrency,
+                "requests": args.requests, "repeat": args.repeat, "fetch_threads": fetch.fetch_pool_size}
+
+
+def compare(results, baseline, tolerance):
+    """
+        Returns the names of results that are slower than their baseline
+        by more than the tolerance. Tail latency (p95) is compared.
+    """
+    regressions = []
+    for name, summary in sorted(results.items()):
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        change = summary["p95"] / previous["p95"] - 1 if previous["p95"] else 0
+        flag = "REGRESSION" if change > tolerance else ""
+        print("{:<32} {:9.2f} ms -> {:9.2f} ms {:+7.1%} {}".format(
+            name, previous["p95"] * 1000, summary["p95"] * 1000, change, flag))
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--directory", default=DEFAULT_DIRECTORY, help="where corpora are generated")
+    parser.add_argument("--long-rows", type=int, default=None)
+    parser.add_argument("--full", action="store_true", help="use a {} row long file".format(FULL_LONG_ROWS))
+    parser.add_argument("--latency", type=float, default=0.0, help="stand-in web server latency, seconds")
+    parser.add_argument("--action-latency", type=float, default=0.0, help="stand-in CKAN action latency, seconds")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--skip-end-to-end", action="store_true")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    args.long_rows = args.long_rows or (FULL_LONG_ROWS if args.full else LONG_ROWS)
+
+    bench = Bench(args)
+    try:
+        if not args.skip_micro:
+            bench.micro()
+        if not args.skip_end_to_end:
+            bench.end_to_end()
+    finally:
+        bench.server.stop()
+    print("CKAN action calls: {}".format(bench.ckan.calls))
+
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("environment") != bench.environment():
+            print("Baseline was measured with different settings: {}".format(baseline.get("environment")))
+        regressions = compare(bench.results, baseline, args.tolerance)
+        if regressions:
+            print("{} benchmarks regressed by more than {:.0%}".format(len(regressions), args.tolerance))
+            sys.exit(1)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"environment": bench.environment(), "results": bench.results}, f, indent=2, sort_keys=True)
+        print("Baseline saved to {}".format(args.baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,510 @@
+# encoding: utf-8
+
+import os
+import time
+import uuid
+import logging
+import tempfile
+import threading
+
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+
+import fetch
+import jobs
+import plugin
+import refindex
+import datastore
+import validation
+from storage import local_upload_path
+from csv_unicode import CSVStreamReader
+
+log = logging.getLogger(__name__)
+
+#Number of packages requested at a time when going through an organization
+package_search_rows = 100
+
+
+def as_list(value):
+    """
+        Action parameters can come as lists (JSON POST) or comma-separated strings (GET).
+    """
+    if value is None:
+        return []
+    if isinstance(value, basestring):
+        return [item.strip() for item in value.split(",") if item.strip()]
+    return list(value)
+
+
+def organization_package_ids(context, organization_id):
+    org = tk.get_action('organization_show')(dict(context), {'id': organization_id,
+                                                             'include_datasets': False})
+    package_ids = []
+    start = 0
+    while True:
+        result = tk.get_action('package_search')(dict(context), {'fq': 'owner_org:"{}"'.format(org["id"]),
+                                                                 'fl': 'id',
+                                                                 'include_private': True,
+                                                                 'rows': package_search_rows,
+                                                                 'start': start})
+        package_ids.extend(package["id"] for package in result["results"])
+        start += package_search_rows
+        if start >= result["count"] or not result["results"]:
+            return package_ids
+
+
+def prepare_csvw(controller, pkg_dict, resource):
+    """
+        Does everything for one CSV resource that doesn't write to CKAN:
+        sniffs the CSV (or reads its columns from the DataStore table, if it has one),
+        takes column descriptions from its existing CSVW file (or, if there is none,
+        from profiling the data or the DataStore field types) and builds the new CSVW.
+        Runs in the bulk thread pool, so it only uses the controller and HTTP/filestore reads.
+        Returns the CSVW JSON string.
+    """
+    resource_url = resource.get("url")
+    if not resource_url:
+        raise Exception("url_fail")
+    url_type = resource.get("url_type")
+    values = {}
+    json_dict = None
+    json_url, json_url_type, json_resource_id = controller.find_existing_json_for_resource(resource, pkg_dict)
+    if json_url:
+        try:
+            json_dict = controller.fetch_json_return_values(json_url, json_url_type, json_resource_id)
+            values = controller.csvw_to_form(json_dict)
+        except Exception as e:
+            #Same as on the metadata page - a broken CSVW file gets replaced with a new one
+            log.warning("Can't reuse CSVW {} for resource {}: {}".format(json_url, resource["id"], repr(e)))
+
+    datastore_result = controller.get_datastore_columns(resource)
+    if datastore_result is not None:
+        csv_headers, datastore_values = datastore_result
+        csv_info = controller.known_dialect(resource_url, json_dict)
+        values = values or datastore_values
+    else:
+        status, csv_headers, csv_info = controller.get_csv_sample(resource_url, url_type, resource)
+        if status != "ok":
+            raise Exception(status)
+        if not values and plugin.profile_suggestions:
+            values = controller.get_column_suggestions(resource_url, url_type, resource, csv_headers, csv_info)
+
+    form_data = controller.values_to_form(csv_headers, csv_info, values)
+    return controller.form_to_csvw(form_data, pkg_dict, resource)
+
+
+def prepare_csvw_in_pool(controller, pkg_dict, resource, caller):
+    """
+        prepare_csvw for the bulk thread pool. Pool threads outlive the job, and the
+        database session each of them gets from the DataStore and CKAN API reads would
+        stay open, so it's removed after every call - unless the call ran inline in
+        the caller thread (see fetch.run_concurrently), which still uses its session.
+    """
+    try:
+        return prepare_csvw(controller, pkg_dict, resource)
+    finally:
+        if threading.current_thread() is not caller:
+            model.Session.remove()
+
+
+def generate_for_package(context, package_id, resource_ids=None, skip_existing=False, pkg_dict=None):
+    """
+        Generates CSVW for CSV resources of one package (all of them, or only
+        those in resource_ids). CSV files are sniffed in parallel, CSVW files are
+        uploaded one by one, and all new links are saved with a single package update.
+        Returns generated, failed and skipped lists like csvmetadata_bulk_generate.
+    """
+    controller = plugin.ResourceCSVController()
+    if pkg_dict is None:
+        pkg_dict = tk.get_action('package_show')(dict(context), {'id': package_id})
+    generated, failed, skipped = [], [], []
+
+    resources = []
+    for resource in pkg_dict["resources"]:
+        if resource_ids is not None and resource["id"] not in resource_ids:
+            continue
+        if str(resource.get("format")) != "CSV":
+            if resource_ids is not None:
+                skipped.append({"resource_id": resource["id"], "reason": "not_csv"})
+            continue
+        if skip_existing and controller.find_existing_json_for_resource(resource, pkg_dict)[0]:
+            skipped.append({"resource_id": resource["id"], "reason": "has_csvw"})
+            continue
+        resources.append(resource)
+
+    caller = threading.current_thread()
+    results = fetch.run_concurrently([(prepare_csvw_in_pool, (controller, pkg_dict, resource, caller))
+                                      for resource in resources], None, pool="bulk")
+
+    links = {}
+    for resource, (csvw_string, exception) in zip(resources, results):
+        if exception is not None:
+            failed.append({"resource_id": resource["id"], "error": str(exception) or repr(exception)})
+            continue
+        filename = controller.make_json_filename(controller.filename_from_url(resource["url"]))
+        try:
+            json_resource = plugin.save_csvw(pkg_dict["id"], resource["id"], csvw_string, filename, pkg_dict, link=False)
+        except Exception as e:
+            log.exception("Can't save CSVW for resource {}".format(resource["id"]))
+            failed.append({"resource_id": resource["id"], "error": repr(e)})
+            continue
+        generated.append({"resource_id": resource["id"], "csvw_resource_id": json_resource["id"]})
+        if resource.get("conformsTo") != json_resource["url"]:
+            links[resource["id"]] = json_resource["url"]
+
+    if links:
+        #Package now has the new CSVW resources too, so it has to be fetched again before updating it
+        current_resources = plugin.ckan_api.action.package_show(id=pkg_dict["id"])["resources"]
+        for resource in current_resources:
+            if resource["id"] in links:
+                resource["conformsTo"] = links[resource["id"]]
+        plugin.ckan_api.action.package_patch(id=pkg_dict["id"], resources=current_resources)
+
+    return generated, failed, skipped
+
+
+def bulk_targets(context, data_dict):
+    """
+        Works out the packages and resources of a csvmetadata_bulk_generate call and
+        checks that the caller may update those packages. Returns a dictionary of
+        package ID -> list of resource IDs to process in it (None meaning all CSV
+        resources), and the packages that had to be looked up, by ID.
+    """
+    package_ids = as_list(data_dict.get('package_id'))
+    organization_id = data_dict.get('organization_id')
+    resource_ids = as_list(data_dict.get('resource_ids'))
+    if not (package_ids or organization_id or resource_ids):
+        raise tk.ValidationError({'package_id': ['One of package_id, organization_id or resource_ids is required']})
+
+    targets = {}
+    pkg_dicts = {}
+    for package_id in package_ids:
+        #Packages can be given by name, resources refer to them by ID
+        pkg_dict = tk.get_action('package_show')(dict(context), {'id': package_id})
+        pkg_dicts[pkg_dict["id"]] = pkg_dict
+        targets[pkg_dict["id"]] = None
+    if organization_id:
+        for package_id in organization_package_ids(context, organization_id):
+            targets[package_id] = None
+    for resource_id in resource_ids:
+        resource = tk.get_action('resource_show')(dict(context), {'id': resource_id})
+        if targets.get(resource["package_id"], ()) is not None:
+            package_resource_ids = targets.setdefault(resource["package_id"], [])
+            if resource_id not in package_resource_ids:
+                package_resource_ids.append(resource_id)
+
+    for package_id in targets:
+        tk.check_access('package_update', dict(context), {'id': package_id})
+    return targets, pkg_dicts
+
+
+def bulk_generate(targets, skip_existing=False, job_key=None, pkg_dicts=None):
+    """
+        Generates CSVW for the packages and resources that bulk_targets returned,
+        one package at a time, preparing each package's resources in the bulk thread pool.
+        Runs either in the request, from the paster command or as a background job,
+        see jobs.async_mode. Access has been checked already, so packages are read
+        and updated as the site user. With a job key, results so far are kept
+        in the job's progress after every package.
+        Returns a dictionary with "generated", "failed" and "skipped" lists.
+    """
+    site_user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
+    context = {'user': site_user['name'], 'ignore_auth': True}
+    pkg_dicts = pkg_dicts or {}
+    result = {"generated": [], "failed": [], "skipped": []}
+    for number, (package_id, package_resource_ids) in enumerate(targets.items()):
+        try:
+            package_results = generate_for_package(context, package_id, package_resource_ids, skip_existing,
+                                                   pkg_dicts.get(package_id))
+        except Exception as e:
+            log.exception("Can't generate CSVW for package {}".format(package_id))
+            result["failed"].append({"package_id": package_id, "error": repr(e)})
+        else:
+            result["generated"].extend(package_results[0])
+            result["failed"].extend(package_results[1])
+            result["skipped"].extend(package_results[2])
+        if job_key is not None:
+            jobs.set_progress(job_key, dict(result, package_ids=list(targets), packages_done=number + 1))
+    return result
+
+
+def csvmetadata_bulk_generate(context, data_dict):
+    """
+        Generates or refreshes CSVW metadata for every CSV resource of a package,
+        of every package in an organization, or for a list of resources.
+
+        :param package_id: id or name of a package
+        :param organization_id: id or name of an organization
+        :param resource_ids: list of CSV resource ids
+        :param skip_existing: leave resources that already have CSVW alone (default: False)
+
+        Existing CSVW column descriptions are kept, columns without one are
+        described from the data. If CSV metadata extension saves files in the
+        background (csvmetadata.async_mode), so does this, and the result is
+        {"status": "pending", "job_key": ...}. csvmetadata_bulk_generate_status
+        then shows how far it has got. Otherwise returns a dictionary with
+        "generated", "failed" and "skipped" lists.
+    """
+    skip_existing = tk.asbool(data_dict.get('skip_existing', False))
+    targets, pkg_dicts = bulk_targets(context, data_dict)
+
+    job_key = "bulk:" + uuid.uuid4().hex
+    #Packages looked up now might have changed by the time a background job gets to them
+    result = jobs.enqueue(bulk_generate, (targets, skip_existing, job_key if jobs.async_mode != "off" else None,
+                                          pkg_dicts if jobs.async_mode == "off" else None),
+                          job_key, title="Generate CSVW for {} packages".format(len(targets)))
+    if jobs.async_mode != "off":
+        return {"status": "pending", "job_key": job_key}
+    return result
+
+
+@tk.side_effect_free
+def csvmetadata_bulk_generate_status(context, data_dict):
+    """
+        Returns the status of a bulk generation job started by csvmetadata_bulk_generate.
+        Once the job has started, its progress has the packages it goes through, the number
+        of packages done and the "generated", "failed" and "skipped" lists so far.
+
+        :param job_key: job_key returned by csvmetadata_bulk_generate
+    """
+    job_key = data_dict.get('job_key')
+    if not job_key or not job_key.startswith("bulk:"):
+        raise tk.ValidationError({'job_key': ['Missing value']})
+    status = jobs.get_status(job_key)
+    if status is None:
+        raise tk.ObjectNotFound("Bulk generation job {} not found".format(job_key))
+    for package_id in (status.get("progress") or {}).get("package_ids", []):
+        tk.check_access('package_update', dict(context), {'id': package_id})
+    return {"job": status}
+
+
+def build_references(controller, pkg_dict, csvw_dict):
+    """
+        Builds or updates reference indexes for the columns that the CSVW
+        foreignKeys point to. Referenced resources of the same package are
+        read from the filestore if possible, others are downloaded.
+        Returns a dictionary for validation.validate_file.
+    """
+    references = {}
+    for url, column in validation.foreign_key_references(csvw_dict):
+        resource = controller.get_resource_index(pkg_dict).by_url.get(url)
+        url_type = resource.get("url_type") if resource else None
+        try:
+            #The referenced file is read with the dialect it was sniffed with
+            status, csv_headers, csv_info = controller.get_csv_sample(url, url_type, resource)
+            if status != "ok":
+                raise Exception(status)
+            source = controller.open_csv_source(url, url_type, resource)
+            references[(url, column)] = refindex.get_reference_index(url, column, csv_info, source)
+        except Exception as e:
+            log.warning("Can't index column {} of {}: {}".format(column, url, repr(e)))
+            references[(url, column)] = str(e) or repr(e)
+    return references
+
+
+def too_large_to_validate(max_bytes):
+    return tk.ValidationError({'resource_id': [
+        'Files larger than {} bytes that are not in the filestore can only be validated in the background, '
+        'see csvmetadata.async_mode'.format(max_bytes)]})
+
+
+def validate_resource(resource_id, max_errors=None):
+    """
+        Validates a CSV resource against its CSVW file and stores the report
+        in validation.validation_reports. Files that aren't in the local filestore
+        are downloaded to a temporary file first - in the request only
+        up to validation.validation_sync_max_bytes. Runs either in the request
+        or as a background job, see jobs.async_mode.
+    """
+    controller = plugin.ResourceCSVController()
+    resource = plugin.ckan_api.action.resource_show(id=resource_id)
+    pkg_dict = plugin.ckan_api.action.package_show(id=resource["package_id"])
+    json_url, json_url_type, json_resource_id = controller.find_existing_json_for_resource(resource, pkg_dict)
+    if not json_url:
+        raise Exception("Resource {} has no CSVW metadata to validate against".format(resource_id))
+    csvw_dict = controller.fetch_json_return_values(json_url, json_url_type, json_resource_id)
+
+    path = local_upload_path(resource)
+    #In the request a remote file would be downloaded in full and validated in a single process
+    max_bytes = validation.validation_sync_max_bytes if jobs.async_mode == "off" and path is None else 0
+    if max_bytes and int(resource.get("size") or 0) > max_bytes:
+        raise too_large_to_validate(max_bytes)
+    temp_path = None
+    try:
+        if path is None:
+            stream = controller.open_csv_stream(resource["url"], resource.get("url_type"), resource)
+            try:
+                with tempfile.NamedTemporaryFile(prefix="csvmetadata-", suffix=".csv", delete=False) as f:
+                    temp_path = f.name
+                    copied = 0
+                    while True:
+                        data = stream.read(1048576)
+                        if not data:
+                            break
+                        copied += len(data)
+                        if max_bytes and copied > max_bytes:
+                            raise too_large_to_validate(max_bytes)
+                        f.write(data)
+            finally:
+                stream.close()
+            path = temp_path
+        references = build_references(controller, pkg_dict, csvw_dict)
+        #Worker processes are only forked from CKAN job workers: forking a web server process
+        #copies its threads' locks and open connections, so there the chunks are validated in-process
+        processes = None if jobs.async_mode == "ckan" else 1
+        report = validation.validate_file(path, csvw_dict, max_errors, processes, references=references)
+    finally:
+        if temp_path is not None:
+            os.remove(temp_path)
+
+    report["csvw_url"] = json_url
+    report["validated"] = time.time()
+    validation.validation_reports.set(resource_id, report)
+    return report
+
+
+def prewarm_page(resource_id):
+    """
+        Gathers the CSV metadata page data of a resource - sniffing, encoding
+        detection and column suggestions - and caches it for the page, right after
+        the resource was created or updated. Runs as a background job, see plugin.prewarm_resources.
+    """
+    controller = plugin.ResourceCSVController()
+    resource = plugin.ckan_api.action.resource_show(id=resource_id)
+    pkg_dict = plugin.ckan_api.action.package_show(id=resource["package_id"])
+    page_data = controller.get_page_data(resource, pkg_dict)
+    controller.cache_page_data(resource, pkg_dict, page_data, prewarmed=True)
+    log.info("Prepared CSV metadata page for resource {}: {}".format(resource_id, page_data[0]))
+
+
+def load_into_datastore(resource_id, chunk_rows=None, progress=None):
+    """
+        Loads a CSV resource into the DataStore with the column types its CSVW
+        file describes, replacing the rows of the resource's DataStore table. The file is read
+        with the CSVW dialect and streamed to the DataStore with COPY in chunks
+        of rows (see datastore.replace_rows). If loading fails, the old rows
+        stay as they were. Rows loaded so far are reported
+        to progress(rows), or, if it isn't given, to the job status.
+        Runs either in the request or as a background job, see jobs.async_mode.
+        Returns a summary dictionary.
+    """
+    started = time.time()
+    controller = plugin.ResourceCSVController()
+    resource = plugin.ckan_api.action.resource_show(id=resource_id)
+    pkg_dict = plugin.ckan_api.action.package_show(id=resource["package_id"])
+    json_url, json_url_type, json_resource_id = controller.find_existing_json_for_resource(resource, pkg_dict)
+    if not json_url:
+        raise Exception("Resource {} has no CSVW metadata to load it with".format(resource_id))
+    csvw_dict = controller.fetch_json_return_values(json_url, json_url_type, json_resource_id)
+    dialect = csvw_dict.get("dialect") or {}
+    if not dialect.get("delimiter") or not dialect.get("quoteChar"):
+        raise Exception("CSVW has no CSV dialect to read the file with")
+    fields = datastore.csvw_fields(csvw_dict)
+    if progress is None:
+        progress = lambda rows: jobs.set_progress("datastore:" + resource_id, {"rows": rows})
+
+    #A resource that isn't in the DataStore yet gets its table from the DataStore, which also
+    #marks it datastore_active, and the table is removed again if loading fails
+    created = datastore.datastore_fields(plugin.ckan_api, resource_id) is None
+    if created:
+        plugin.ckan_api.action.datastore_create(resource_id=resource_id, fields=fields, force=True)
+
+    stream = controller.open_csv_stream(resource["url"], resource.get("url_type"), resource)
+    try:
+        rows = iter(CSVStreamReader(stream.read, dialect["delimiter"], dialect["quoteChar"],
+                                    encoding=dialect.get("encoding")))
+        if dialect.get("header", True):
+            next(rows, None)
+        #All rows are replaced, and the columns too, as the fields might have changed
+        loaded = datastore.replace_rows(resource_id, fields, rows, chunk_rows, progress)
+    except Exception:
+        if created:
+            plugin.ckan_api.action.datastore_delete(resource_id=resource_id, force=True)
+        raise
+    finally:
+        stream.close()
+    return {"rows": loaded, "fields": fields, "csvw_url": json_url, "seconds": round(time.time() - started, 3)}
+
+
+def csvmetadata_datastore_load(context, data_dict):
+    """
+        Loads a CSV resource into the DataStore, with Postgres column types
+        from its CSVW file instead of guessed ones, using bulk COPY.
+        Rows of the resource's existing DataStore table are replaced.
+
+        :param resource_id: id of the CSV resource
+        :param chunk_rows: number of rows sent to the DataStore at a time (optional)
+
+        If CSV metadata extension saves files in the background (csvmetadata.async_mode),
+        so does this, and the result is {"status": "pending"}. Progress is then
+        shown by csvmetadata_datastore_load_status. Otherwise returns the number
+        of rows loaded and the DataStore fields.
+    """
+    resource_id = data_dict.get('resource_id')
+    if not resource_id:
+        raise tk.ValidationError({'resource_id': ['Missing value']})
+    tk.check_access('resource_update', dict(context), {'id': resource_id})
+    chunk_rows = int(data_dict['chunk_rows']) if data_dict.get('chunk_rows') else None
+
+    result = jobs.enqueue(load_into_datastore, (resource_id, chunk_rows), "datastore:" + resource_id,
+                          title="Load resource {} into the DataStore".format(resource_id))
+    if jobs.async_mode != "off":
+        return {"status": "pending"}
+    return result
+
+
+@tk.side_effect_free
+def csvmetadata_datastore_load_status(context, data_dict):
+    """
+        Returns the status of the latest DataStore loading job of a CSV resource,
+        with the number of rows loaded so far in its progress.
+
+        :param resource_id: id of the CSV resource
+    """
+    resource_id = data_dict.get('resource_id')
+    if not resource_id:
+        raise tk.ValidationError({'resource_id': ['Missing value']})
+    tk.check_access('resource_show', dict(context), {'id': resource_id})
+    return {"job": jobs.get_status("datastore:" + resource_id)}
+
+
+def csvmetadata_validate(context, data_dict):
+    """
+        Checks the data of a CSV resource against the constraints in its CSVW
+        file: base datatype, length, required, minimum/maximum and primary key.
+
+        :param resource_id: id of the CSV resource
+        :param max_errors: stop after this many errors (optional)
+
+        If CSV metadata extension saves files in the background (csvmetadata.async_mode),
+        so does this, and the result is {"status": "pending"}. The report is
+        then shown by csvmetadata_validation_report once it's ready.
+        Otherwise returns the validation report.
+    """
+    resource_id = data_dict.get('resource_id')
+    if not resource_id:
+        raise tk.ValidationError({'resource_id': ['Missing value']})
+    tk.check_access('resource_update', dict(context), {'id': resource_id})
+    max_errors = int(data_dict['max_errors']) if data_dict.get('max_errors') else None
+
+    report = jobs.enqueue(validate_resource, (resource_id, max_errors), "validate:" + resource_id,
+                          title="Validate resource {}".format(resource_id))
+    if jobs.async_mode != "off":
+        return {"status": "pending"}
+    return report
+
+
+@tk.side_effect_free
+def csvmetadata_validation_report(context, data_dict):
+    """
+        Returns the latest validation report of a CSV resource, together with
+        the status of the validation job, if there is one.
+
+        :param resource_id: id of the CSV resource
+    """
+    resource_id = data_dict.get('resource_id')
+    if not resource_id:
+        raise tk.ValidationError({'resource_id': ['Missing value']})
+    tk.check_access('resource_show', dict(context), {'id': resource_id})
+    return {"job": jobs.get_status("validate:" + resource_id),
+            "report": validation.validation_reports.get(resource_id)}
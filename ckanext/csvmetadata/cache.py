@@ -0,0 +1,165 @@
+# encoding: utf-8
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """
+        A bounded in-process cache that evicts least recently used entries.
+        Values are stored as-is, so callers shouldn't modify what they get back.
+    """
+    def __init__(self, max_size=512):
+        self.max_size = max(int(max_size), 1)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            #Re-inserting the value moves it to the "most recently used" end
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def count(self, counter, amount=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["size"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = float(stats["hits"]) / lookups if lookups else 0.0
+        return stats
+
+
+class SQLiteCache(LRUCache):
+    """
+        A bounded LRU cache stored in an SQLite database, so that cached entries
+        survive restarts and are shared between all worker processes on the host.
+        Values must be JSON-serializable; tuples come back as lists.
+        Hit/miss counters are per process.
+        Caches are created in configure, which preforking servers run before forking
+        workers, and SQLite connections must not be used by more than one process,
+        so each process opens its own connection on first use.
+    """
+    def __init__(self, path, max_size=512, table="entries"):
+        super(SQLiteCache, self).__init__(max_size)
+        self.path = path
+        self.table = table
+        self._connection = None
+        self._connection_pid = None
+
+    @property
+    def _conn(self):
+        #Only used with self._lock held
+        if self._connection is None or self._connection_pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS {0} "
+                                   "(key TEXT PRIMARY KEY, value TEXT, accessed REAL)".format(self.table))
+                connection.execute("CREATE INDEX IF NOT EXISTS {0}_accessed ON {0} (accessed)".format(self.table))
+            self._connection = connection
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                row = self._conn.execute("SELECT value FROM {} WHERE key = ?".format(self.table), (key,)).fetchone()
+                if row is None:
+                    return default
+                with self._conn:
+                    self._conn.execute("UPDATE {} SET accessed = ? WHERE key = ?".format(self.table), (time.time(), key))
+                return json.loads(row[0])
+            except (sqlite3.Error, ValueError) as e:
+                #A broken or locked cache file shouldn't break the page, just make it slower
+                log.warning("Error while reading {} from cache {}: {}".format(key, self.path, repr(e)))
+                return default
+
+    def set(self, key, value):
+        with self._lock:
+            try:
+                with self._conn:
+                    self._conn.execute("INSERT OR REPLACE INTO {} (key, value, accessed) VALUES (?, ?, ?)"
+                                       .format(self.table), (key, json.dumps(value), time.time()))
+                    excess = self._conn.execute("SELECT COUNT(*) FROM {}".format(self.table)).fetchone()[0] - self.max_size
+                    if excess > 0:
+                        self._conn.execute("DELETE FROM {0} WHERE key IN "
+                                           "(SELECT key FROM {0} ORDER BY accessed ASC LIMIT ?)"
+                                           .format(self.table), (excess,))
+                        self.counters["evictions"] += excess
+            except sqlite3.Error as e:
+                log.warning("Error while writing {} to cache {}: {}".format(key, self.path, repr(e)))
+
+    def delete(self, key):
+        with self._lock:
+            try:
+                with self._conn:
+                    self._conn.execute("DELETE FROM {} WHERE key = ?".format(self.table), (key,))
+            except sqlite3.Error as e:
+                log.warning("Error while deleting {} from cache {}: {}".format(key, self.path, repr(e)))
+
+    def clear(self):
+        with self._lock:
+            try:
+                with self._conn:
+                    self._conn.execute("DELETE FROM {}".format(self.table))
+            except sqlite3.Error as e:
+                log.warning("Error while clearing cache {}: {}".format(self.path, repr(e)))
+
+    def __len__(self):
+        with self._lock:
+            try:
+                return self._conn.execute("SELECT COUNT(*) FROM {}".format(self.table)).fetchone()[0]
+            except sqlite3.Error as e:
+                #stats() counts the entries too, and shouldn't break the page that shows them
+                log.warning("Error while counting entries of cache {}: {}".format(self.path, repr(e)))
+                return 0
+
+    def stats(self):
+        stats = super(SQLiteCache, self).stats()
+        stats["size"] = len(self)
+        return stats
+
+
+def make_cache(max_size=512, path=None, table="entries"):
+    """
+        Returns an SQLite-backed cache if a database path is given,
+        otherwise an in-process LRU cache.
+        Several caches can share one database file if their table names differ.
+    """
+    if path:
+        return SQLiteCache(path, max_size, table)
+    return LRUCache(max_size)
@@ -0,0 +1,151 @@
+# encoding: utf-8
+
+import json
+import time
+import hashlib
+import calendar
+import datetime
+import logging
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+import fetch
+from cache import make_cache
+
+log = logging.getLogger(__name__)
+
+#A global that stores CSVW TableGroup documents of packages and the table descriptions
+#they were built from, keyed by package ID
+catalog_cache = make_cache()
+
+
+def configure(config):
+    global catalog_cache
+    catalog_cache = make_cache(max_size=int(config.get('csvmetadata.sniff_cache_size', 512)),
+                               path=config.get('csvmetadata.sniff_cache_path'),
+                               table="catalogs")
+
+
+def parse_timestamp(value):
+    """
+        Seconds since the epoch for a CKAN timestamp, like "2018-03-01T12:30:00.123456" (UTC), or None.
+    """
+    if not value:
+        return None
+    try:
+        return calendar.timegm(datetime.datetime.strptime(value.split(".")[0], "%Y-%m-%dT%H:%M:%S").timetuple())
+    except ValueError:
+        return None
+
+
+def member_stamp(resource, json_url, json_resource):
+    #A table description is fetched again when the CSV URL, the CSVW URL or the CSVW file changes
+    #CSVW files uploaded in place of the old ones keep their URL, but get a new last_modified
+    if not json_resource:
+        return [resource["url"], json_url, None, None]
+    return [resource["url"], json_url, json_resource.get("last_modified"), json_resource.get("created")]
+
+
+def table_description(csvw_dict):
+    """
+        A table of the TableGroup: the resource's CSVW, without its own context.
+    """
+    table = dict((key, value) for key, value in csvw_dict.items() if key != "@context")
+    table["@type"] = "Table"
+    return table
+
+
+def get_table_group(controller, pkg_dict, deadline=None):
+    """
+        Returns the CSVW TableGroup of a package, combining the CSVW
+        descriptions of all its CSV resources, as a dictionary with
+        the JSON document, its strong ETag and Last-Modified time.
+
+        The group is kept in catalog_cache until the package's metadata_modified
+        changes. Then only the CSVW files of the resources whose CSV URL or CSVW file
+        have changed are fetched again, the other tables are reused. CSVW files
+        that can't be fetched, or aren't fetched within deadline seconds (None waits
+        for all of them), are left out, the group is marked incomplete, and fetching
+        them is retried on the next request.
+    """
+    cached = catalog_cache.get(pkg_dict["id"])
+    if cached is not None and cached["metadata_modified"] == pkg_dict.get("metadata_modified"):
+        catalog_cache.count("hits")
+        return cached
+    catalog_cache.count("misses")
+
+    previous_tables = cached["tables"] if cached is not None else {}
+    index = controller.get_resource_index(pkg_dict)
+    members = []
+    calls = []
+    for resource in pkg_dict["resources"]:
+        if str(resource.get("format")) != "CSV" or not resource.get("url"):
+            continue
+        json_url, json_url_type, json_resource_id = controller.find_existing_json_for_resource(resource, pkg_dict)
+        if not json_url:
+            continue
+        json_resource = index.by_id.get(json_resource_id) if json_resource_id else None
+        stamp = member_stamp(resource, json_url, json_resource)
+        previous = previous_tables.get(resource["id"])
+        if previous is not None and previous["stamp"] == stamp:
+            members.append((resource, previous, None))
+            continue
+        modified = parse_timestamp(stamp[2] or stamp[3])
+        members.append((resource, {"stamp": stamp, "modified": modified}, len(calls)))
+        calls.append((controller.fetch_json_return_values, (json_url, json_url_type, json_resource_id)))
+    results = fetch.run_concurrently(calls, deadline)
+
+    tables = {}
+    complete = True
+    for resource, member, call_index in members:
+        if call_index is not None:
+            csvw_dict, exception = results[call_index]
+            if exception is None and not isinstance(csvw_dict, dict):
+                exception = ValueError("CSVW isn't a JSON object")
+            if exception is not None:
+                log.warning("Leaving resource {} out of the CSVW of package {}: {}".format(
+                    resource["id"], pkg_dict["id"], repr(exception)))
+                complete = False
+                continue
+            member["table"] = table_description(csvw_dict)
+        tables[resource["id"]] = member
+
+    #Tables follow the order of resources in the package
+    group = {"@context": ["http://www.w3.org/ns/csvw", {"@language": "lv"}],
+             "@type": "TableGroup",
+             "dc:title": pkg_dict.get("title"),
+             "tables": [tables[resource["id"]]["table"] for resource, member, call_index in members
+                        if resource["id"] in tables]}
+    document = json.dumps(group, sort_keys=True)
+    #Last-Modified is when the newest CSVW file was saved, or, if that's not known, when the package was
+    modified_times = [member["modified"] for member in tables.values() if member["modified"] is not None]
+    if not modified_times:
+        modified_times = [parse_timestamp(pkg_dict.get("metadata_modified")) or time.time()]
+    catalog = {"metadata_modified": pkg_dict.get("metadata_modified") if complete else None,
+               "complete": complete,
+               "tables": tables,
+               "document": document,
+               "etag": '"{}"'.format(hashlib.sha1(document).hexdigest()),
+               "last_modified": max(modified_times)}
+    catalog_cache.set(pkg_dict["id"], catalog)
+    return catalog
+
+
+def http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
+
+
+def not_modified(request_headers, etag, last_modified):
+    """
+        Whether a conditional request's If-None-Match or, if it has none,
+        If-Modified-Since header says the client has the current version.
+    """
+    if_none_match = request_headers.get("If-None-Match")
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        #Proxies that compress responses can make the ETag weak
+        return "*" in tags or etag in tags or "W/" + etag in tags
+    if_modified_since = request_headers.get("If-Modified-Since")
+    if if_modified_since:
+        parsed = parsedate_tz(if_modified_since)
+        return parsed is not None and int(last_modified) <= mktime_tz(parsed)
+    return False
@@ -0,0 +1,96 @@
+# encoding: utf-8
+
+import sys
+import json
+
+from ckan.lib.cli import CkanCommand
+
+
+class CSVMetadataCommand(CkanCommand):
+    """
+        CSV metadata management commands
+
+        Usage:
+            paster csvmetadata bulk-generate [options] -c <path to config file>
+                Generates or refreshes CSVW metadata for all CSV resources of
+                the given packages, organization or resources
+
+            paster csvmetadata datastore-load -r <id> [options] -c <path to config file>
+                Loads CSV resources into the DataStore with the column types
+                from their CSVW files
+
+        Options for bulk-generate:
+            -p, --package <id or name>    can be given several times
+            -o, --organization <id or name>
+            -r, --resource <id>           can be given several times
+            -s, --skip-existing           don't touch resources that already have CSVW
+
+        Options for datastore-load:
+            -r, --resource <id>           can be given several times
+            --chunk-rows <number>         rows sent to the DataStore at a time
+    """
+    summary = __doc__.split('\n')[1].strip()
+    usage = __doc__
+    max_args = 1
+    min_args = 1
+
+    def __init__(self, name):
+        super(CSVMetadataCommand, self).__init__(name)
+        self.parser.add_option('-p', '--package', dest='package_ids', action='append', default=[])
+        self.parser.add_option('-o', '--organization', dest='organization_id', default=None)
+        self.parser.add_option('-r', '--resource', dest='resource_ids', action='append', default=[])
+        self.parser.add_option('-s', '--skip-existing', dest='skip_existing', action='store_true', default=False)
+        self.parser.add_option('--chunk-rows', dest='chunk_rows', type='int', default=None)
+
+    def command(self):
+        self._load_config()
+        cmd = self.args[0]
+        if cmd == 'bulk-generate':
+            self.bulk_generate()
+        elif cmd == 'datastore-load':
+            self.datastore_load()
+        else:
+            print('Command {} not recognized'.format(cmd))
+            print(self.usage)
+            sys.exit(1)
+
+    def bulk_generate(self):
+        import ckan.plugins.toolkit as tk
+        from ckanext.csvmetadata import actions
+
+        site_user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
+        context = {'user': site_user['name'], 'ignore_auth': True}
+        targets, pkg_dicts = actions.bulk_targets(context, {
+            'package_id': self.options.package_ids,
+            'organization_id': self.options.organization_id,
+            'resource_ids': self.options.resource_ids})
+        #Generation runs right here, not in the background
+        result = actions.bulk_generate(targets, self.options.skip_existing, pkg_dicts=pkg_dicts)
+
+        print(json.dumps(result, indent=2))
+        print('Generated: {}, failed: {}, skipped: {}'.format(
+            len(result['generated']), len(result['failed']), len(result['skipped'])))
+        if result['failed']:
+            sys.exit(1)
+
+    def datastore_load(self):
+        from ckanext.csvmetadata import actions
+
+        if not self.options.resource_ids:
+            print('Give at least one resource with -r')
+            sys.exit(1)
+        failed = 0
+        for resource_id in self.options.resource_ids:
+            #Loading runs right here, not in the background, printing progress as it goes
+            def progress(rows):
+                sys.stdout.write('\r{}: {} rows'.format(resource_id, rows))
+                sys.stdout.flush()
+            try:
+                result = actions.load_into_datastore(resource_id, self.options.chunk_rows, progress)
+            except Exception as e:
+                print('\n{}: failed: {}'.format(resource_id, repr(e)))
+                failed += 1
+            else:
+                print('\r{}: loaded {} rows in {}s'.format(resource_id, result['rows'], result['seconds']))
+        if failed:
+            sys.exit(1)
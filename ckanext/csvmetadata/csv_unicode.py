@@ -1,33 +1,189 @@
-#Taken from https://docs.python.org/2/library/csv.html
+#Streaming CSV reading for files in whatever encoding our publishers use
 
+import re
 import csv, codecs
 
-class UTF8Recoder:
+#Byte order marks, longer ones first - UTF-32 LE BOM starts with UTF-16 LE BOM
+BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32le"),
+    (codecs.BOM_UTF32_BE, "utf-32be"),
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16le"),
+    (codecs.BOM_UTF16_BE, "utf-16be"),
+)
+
+#Charsets that servers (and requests, for text/* without a charset) declare by default,
+#so the declaration doesn't tell anything about the actual encoding
+UNRELIABLE_DECLARATIONS = ("iso-8859-1", "latin-1", "latin1", "ascii", "us-ascii")
+
+#Windows-1257 has typographic quotes and dashes in 0x80-0x9F, where ISO-8859-13 only has control characters.
+#ISO-8859-13 has its quotes at 0xA1, 0xA5, 0xB4 and 0xFF instead, and those are the only other differences.
+_cp1257_punctuation = re.compile(b"[\x80-\x9f]")
+_iso885913_punctuation = re.compile(b"[\xa1\xa5\xb4\xff]")
+
+#Number of bytes encoding is detected from
+detection_sample_size = 65536
+
+#Characters CSV dialects are made of
+_csv_syntax = u"\r\n,;\t|\"' "
+
+
+def detect_bom(sample):
+    """
+        Returns (encoding, BOM length) if the sample starts with a byte order mark, otherwise (None, 0).
+    """
+    for bom, encoding in BOMS:
+        if sample.startswith(bom):
+            return encoding, len(bom)
+    return None, 0
+
+
+def decodes(sample, encoding):
+    """
+        Tells if the sample is valid in the encoding. The sample can be cut
+        in the middle of a multi-byte character.
+    """
+    try:
+        codecs.getincrementaldecoder(encoding)().decode(sample, False)
+    except (UnicodeDecodeError, LookupError):
+        return False
+    return True
+
+
+def detect_encoding(sample, declared=None):
+    """
+        Detects encoding of the beginning of a CSV file from its bytes.
+        Checks, in this order: byte order marks; UTF-16 without BOM (every other
+        byte of mostly ASCII text is zero, or one for Latvian letters); the declared encoding, unless it's
+        a default like ISO-8859-1; UTF-8 (which also covers ASCII); and at last,
+        the Windows-1257 or ISO-8859-13 encoding of Latvian 8-bit files, told
+        apart by where their quote characters are.
+        Returns (encoding, BOM length).
     """
-    Iterator that reads an encoded stream and reencodes the input to UTF-8
+    encoding, bom_length = detect_bom(sample)
+    if encoding is not None:
+        return encoding, bom_length
+
+    half = len(sample) // 2
+    #UTF-32 without BOM isn't detected, but it shouldn't pass for UTF-16: there every other 16-bit unit
+    #is zero - bytes 2 and 3 of every 4 in little endian, bytes 0 and 1 in big endian
+    units = sample[:len(sample) // 4 * 4]
+    utf32 = bool(units) and (not (units[2::4] + units[3::4]).strip(b"\x00") or
+                             not (units[0::4] + units[1::4]).strip(b"\x00"))
+    if half and not utf32:
+        even, odd = sample[0:half * 2:2], sample[1:half * 2:2]
+        #High bytes of Latvian text are 0 (ASCII) or 1 (Latvian letters are in Latin Extended-A)
+        #Low bytes can be 0 too (U+0100, capital A with macron), but not as often as the high ones
+        even_high = even.count(b"\x00") + even.count(b"\x01")
+        odd_high = odd.count(b"\x00") + odd.count(b"\x01")
+        if odd_high > half * 0.6 and odd_high > even_high:
+            return "utf-16le", 0
+        if even_high > half * 0.6 and even_high > odd_high:
+            return "utf-16be", 0
+
+    if declared and declared.lower() not in UNRELIABLE_DECLARATIONS and decodes(sample, declared):
+        return declared, 0
+    if decodes(sample, "utf-8"):
+        return "utf-8", 0
+    if len(_iso885913_punctuation.findall(sample)) > len(_cp1257_punctuation.findall(sample)):
+        return "iso-8859-13", 0
+    return "windows-1257", 0
+
+
+def ascii_compatible(encoding):
     """
-    def __init__(self, f, encoding):
-        self.reader = codecs.getreader(encoding)(f)
+        Tells if CSV delimiters, quotes and line breaks are the same bytes in the encoding as in ASCII,
+        so that the file can be split into lines and cells without decoding it.
+    """
+    try:
+        return _csv_syntax.encode(encoding) == _csv_syntax.encode("ascii")
+    except (UnicodeError, LookupError):
+        return False
+
+
+def transcode(content, encoding, final=True):
+    """
+        Re-encodes a sample in an encoding that isn't ASCII compatible (UTF-16, UTF-32) to UTF-8.
+    """
+    return codecs.getincrementaldecoder(encoding)(errors="replace").decode(content, final).encode("utf-8")
+
+
+class BlockLineReader:
+    """
+    Iterator over lines of a byte stream that reads it in large blocks
+    using the read(size) callable. Line endings are kept, like when iterating
+    over a file. Keeps count of bytes read so far in bytes_read.
+    """
+
+    def __init__(self, read, block_size=65536):
+        self.read = read
+        self.block_size = block_size
+        self.bytes_read = 0
 
     def __iter__(self):
-        return self
+        buffer = ""
+        while True:
+            block = self.read(self.block_size)
+            if not block:
+                break
+            self.bytes_read += len(block)
+            lines = (buffer + block).splitlines(True)
+            #Last line is either incomplete or might be a "\r" with "\n" in the next block
+            buffer = lines.pop()
+            for line in lines:
+                yield line
+        if buffer:
+            yield buffer
 
-    def next(self):
-        return self.reader.next().encode("utf-8")
 
-class UnicodeReader:
+class CSVStreamReader:
     """
-    A CSV reader which will iterate over lines in the CSV file "f",
-    which is encoded in the given encoding.
+    Iterator over rows of a CSV byte stream, read with the read(size) callable,
+    as lists of unicode strings.
+    The encoding is detected once from the first block, unless it's given,
+    and a byte order mark at the beginning is skipped either way.
+    Files in ASCII compatible encodings (UTF-8, Windows-1257, ISO-8859-13, ...)
+    are split into rows as they are, and only cell values are decoded.
+    UTF-16 and UTF-32 are decoded and re-encoded as UTF-8 once per block.
+    Keeps count of bytes read from the stream so far in bytes_read.
     """
 
-    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
-        f = UTF8Recoder(f, encoding)
-        self.reader = csv.reader(f, dialect=dialect, **kwds)
+    def __init__(self, read, delimiter, quotechar='"', encoding=None, errors="replace",
+                 block_size=65536, declared_encoding=None):
+        self._read = read
+        self.block_size = block_size
+        self.errors = errors
+        self.delimiter = str(delimiter)
+        self.quotechar = str(quotechar)
+        self.bytes_read = 0
+
+        self._first = read(max(block_size, detection_sample_size))
+        self.bytes_read += len(self._first)
+        bom_encoding, bom_length = detect_bom(self._first)
+        if encoding is None:
+            encoding, bom_length = detect_encoding(self._first, declared_encoding)
+        elif bom_encoding is None or codecs.lookup(bom_encoding).name != codecs.lookup(encoding).name:
+            bom_length = 0
+        self._first = self._first[bom_length:]
+        self.encoding = encoding
+        self._transcoder = None
+        if not ascii_compatible(encoding):
+            self._transcoder = codecs.getincrementaldecoder(encoding)(errors=errors)
 
-    def next(self):
-        row = self.reader.next()
-        return [unicode(s, "utf-8") for s in row]
+    def _blocks(self, size):
+        #read(size) for BlockLineReader, which counts bytes itself - here they are counted before transcoding
+        if self._first is not None:
+            block, self._first = self._first, None
+        else:
+            block = self._read(size)
+            self.bytes_read += len(block)
+        if self._transcoder is not None:
+            return self._transcoder.decode(block, not block).encode("utf-8")
+        return block
 
     def __iter__(self):
-        return self
+        decode = codecs.getdecoder("utf-8" if self._transcoder is not None else self.encoding)
+        errors = self.errors
+        lines = BlockLineReader(self._blocks, self.block_size)
+        for row in csv.reader(lines, delimiter=self.delimiter, quotechar=self.quotechar):
+            yield [decode(value, errors)[0] for value in row]
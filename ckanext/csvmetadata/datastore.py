@@ -0,0 +1,242 @@
+# encoding: utf-8
+
+import time
+import logging
+import unicodecsv as csv
+from StringIO import StringIO
+from itertools import islice
+
+import ckan.plugins.toolkit as tk
+
+log = logging.getLogger(__name__)
+
+#Whether headers and datatypes of resources that are in the DataStore are taken
+#from their DataStore table instead of downloading, sniffing and profiling the CSV file
+datastore_columns = True
+
+#Postgres types of DataStore fields and the form_schema.json datatype choices they map to
+#Other types (text, time, json, arrays, ...) are described as strings
+DATATYPES = {
+    "numeric": "decimal",
+    "int": "decimal",
+    "int2": "decimal",
+    "int4": "decimal",
+    "int8": "decimal",
+    "integer": "decimal",
+    "smallint": "decimal",
+    "bigint": "decimal",
+    "float4": "float",
+    "real": "float",
+    "float8": "double",
+    "double precision": "double",
+    "bool": "boolean",
+    "boolean": "boolean",
+    "date": "date",
+    "timestamp": "dateTime",
+    "timestamptz": "dateTime",
+    "timestamp without time zone": "dateTime",
+    "timestamp with time zone": "dateTime",
+    "bytea": "base64Binary",
+}
+
+#CSVW default dialect, for files whose dialect isn't known any other way
+DEFAULT_DIALECT = {"delimiter": ",", "encoding": "utf-8", "quoteChar": '"'}
+
+#CSVW base datatypes and the Postgres types their columns get when a file is loaded into the DataStore
+#Other datatypes (string, anyURI, base64Binary) are loaded as text
+PG_TYPES = {
+    "decimal": "numeric",
+    "double": "float8",
+    "float": "float8",
+    "boolean": "bool",
+    "date": "date",
+    "dateTime": "timestamp",
+}
+
+#Rows sent to the DataStore with each COPY when loading a file, which is also how often progress is reported
+load_chunk_rows = 50000
+
+
+def configure(config):
+    global datastore_columns, load_chunk_rows
+    datastore_columns = tk.asbool(config.get('csvmetadata.datastore_columns', datastore_columns))
+    load_chunk_rows = max(int(config.get('csvmetadata.datastore_load_chunk_rows', load_chunk_rows)), 1)
+
+
+def datastore_fields(ckan_api, resource_id):
+    """
+        Returns fields of the resource's DataStore table as a list
+        of (name, Postgres type) tuples, without the _id field the DataStore adds,
+        or None if the resource doesn't have a table.
+    """
+    try:
+        result = ckan_api.action.datastore_search(resource_id=resource_id, limit=0)
+    except Exception as e:
+        #No table, or no DataStore plugin at all
+        log.debug("No DataStore table for resource {}: {}".format(resource_id, repr(e)))
+        return None
+    fields = [(field["id"], field.get("type") or "text") for field in result.get("fields", [])
+              if field["id"] != "_id"]
+    return fields or None
+
+
+def field_values(fields):
+    """
+        CSV metadata form values with the datatypes of the fields,
+        in the same format as csvw_to_form returns them.
+    """
+    return dict(("{}-datatype".format(i), DATATYPES.get(pg_type.lower(), "string"))
+                for i, (name, pg_type) in enumerate(fields))
+
+
+def csvw_fields(csvw_dict):
+    """
+        DataStore fields for the columns of a CSVW tableSchema,
+        with Postgres types that fit their datatypes.
+    """
+    fields = []
+    for column in csvw_dict["tableSchema"]["columns"]:
+        datatype = column.get("datatype") or {}
+        base = datatype.get("base") if isinstance(datatype, dict) else datatype
+        fields.append({"id": column["name"], "type": PG_TYPES.get(base, "text")})
+    return fields
+
+
+def get_write_engine():
+    try:
+        #CKAN 2.7 and later
+        from ckanext.datastore.backend.postgres import get_write_engine as datastore_write_engine
+    except ImportError:
+        from ckanext.datastore.db import _get_engine
+        return _get_engine({"connection_url": tk.config["ckan.datastore.write_url"]})
+    return datastore_write_engine()
+
+
+def quote_identifier(name):
+    return u'"{}"'.format(name.replace(u'"', u'""'))
+
+
+def replace_rows(table, fields, rows, chunk_rows=None, progress=None):
+    """
+        Replaces the rows of the DataStore table with the rows given (lists of
+        unicode values, without the header), and its data columns with the fields.
+        The table itself is kept, with the column comments of the DataStore data
+        dictionary, its triggers and its indexes: columns whose type changed are
+        altered, and only if the column names changed, the data columns are made
+        again, with comments of the columns that are left. Rows are loaded with
+        Postgres COPY, chunk_rows rows at a time, so that only one chunk is in memory.
+        COPY fires the table's row triggers, like datastore_upsert does.
+        Short rows are padded with empty values, which are loaded as NULL,
+        and long rows are cut to the fields.
+        Everything happens in a single transaction: if a chunk fails, for example
+        on a value that doesn't fit its column's type, the old rows stay as they were.
+        progress(rows loaded so far) is called after each chunk.
+        Returns the number of rows loaded.
+    """
+    chunk_rows = chunk_rows or load_chunk_rows
+    started = time.time()
+    connection = get_write_engine().raw_connection()
+    try:
+        cursor = connection.cursor()
+        #CSVW dates are ISO 8601; with the default "ISO, MDY" style Postgres would take
+        #a Latvian 01.02.2020 for the 2nd of January instead of rejecting it
+        cursor.execute(u"SET LOCAL DateStyle = 'ISO, YMD'")
+        #Rows that are deleted stay readable to others until the commit
+        cursor.execute(u"DELETE FROM {}".format(quote_identifier(table)))
+        alter_columns(cursor, table, fields)
+        loaded = copy_chunks(cursor, table, fields, rows, chunk_rows, progress)
+        update_full_text(cursor, table, fields)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    log.info("Loaded {} rows into DataStore table {} in {:.1f}s".format(loaded, table, time.time() - started))
+    return loaded
+
+
+def alter_columns(cursor, table, fields):
+    """
+        Changes data columns of the table (all but _id and _full_text) to the fields, see replace_rows.
+        The table has to be empty.
+    """
+    cursor.execute(u"SELECT attname, atttypid, col_description(attrelid, attnum) FROM pg_attribute "
+                   u"WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped "
+                   u"AND attname NOT IN ('_id', '_full_text') ORDER BY attnum", (quote_identifier(table),))
+    columns = cursor.fetchall()
+    type_ids = {}
+    for pg_type in set(field["type"] for field in fields):
+        cursor.execute(u"SELECT %s::regtype::oid", (pg_type,))
+        type_ids[pg_type] = cursor.fetchone()[0]
+    quoted_table = quote_identifier(table)
+
+    if [name for name, type_id, comment in columns] == [field["id"] for field in fields]:
+        #Indexes the DataStore made on these columns are kept too
+        for (name, type_id, comment), field in zip(columns, fields):
+            if type_id != type_ids[field["type"]]:
+                cursor.execute(u"ALTER TABLE {} ALTER COLUMN {} TYPE {} USING NULL".format(
+                    quoted_table, quote_identifier(name), field["type"]))
+        return
+
+    comments = dict((name, comment) for name, type_id, comment in columns)
+    for name, type_id, comment in columns:
+        cursor.execute(u"ALTER TABLE {} DROP COLUMN {}".format(quoted_table, quote_identifier(name)))
+    for field in fields:
+        cursor.execute(u"ALTER TABLE {} ADD COLUMN {} {}".format(
+            quoted_table, quote_identifier(field["id"]), field["type"]))
+        if comments.get(field["id"]) is not None:
+            #Names go into a query with parameters, where % has to be doubled
+            cursor.execute(u"COMMENT ON COLUMN {}.{} IS %s".format(
+                quoted_table.replace(u"%", u"%%"), quote_identifier(field["id"]).replace(u"%", u"%%")),
+                (comments[field["id"]],))
+
+
+def copy_chunks(cursor, table, fields, rows, chunk_rows, progress=None):
+    """
+        Sends rows to the table with COPY, chunk_rows at a time, see replace_rows.
+    """
+    column_count = len(fields)
+    columns = u", ".join(quote_identifier(field["id"]) for field in fields)
+    options = u"FORMAT csv"
+    typed = [quote_identifier(field["id"]) for field in fields if field["type"] != "text"]
+    if typed:
+        #Empty values are written unquoted and COPY loads them as NULL, except that
+        #a row with a single empty value has to be quoted - it would be an empty line otherwise
+        options += u", FORCE_NULL ({})".format(u", ".join(typed))
+    sql = u"COPY {} ({}) FROM STDIN WITH ({})".format(quote_identifier(table), columns, options)
+
+    loaded = 0
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_rows))
+        if not chunk:
+            break
+        buffer = StringIO()
+        writer = csv.writer(buffer, encoding="utf-8")
+        for row in chunk:
+            if len(row) != column_count:
+                row = (row + [u""] * column_count)[:column_count]
+            writer.writerow(row)
+        buffer.seek(0)
+        cursor.copy_expert(sql, buffer)
+        loaded += len(chunk)
+        if progress is not None:
+            progress(loaded)
+    return loaded
+
+
+def update_full_text(cursor, table, fields):
+    """
+        The DataStore fills the full text search column of the rows it inserts itself,
+        for rows loaded with COPY it's filled here, like XLoader does it.
+    """
+    cursor.execute(u"SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = '_full_text'",
+                   (table,))
+    if cursor.fetchone() is None:
+        return
+    #ARRAY instead of concat_ws, which can't take more than 100 arguments
+    #Column names go into a query with parameters, where % has to be doubled
+    values = u", ".join(u"{}::text".format(quote_identifier(field["id"]).replace(u"%", u"%%")) for field in fields)
+    cursor.execute(u"UPDATE {} SET _full_text = to_tsvector(%s, array_to_string(ARRAY[{}], ' '))".format(
+        quote_identifier(table), values), (tk.config.get("ckan.datastore.default_fts_lang", "english"),))
@@ -0,0 +1,164 @@
+# encoding: utf-8
+
+import time
+import logging
+from urlparse import urlparse
+
+import metrics
+from cache import make_cache
+
+log = logging.getLogger(__name__)
+
+#Seconds a CSV or CSVW URL isn't requested again after it has failed once,
+#doubled with every further failure, up to failure_backoff_max (0 requests failed URLs every time)
+failure_backoff = 30
+failure_backoff_max = 3600
+
+#Number of consecutive requests to a host that time out or can't connect, after which
+#the host's circuit breaker opens and no more requests are sent to it (0 never opens it)
+breaker_threshold = 3
+
+#Seconds an open breaker waits before letting a single request through to see whether the host is back
+breaker_cooldown = 60
+
+#Statuses (as returned by get_csv_sample) of requests that failed
+#"url_fail" means the host couldn't be connected to or didn't answer in time,
+#"http_error_*" that it answered with an error
+HOST_FAILURE = "url_fail"
+
+#A global that stores failed URLs and when they may be requested again, keyed by URL
+failure_cache = make_cache()
+
+#A global that stores circuit breakers, keyed by host
+breaker_cache = make_cache()
+
+
+def configure(config):
+    global failure_backoff, failure_backoff_max, breaker_threshold, breaker_cooldown
+    global failure_cache, breaker_cache
+    failure_backoff = float(config.get('csvmetadata.failure_backoff', failure_backoff))
+    failure_backoff_max = float(config.get('csvmetadata.failure_backoff_max', failure_backoff_max))
+    breaker_threshold = int(config.get('csvmetadata.breaker_threshold', breaker_threshold))
+    breaker_cooldown = float(config.get('csvmetadata.breaker_cooldown', breaker_cooldown))
+    #Like the sniffing results, kept in the shared database if there is one, so that
+    #every worker process knows a host is down once one of them has found out
+    failure_cache = make_cache(max_size=int(config.get('csvmetadata.sniff_cache_size', 512)),
+                               path=config.get('csvmetadata.sniff_cache_path'),
+                               table="failures")
+    breaker_cache = make_cache(max_size=int(config.get('csvmetadata.sniff_cache_size', 512)),
+                               path=config.get('csvmetadata.sniff_cache_path'),
+                               table="breakers")
+
+
+def host_of(url):
+    return urlparse(url).netloc.lower()
+
+
+def is_failure(status):
+    return status == HOST_FAILURE or status.startswith("http_error_")
+
+
+def blocked(url, now=None):
+    """
+        Why requests to the URL are held back, or None if they aren't: a dictionary
+        with the reason ("breaker" if its host's breaker is open, "backoff" if the URL
+        itself has failed recently), the status of the last failure, the number of
+        failures, the host and the time the next request will be let through.
+    """
+    now = now or time.time()
+    host = host_of(url)
+    breaker = breaker_cache.get(host) if host else None
+    if breaker is not None and breaker["state"] != "closed" and now < breaker["retry_at"]:
+        return {"reason": "breaker", "status": HOST_FAILURE, "failures": breaker["failures"],
+                "host": host, "retry_at": breaker["retry_at"]}
+    failure = failure_cache.get(url)
+    if failure is not None and now < failure["retry_at"]:
+        return {"reason": "backoff", "status": failure["status"], "failures": failure["failures"],
+                "host": host, "retry_at": failure["retry_at"]}
+    return None
+
+
+def allow(url):
+    """
+        Returns None if a request to the URL may be sent, otherwise what blocked returns.
+        Once an open breaker has cooled down, the first request to its host
+        is let through as a trial and the others are held back for another
+        cooldown, until the trial either succeeds and closes the breaker, or
+        fails and opens it again.
+    """
+    now = time.time()
+    reason = blocked(url, now)
+    if reason is not None:
+        metrics.increment("csvmetadata_short_circuit_total", reason=reason["reason"])
+        return reason
+    host = host_of(url)
+    breaker = breaker_cache.get(host) if host else None
+    if breaker is not None and breaker["state"] != "closed":
+        breaker_cache.set(host, {"state": "half_open", "failures": breaker["failures"],
+                                 "retry_at": now + breaker_cooldown})
+        log.info("Trying host {} again after its circuit breaker opened".format(host))
+    return None
+
+
+def record(url, status):
+    """
+        Records how a request to the URL went. Failed URLs are held back
+        with exponential backoff, and consecutive connection failures and timeouts
+        of a host open its breaker. Any answer from the host closes it.
+    """
+    now = time.time()
+    host = host_of(url)
+    if not is_failure(status):
+        if failure_cache.get(url) is not None:
+            failure_cache.delete(url)
+        close_breaker(host)
+        return
+
+    if failure_backoff > 0:
+        failure = failure_cache.get(url)
+        failures = failure["failures"] + 1 if failure is not None else 1
+        delay = min(failure_backoff * 2 ** (failures - 1), failure_backoff_max)
+        failure_cache.set(url, {"status": status, "failures": failures, "retry_at": now + delay})
+        log.info("Request to {} failed with {} ({} times), not trying again for {:.0f}s".format(
+            url, status, failures, delay))
+
+    if status != HOST_FAILURE:
+        #An error page is still an answer, the host is up
+        close_breaker(host)
+    elif host and breaker_threshold > 0:
+        breaker = breaker_cache.get(host) or {"state": "closed", "failures": 0, "retry_at": 0}
+        failures = breaker["failures"] + 1
+        if breaker["state"] != "closed" or failures >= breaker_threshold:
+            if breaker["state"] == "closed":
+                log.warning("Circuit breaker of host {} opened after {} failed requests".format(host, failures))
+                metrics.increment("csvmetadata_breaker_opened_total")
+            breaker_cache.set(host, {"state": "open", "failures": failures, "retry_at": now + breaker_cooldown})
+        else:
+            breaker_cache.set(host, {"state": "closed", "failures": failures, "retry_at": 0})
+
+
+def close_breaker(host):
+    breaker = breaker_cache.get(host) if host else None
+    if breaker is not None:
+        if breaker["state"] != "closed":
+            log.info("Circuit breaker of host {} closed".format(host))
+        breaker_cache.delete(host)
+
+
+def reset(url):
+    """
+        Forgets the URL's failures and closes its host's breaker, so that
+        the next request to it is sent right away.
+    """
+    failure_cache.delete(url)
+    close_breaker(host_of(url))
+
+
+class Unavailable(Exception):
+    """
+        Raised instead of requesting a URL that is held back (see blocked).
+    """
+    def __init__(self, url, reason):
+        super(Unavailable, self).__init__("Not requesting {} until {:.0f} ({}, last status {})".format(
+            url, reason["retry_at"], reason["reason"], reason["status"]))
+        self.reason = reason
@@ -0,0 +1,69 @@
+"use strict";
+
+// Loads form fields of the columns that weren't rendered with the page,
+// a chunk at a time, when the user scrolls to the end of the form or asks for more
+ckan.module('csvmetadata-columns', function ($) {
+  return {
+    options: {
+      url: null,
+      start: 0,
+      total: 0,
+      count: 50
+    },
+
+    initialize: function () {
+      $.proxyAll(this, /_on/);
+      this.next = parseInt(this.options.start, 10);
+      this.total = parseInt(this.options.total, 10);
+      this.loading = false;
+      this.el.find('[data-columns-more]').on('click', this._onMore);
+      $(window).on('scroll', this._onScroll);
+      this._onScroll();
+    },
+
+    _onMore: function () {
+      this.load();
+    },
+
+    _onScroll: function () {
+      // Starting to load the next chunk a screen before the user gets to the end
+      if (this.el.offset().top - $(window).scrollTop() < 2 * $(window).height()) {
+        this.load();
+      }
+    },
+
+    load: function () {
+      if (this.loading || this.next >= this.total) {
+        return;
+      }
+      this.loading = true;
+      $.getJSON(this.options.url, {start: this.next, count: this.options.count})
+        .done(this._onChunk)
+        .fail(function () { this.loading = false; }.bind(this));
+    },
+
+    _onChunk: function (chunk) {
+      var columns = $(chunk.html);
+      this.loading = false;
+      this.el.before(columns);
+      columns.find('[data-module]').each(function (i, element) {
+        ckan.module.initializeElement(element);
+      });
+      columns.find('[data-toggle="tooltip"]').tooltip();
+      columns.find('[data-foreignkey-id]').each(foreignkey_hide);
+      if ($('#csv_has_headers').prop('checked') == false) {
+        columns.find('[data-is-name="true"]').each(function (i, element) {
+          $(element).val($(element).attr('data-default-value'));
+        });
+      }
+      this.next = chunk.end;
+      this.el.find('[data-columns-shown]').text(this.next);
+      if (this.next >= this.total) {
+        $(window).off('scroll', this._onScroll);
+        this.el.find('[data-columns-more]').remove();
+      } else {
+        this._onScroll();
+      }
+    }
+  };
+});
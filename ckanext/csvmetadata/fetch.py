@@ -0,0 +1,275 @@
+# encoding: utf-8
+
+import os
+import time
+import socket
+import logging
+import threading
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    from urllib3.util.retry import Retry
+    from urllib3.exceptions import ReadTimeoutError, ProtocolError
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
+    from requests.packages.urllib3.exceptions import ReadTimeoutError, ProtocolError
+
+import ckan.plugins.toolkit as tk
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+#Timeouts for downloading CSV samples and CSVW files, in seconds
+csv_timeout = 10
+json_timeout = 3
+
+#Outbound HTTP connection pool settings
+#Connections are kept alive and reused per host, up to http_pool_maxsize connections to each host
+#With http_pool_block, requests wait for a free connection instead of opening extra ones, with no
+#time limit - a single response that is never closed then holds up every later request to its host
+http_pool_connections = 10
+http_pool_maxsize = 10
+http_pool_block = False
+http_retries = 2
+http_backoff_factor = 0.3
+
+#Errors that mean a host couldn't be connected to or stopped answering,
+#also while a streamed response body is being read
+HOST_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+               ReadTimeoutError, ProtocolError, socket.error)
+
+#Number of threads used for concurrent fetches in each process
+fetch_pool_size = 4
+
+#Number of threads bulk generation prepares resources with, in each process
+#Kept apart from the fetch pool so that a bulk run can't starve the page fetches of web requests
+bulk_pool_size = 2
+
+#A global that stores the thread pools by name ("fetch" or "bulk"), created on first use
+#Threads don't survive forking, so each pool is tied to the process that created it
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+#A global that stores the HTTP session, created on first use
+#Like the thread pool, it's not shared with forked processes
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+#Deadline of the run_concurrently call the current thread works for, if any, see http_get,
+#and the name of the pool the current thread belongs to, if any, see run_concurrently
+_local = threading.local()
+
+
+def configure(config):
+    global fetch_pool_size, bulk_pool_size, csv_timeout, json_timeout
+    global http_pool_connections, http_pool_maxsize, http_pool_block, http_retries, http_backoff_factor
+    fetch_pool_size = max(int(config.get('csvmetadata.fetch_threads', fetch_pool_size)), 1)
+    bulk_pool_size = max(int(config.get('csvmetadata.bulk_threads', bulk_pool_size)), 1)
+    csv_timeout = float(config.get('csvmetadata.csv_timeout', csv_timeout))
+    json_timeout = float(config.get('csvmetadata.json_timeout', json_timeout))
+    http_pool_connections = int(config.get('csvmetadata.http_pool_connections', http_pool_connections))
+    http_pool_maxsize = int(config.get('csvmetadata.http_pool_maxsize', http_pool_maxsize))
+    http_pool_block = tk.asbool(config.get('csvmetadata.http_pool_block', http_pool_block))
+    http_retries = int(config.get('csvmetadata.http_retries', http_retries))
+    http_backoff_factor = float(config.get('csvmetadata.http_backoff_factor', http_backoff_factor))
+    #Settings might have changed, next request will get a session built with the new ones
+    set_session(None)
+
+
+def make_session():
+    """
+        Creates a requests session with a keep-alive connection pool for each host
+        and retries with exponential backoff for temporary server errors.
+        Failed connections aren't retried: a host that doesn't accept connections
+        would hold a pool thread for a connect timeout on every retry.
+    """
+    retry = Retry(total=http_retries, connect=0, read=0,
+                  backoff_factor=http_backoff_factor,
+                  status_forcelist=(502, 503, 504),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=http_pool_connections,
+                          pool_maxsize=http_pool_maxsize,
+                          pool_block=http_pool_block,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = make_session()
+            _session_pid = os.getpid()
+        return _session
+
+
+def set_session(session):
+    """
+        Replaces the session used for all outbound requests, for example with one
+        that has a stand-in transport adapter mounted. Passing None makes
+        the next request create a new session from the config settings.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        _session = session
+        _session_pid = os.getpid() if session is not None else None
+
+
+def mount_transport(prefix, adapter):
+    """
+        Routes requests to URLs starting with the prefix through a different
+        transport adapter, for example a local stand-in for a remote host.
+    """
+    get_session().mount(prefix, adapter)
+
+
+def http_get(url, **kwargs):
+    """
+        requests.get() replacement that goes through the shared connection pool.
+        In calls made by run_concurrently, the timeout is cut to what's left
+        until its deadline, so that calls nobody waits for anymore don't keep
+        pool threads busy for long.
+    """
+    deadline = getattr(_local, "deadline", None)
+    cut = False
+    if deadline is not None:
+        remaining = deadline.remaining()
+        if remaining <= 0:
+            raise DeadlinePassed("Deadline passed before requesting {}".format(url))
+        if kwargs.get("timeout") is None or kwargs["timeout"] > remaining:
+            kwargs["timeout"] = remaining
+            cut = True
+    try:
+        return get_session().get(url, **kwargs)
+    except requests.exceptions.RequestException:
+        #Timeouts come wrapped in ConnectionError when retries are used up, so it's the deadline that tells
+        if cut and deadline.remaining() < 0.1:
+            #The host might have answered in the usual time, we just couldn't wait for it
+            raise DeadlinePassed("Deadline passed while requesting {}".format(url))
+        raise
+
+
+class ResponseStream(object):
+    """
+        File-like read()/close() over the body of a response requested with stream=True.
+        Closing it closes the response, which returns the connection to the pool -
+        closing response.raw alone doesn't, and with http_pool_block the pool runs dry.
+    """
+    def __init__(self, response):
+        self.response = response
+        response.raw.decode_content = True
+        self.read = response.raw.read
+
+    def close(self):
+        self.response.close()
+
+
+def _mark_worker(name):
+    _local.pool = name
+
+
+def get_pool(name):
+    with _pools_lock:
+        pool, pid = _pools.get(name, (None, None))
+        if pool is None or pid != os.getpid():
+            size = bulk_pool_size if name == "bulk" else fetch_pool_size
+            pool = ThreadPool(size, initializer=_mark_worker, initargs=(name,))
+            _pools[name] = (pool, os.getpid())
+        return pool
+
+
+def get_fetch_pool():
+    return get_pool("fetch")
+
+
+class Deadline(object):
+    """
+        A point in time shared by several concurrent fetches,
+        after which we stop waiting for any of them.
+    """
+    def __init__(self, seconds):
+        self.expires = time.time() + seconds
+
+    def remaining(self):
+        return max(self.expires - time.time(), 0)
+
+
+class DeadlinePassed(Exception):
+    """
+        Raised instead of starting work that nobody waits for anymore.
+        Unlike timeouts, it says nothing about the host, see HOST_ERRORS.
+    """
+    pass
+
+
+def bind_deadline(function, deadline):
+    """
+        Wraps a function that runs in the fetch pool, so that it doesn't start
+        if the deadline has passed while it waited in the queue, and its requests
+        don't outlive the deadline (see http_get).
+    """
+    def bound(*args, **kwargs):
+        if deadline.remaining() <= 0:
+            raise DeadlinePassed("Deadline passed before {} started".format(getattr(function, "__name__", function)))
+        previous = getattr(_local, "deadline", None)
+        _local.deadline = deadline
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.deadline = previous
+    return bound
+
+
+def current_deadline():
+    """
+        Deadline the current thread works for, or None.
+    """
+    return getattr(_local, "deadline", None)
+
+
+def run_concurrently(calls, timeout, pool="fetch"):
+    """
+        Runs (function, args) tuples in the named thread pool and waits for
+        all of them, but no longer than the timeout in total (None waits for as long as it takes).
+        Returns a list with a (result, exception) tuple for each call, in the same order.
+        A call that didn't finish in time gets a TimeoutError as its exception
+        and its result is discarded. Its HTTP requests time out by the deadline,
+        and calls that haven't started by then don't start at all, so leftover
+        calls free the pool soon after the deadline (see bind_deadline).
+        No more than the pool's size of calls run at the same time, the rest wait in the pool queue.
+        Called from one of the pool's own threads, the calls run one after another in that
+        thread instead: waiting on the pool from inside it deadlocks once every thread does so.
+    """
+    deadline = Deadline(timeout) if timeout is not None else None
+    if deadline is not None:
+        calls = [(bind_deadline(function, deadline), args) for function, args in calls]
+    if getattr(_local, "pool", None) == pool:
+        return [_run_inline(function, args, deadline) for function, args in calls]
+    pool = get_pool(pool)
+    #Stages timed in the pool threads count towards the request that is waiting for them
+    pending = [pool.apply_async(metrics.bind(function), args) for function, args in calls]
+    results = []
+    for async_result in pending:
+        try:
+            results.append((async_result.get(deadline.remaining() if deadline else None), None))
+        except Exception as e:
+            results.append((None, e))
+    return results
+
+
+def _run_inline(function, args, deadline):
+    if deadline is not None and deadline.remaining() <= 0:
+        return (None, TimeoutError("Deadline passed before the call started"))
+    try:
+        return (function(*args), None)
+    except Exception as e:
+        return (None, e)
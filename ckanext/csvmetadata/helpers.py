@@ -7,29 +7,33 @@ def lang():
     from ckantoolkit import h
     return h.lang()
 
-def csvmetadata_language_text(text, prefer_lang=None):
+def current_lang():
+    """
+    User's language, or None when there's no user language available
+    """
+    try:
+        return lang()
+    except TypeError:
+        return None  # lang() call will fail when no user language available
+
+def language_text(text, prefer_lang, default_locale):
     """
     :param text: {lang: text} dict or text string
     :param prefer_lang: choose this language version if available
-    Convert "language-text" to users' language by looking up
-    languag in dict or using gettext if not a dict
+    :param default_locale: language version to fall back on
+    csvmetadata_language_text that is given the languages instead
+    of looking them up
     """
     if not text:
         return u''
 
     if hasattr(text, 'get'):
-        try:
-            if prefer_lang is None:
-                prefer_lang = lang()
-        except TypeError:
-            pass  # lang() call will fail when no user language available
-        else:
+        if prefer_lang is not None:
             try:
                 return text[prefer_lang]
             except KeyError:
                 pass
 
-        default_locale = config.get('ckan.locale_default', 'en')
         try:
             return text[default_locale]
         except KeyError:
@@ -42,3 +46,27 @@ def csvmetadata_language_text(text, prefer_lang=None):
     if isinstance(t, str):
         return t.decode('utf-8')
     return t
+
+def csvmetadata_language_text(text, prefer_lang=None):
+    """
+    :param text: {lang: text} dict or text string
+    :param prefer_lang: choose this language version if available
+    Convert "language-text" to users' language by looking up
+    languag in dict or using gettext if not a dict
+    """
+    if prefer_lang is None and hasattr(text, 'get'):
+        prefer_lang = current_lang()
+    return language_text(text, prefer_lang, config.get('ckan.locale_default', 'en'))
+
+def csvmetadata_form_fields(form_schema, prefer_lang=None):
+    """
+    Form fields of the form schema with labels, help texts and choices
+    in users' language. They are resolved once per language and cached
+    in the schema, so templates don't have to look them up for every column.
+    """
+    if prefer_lang is None:
+        prefer_lang = current_lang()
+    default_locale = config.get('ckan.locale_default', 'en')
+    return form_schema.localized_fields(
+        (prefer_lang, default_locale),
+        lambda text: language_text(text, prefer_lang, default_locale))
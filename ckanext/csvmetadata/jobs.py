@@ -0,0 +1,123 @@
+# encoding: utf-8
+
+import os
+import time
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+
+from cache import make_cache
+
+log = logging.getLogger(__name__)
+
+#Where slow work like saving CSVW files runs:
+#"off" - in the request itself, "local" - in a thread pool of the web server process,
+#"ckan" - in CKAN background job queue (CKAN 2.7+, needs a running `paster jobs worker`)
+async_mode = "off"
+
+#Number of threads per process for the "local" mode
+job_pool_size = 2
+
+#A global that stores job status, keyed by job key (CSV resource ID for CSVW saving)
+#It has to be stored in SQLite for web server processes to see status of jobs ran by CKAN job workers
+job_status = make_cache()
+
+#Finished jobs are reported on the page for this many seconds
+job_status_ttl = 600
+
+_job_pool = None
+_job_pool_pid = None
+_job_pool_lock = threading.Lock()
+
+
+def configure(config):
+    global async_mode, job_pool_size, job_status
+    async_mode = config.get('csvmetadata.async_mode', async_mode)
+    if async_mode not in ("off", "local", "ckan"):
+        raise Exception('Config option `csvmetadata.async_mode` must be one of "off", "local" or "ckan"')
+    if async_mode == "ckan" and not hasattr(tk, "enqueue_job"):
+        log.warning("CKAN background jobs aren't available in this CKAN version, using local thread pool instead")
+        async_mode = "local"
+    cache_path = config.get('csvmetadata.sniff_cache_path')
+    if async_mode == "ckan" and not cache_path:
+        log.warning("Set `csvmetadata.sniff_cache_path` to see status of CKAN background jobs on the CSV metadata page")
+    job_pool_size = max(int(config.get('csvmetadata.job_threads', job_pool_size)), 1)
+    job_status = make_cache(max_size=int(config.get('csvmetadata.sniff_cache_size', 512)),
+                            path=cache_path, table="jobs")
+
+
+def get_job_pool():
+    global _job_pool, _job_pool_pid
+    with _job_pool_lock:
+        if _job_pool is None or _job_pool_pid != os.getpid():
+            _job_pool = ThreadPool(job_pool_size)
+            _job_pool_pid = os.getpid()
+        return _job_pool
+
+
+def set_status(job_key, status, error=None):
+    #A new job starts without progress, a running one keeps its progress when it finishes
+    previous = job_status.get(job_key) if status != "pending" else None
+    new_status = {"status": status, "error": error, "updated": time.time()}
+    if previous is not None and "progress" in previous:
+        new_status["progress"] = previous["progress"]
+    job_status.set(job_key, new_status)
+
+
+def set_progress(job_key, progress):
+    """
+        Adds progress of a running job (a dictionary) to its status.
+    """
+    status = job_status.get(job_key) or {"status": "running", "error": None}
+    job_status.set(job_key, dict(status, progress=progress, updated=time.time()))
+
+
+def get_status(job_key):
+    """
+        Returns status dict of the last job with the given key, with "status" being one of
+        "pending", "running", "done" or "failed". Returns None if there's no such job,
+        or it has finished long enough ago.
+    """
+    status = job_status.get(job_key)
+    if status is None:
+        return None
+    if status["status"] in ("done", "failed") and time.time() - status["updated"] > job_status_ttl:
+        return None
+    return status
+
+
+def run_job(function, args, job_key, in_thread=False):
+    """
+        Runs the function, keeping track of its status. This is what actually
+        gets queued, so it has to stay a module-level function.
+    """
+    set_status(job_key, "running")
+    try:
+        function(*args)
+    except Exception as e:
+        log.exception("Background job {} failed".format(job_key))
+        set_status(job_key, "failed", repr(e))
+    else:
+        set_status(job_key, "done")
+    finally:
+        if in_thread:
+            #Each thread gets its own database session, it has to be cleaned up here
+            model.Session.remove()
+
+
+def enqueue(function, args, job_key, title=None):
+    """
+        Runs function(*args) in the background according to async_mode.
+        Function and arguments have to be picklable for the "ckan" mode.
+        In "off" mode, the function runs right away and exceptions are raised to the caller.
+    """
+    if async_mode == "off":
+        return function(*args)
+    set_status(job_key, "pending")
+    if async_mode == "ckan":
+        tk.enqueue_job(run_job, [function, args, job_key], title=title)
+    else:
+        get_job_pool().apply_async(run_job, (function, args, job_key, True))
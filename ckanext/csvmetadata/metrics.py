@@ -0,0 +1,242 @@
+# encoding: utf-8
+
+import time
+import socket
+import logging
+import threading
+from bisect import bisect_left
+
+log = logging.getLogger(__name__)
+
+#Whether stage timings are collected at all
+metrics_enabled = True
+
+#Whether /csvmetadata/metrics serves the collected metrics in Prometheus text format
+#Metrics are kept per process, so with several web server processes each scrape sees one of them
+metrics_endpoint = False
+
+#"host:port" of a StatsD server that every timing and counter is also sent to, None to not send them
+statsd_address = None
+statsd_prefix = "csvmetadata"
+
+#Whether the CSV metadata page reports its stage timings in a Server-Timing response header,
+#which browser developer tools show in the network panel
+server_timing = False
+
+#Histogram bucket upper bounds for stage durations, in seconds, and for bytes read
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+#Metric descriptions, keyed by name, in the order they are exported
+METRICS = (
+    ("csvmetadata_stage_seconds", "histogram", "Duration of CSV metadata page stages", TIME_BUCKETS),
+    ("csvmetadata_stage_bytes", "histogram", "Bytes read from CSV and CSVW files by a stage", BYTE_BUCKETS),
+    ("csvmetadata_stage_total", "counter", "Number of times a stage ran, by outcome", None),
+    ("csvmetadata_short_circuit_total", "counter",
+     "Requests to failed URLs and hosts that weren't sent, by reason (backoff or breaker)", None),
+    ("csvmetadata_breaker_opened_total", "counter", "Number of times a host's circuit breaker opened", None),
+)
+
+_buckets = dict((name, buckets) for name, metric_type, description, buckets in METRICS)
+_values = {}
+_lock = threading.Lock()
+
+#Timings of the request the current thread works for, see begin_request
+_local = threading.local()
+
+_statsd_socket = None
+_statsd_target = None
+
+
+def configure(config):
+    global metrics_enabled, metrics_endpoint, statsd_address, statsd_prefix, server_timing
+    global _statsd_socket, _statsd_target
+    metrics_enabled = _asbool(config.get('csvmetadata.metrics', metrics_enabled))
+    metrics_endpoint = _asbool(config.get('csvmetadata.metrics_endpoint', metrics_endpoint))
+    server_timing = _asbool(config.get('csvmetadata.server_timing', server_timing))
+    statsd_address = config.get('csvmetadata.statsd_address', statsd_address)
+    statsd_prefix = config.get('csvmetadata.statsd_prefix', statsd_prefix)
+    _statsd_socket = _statsd_target = None
+    if statsd_address:
+        host, port = statsd_address.rsplit(":", 1)
+        _statsd_target = (host, int(port))
+        _statsd_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+
+def _asbool(value):
+    #This module is also used outside CKAN, by the benchmarks
+    return str(value).lower() in ("true", "1", "yes", "on")
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def observe(name, value, **labels):
+    """
+        Adds a value to a histogram.
+    """
+    buckets = _buckets[name]
+    key = (name, _label_key(labels))
+    with _lock:
+        entry = _values.get(key)
+        if entry is None:
+            entry = _values[key] = {"buckets": [0] * len(buckets), "sum": 0, "count": 0}
+        i = bisect_left(buckets, value)
+        if i < len(buckets):
+            entry["buckets"][i] += 1
+        entry["sum"] += value
+        entry["count"] += 1
+
+
+def increment(name, amount=1, **labels):
+    key = (name, _label_key(labels))
+    with _lock:
+        _values[key] = _values.get(key, 0) + amount
+
+
+def _statsd_send(line):
+    try:
+        _statsd_socket.sendto(line.encode("utf-8"), _statsd_target)
+    except (socket.error, UnicodeError):
+        #Metrics must never break the page
+        pass
+
+
+class Stage(object):
+    """
+        Times a stage of request processing:
+
+            with metrics.stage("csv_sample") as timer:
+                ...
+                timer.outcome = status
+                timer.bytes = len(content)
+
+        The duration goes to the stage histogram, labelled with the outcome
+        ("ok" unless the stage sets another one, "error" if it raises),
+        bytes (if set) to the bytes histogram, and both to StatsD and
+        to the timings of the current request, if there is one.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.outcome = "ok"
+        self.bytes = None
+        self.started = None
+        self.seconds = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.time() - self.started
+        if exc_type is not None and self.outcome == "ok":
+            self.outcome = "error"
+        if not metrics_enabled:
+            return False
+        observe("csvmetadata_stage_seconds", self.seconds, stage=self.name, outcome=self.outcome)
+        increment("csvmetadata_stage_total", stage=self.name, outcome=self.outcome)
+        if self.bytes is not None:
+            observe("csvmetadata_stage_bytes", self.bytes, stage=self.name)
+        if _statsd_socket is not None:
+            _statsd_send("{}.{}.{}:{:.3f}|ms".format(statsd_prefix, self.name, self.outcome, self.seconds * 1000))
+            if self.bytes is not None:
+                _statsd_send("{}.{}.bytes:{}|c".format(statsd_prefix, self.name, self.bytes))
+        timings = getattr(_local, "timings", None)
+        if timings is not None:
+            timings.append(self)
+        return False
+
+
+def stage(name):
+    return Stage(name)
+
+
+def begin_request():
+    """
+        Starts collecting timings of stages the current thread runs
+        for a request, see bind and server_timing_header.
+    """
+    _local.timings = []
+
+
+def end_request():
+    timings = getattr(_local, "timings", None)
+    _local.timings = None
+    return timings or []
+
+
+def bind(function):
+    """
+        Wraps a function that runs in another thread, like the fetch thread pool,
+        so that stages it runs are counted towards the current request.
+    """
+    timings = getattr(_local, "timings", None)
+    if timings is None:
+        return function
+
+    def bound(*args, **kwargs):
+        previous = getattr(_local, "timings", None)
+        _local.timings = timings
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.timings = previous
+    return bound
+
+
+def server_timing_header(timings):
+    """
+        Server-Timing header value for a request's stage timings.
+    """
+    return ", ".join('{};dur={:.1f};desc="{}"'.format(timer.name, timer.seconds * 1000, timer.outcome)
+                     for timer in timings)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for name, value in labels) + "}"
+
+
+def render_prometheus(caches=None):
+    """
+        Returns the metrics of this process in Prometheus text exposition format.
+        caches maps cache names to LRUCache-like objects whose hit, miss and
+        eviction counters are exported too.
+    """
+    with _lock:
+        values = sorted(_values.items())
+    lines = []
+    for name, metric_type, description, buckets in METRICS:
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+        for (value_name, labels), value in values:
+            if value_name != name:
+                continue
+            if metric_type == "counter":
+                lines.append("{}{} {}".format(name, _format_labels(labels), value))
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, value["buckets"]):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(name, _format_labels(labels + (("le", repr(float(bound))),)),
+                                                     cumulative))
+            lines.append("{}_bucket{} {}".format(name, _format_labels(labels + (("le", "+Inf"),)), value["count"]))
+            lines.append("{}_sum{} {}".format(name, _format_labels(labels), repr(float(value["sum"]))))
+            lines.append("{}_count{} {}".format(name, _format_labels(labels), value["count"]))
+
+    if caches:
+        lines.append("# HELP csvmetadata_cache_events_total Cache hits, misses and evictions in this process")
+        lines.append("# TYPE csvmetadata_cache_events_total counter")
+        for cache_name, cache in sorted(caches.items()):
+            for event, count in sorted(cache.counters.items()):
+                lines.append("csvmetadata_cache_events_total{} {}".format(
+                    _format_labels((("cache", cache_name), ("event", event))), count))
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        _values.clear()
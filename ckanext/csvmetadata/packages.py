@@ -0,0 +1,108 @@
+# encoding: utf-8
+
+import time
+import logging
+
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+
+from cache import LRUCache
+
+log = logging.getLogger(__name__)
+
+#Number of package dicts kept in each process, 0 turns the cache off
+package_cache_size = 64
+
+#Cached package dicts are shown for no longer than this many seconds,
+#as changes outside the package itself (like organization title) don't reach the hooks
+package_cache_ttl = 300
+
+#A global that stores package_show results, keyed by package ID
+#Package dicts of large packages are big and slow to serialize, so it's always in-process
+package_cache = LRUCache(package_cache_size)
+
+
+def configure(config):
+    global package_cache_size, package_cache_ttl, package_cache
+    package_cache_size = int(config.get('csvmetadata.package_cache_size', package_cache_size))
+    package_cache_ttl = float(config.get('csvmetadata.package_cache_ttl', package_cache_ttl))
+    package_cache = LRUCache(package_cache_size)
+
+
+class ResourceIndex(object):
+    """
+        Package's resources by ID and by URL, and its JSON resources by URL and
+        by filename, so that finding the CSVW file for a CSV resource doesn't go
+        through the whole resource list. Where several resources have the same
+        URL or filename, the first one in the package wins, like before.
+    """
+    def __init__(self, pkg_dict, filename_from_url):
+        self.pkg_dict = pkg_dict
+        self.by_id = {}
+        self.by_url = {}
+        self.json_by_url = {}
+        self.json_by_filename = {}
+        for resource in pkg_dict["resources"]:
+            self.by_id[resource["id"]] = resource
+            self.by_url.setdefault(resource["url"], resource)
+            if resource.get("format") == "JSON":
+                self.json_by_url.setdefault(resource["url"], resource)
+                self.json_by_filename.setdefault(filename_from_url(resource["url"]), resource)
+
+
+def show_package(context, package_id):
+    """
+        package_show that keeps results between requests. A cached package dict
+        is used as long as the package's metadata_modified is the same, the hooks
+        haven't reported a change (see forget) and it isn't older than package_cache_ttl.
+        The dict is shared, callers shouldn't modify it.
+    """
+    package = model.Package.get(package_id) if package_cache_size > 0 else None
+    if package is None:
+        #Not caching, or there's no such package and package_show will say so
+        return tk.get_action('package_show')(dict(context), {'id': package_id})
+
+    stamp = package.metadata_modified.isoformat() if package.metadata_modified else None
+    entry = package_cache.get(package.id)
+    if entry is not None and entry["stamp"] == stamp and time.time() - entry["cached"] < package_cache_ttl:
+        #The dict was cached for whoever asked first, this user still has to be allowed to see it
+        tk.check_access('package_show', dict(context), {'id': package.id})
+        package_cache.count("hits")
+        return entry["pkg_dict"]
+
+    package_cache.count("misses")
+    pkg_dict = tk.get_action('package_show')(dict(context), {'id': package.id})
+    package_cache.set(package.id, {"stamp": stamp, "cached": time.time(), "pkg_dict": pkg_dict, "index": None})
+    return pkg_dict
+
+
+def resource_index(pkg_dict, filename_from_url):
+    """
+        Returns a ResourceIndex for the package dict. The index of a cached
+        package dict is kept with it, so it's only built once per package version.
+    """
+    entry = package_cache.get(pkg_dict["id"])
+    if entry is not None and entry["pkg_dict"] is pkg_dict:
+        if entry["index"] is None:
+            entry["index"] = ResourceIndex(pkg_dict, filename_from_url)
+        return entry["index"]
+    return ResourceIndex(pkg_dict, filename_from_url)
+
+
+def forget(data):
+    """
+        Drops cached package dicts affected by a package or resource change.
+        Takes whatever CKAN passes to its after_create/after_update/after_delete
+        hooks - a package dict, a resource dict, or a list of a package's
+        remaining resources after one of them was deleted.
+    """
+    if isinstance(data, dict):
+        data = [data]
+    package_ids = set(item.get("package_id") or item.get("id") for item in data or [])
+    package_ids.discard(None)
+    for package_id in package_ids:
+        package_cache.delete(package_id)
+        #Packages are cached by ID, but package_delete passes on whatever it was called with
+        package = model.Package.get(package_id)
+        if package is not None and package.id != package_id:
+            package_cache.delete(package.id)
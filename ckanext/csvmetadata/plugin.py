@@ -2,13 +2,32 @@
 
 import os
 import json
+import time
+import hashlib
 import logging
-import requests
+import threading
 import unicodecsv as csv
 from StringIO import StringIO
 from collections import OrderedDict
 from ast import literal_eval as lit_eval
-from helpers import csvmetadata_language_text
+from helpers import csvmetadata_language_text, csvmetadata_form_fields
+from schema import load_form_schema, file_stamp, DATATYPE_BOUNDS
+from cache import make_cache
+from storage import local_upload_path
+import fetch
+import jobs
+import actions
+import packages
+import validation
+import refindex
+import ranges
+import datastore
+import catalog
+import failures
+import metrics
+from sniffing import read_csv_head, record_ends, records_end
+from csv_unicode import detect_encoding, ascii_compatible, transcode
+from profiler import profile_csv, profile_rows
 
 from ckanapi import LocalCKAN
 ckan_api = LocalCKAN()
@@ -38,50 +57,108 @@ ckan_root_path = None
 ckan_api_key = None
 
 #A limit of CSV file size to be processed in order to get headers
+#Only if that's not enough to get the header and csv_sample_rows data rows,
+#more is read in growing chunks, up to csv_sample_byte_limit
 csv_header_byte_limit = 4096
+csv_sample_byte_limit = 1048576
+csv_sample_rows = 3
+
+#Total time limit for fetching everything needed to render the CSV metadata page, in seconds
+page_fetch_deadline = 10
+
+#A global that stores CSV sniffing results, keyed by CSV URL
+#Replaced in CSVMetadataPlugin.configure according to config options
+sniff_cache = make_cache()
+
+#A global that stores column datatype/length/required suggestions for CSVs without CSVW, keyed by CSV URL
+suggestion_cache = make_cache()
+
+#Number of columns rendered with the CSV metadata page, the rest is loaded in chunks of that many columns
+form_column_window = 50
+
+#Largest column chunk the page can ask for at a time
+form_column_chunk_limit = 500
+
+#A global that stores what the CSV metadata page was last rendered from (see get_page_data), keyed by resource ID,
+#so that column chunks and partial form submissions don't have to fetch and sniff everything again
+page_cache = make_cache()
+
+#Seconds that page data is reused for
+page_cache_ttl = 600
+
+#Whether page data of new and updated CSV resources is gathered by a background job
+#right away, so that the first visit to the page doesn't wait for it (needs async_mode "local" or "ckan")
+prewarm_pages = True
+
+#Seconds that page data gathered in the background is shown for, instead of getting it again
+prewarm_ttl = 3600
+
+#Set while the extension links CSVW to a CSV resource itself, so that the hooks
+#don't pre-warm the page again because of an update the extension just made
+_own_updates = threading.local()
+
+#Limits for reading a CSV file to make column suggestions
+profile_suggestions = True
+profile_byte_budget = 1048576
+profile_time_budget = 2
+profile_reservoir_size = None
+profile_backend = "auto"
+
+#How the file is read for suggestions: "stream" reads it from the beginning, "windows" reads
+#byte windows from its head, tail and in between with range requests (see ranges.sample_rows)
+profile_sampling = "stream"
 
 #class DatastoreException(Exception):
 #    pass
 
-def check_json_file(path, file_desc="CSVMetadata table config file"):
-    if not os.path.isfile(path):
-        raise Exception(
-             '{} not found at {}'
-             .format(file_desc, path))
-    try:
-        with open(path, "r") as f:
-            json.load(f)
-    except (OSError, ValueError) as e:
-         raise Exception(
-            "Error while checking {} at {}: \n Error details: {}"
-            .format(file_desc, path, repr(e)))
-
 
 class ResourceCSVController(base.BaseController):
 
     def get_form_schema(self):
-        check_json_file(form_schema_path) #Will try to open and validate file at the path
-        with open(form_schema_path, 'r') as f:
-            schema = json.load(f)
-        return self.adjust_schema(schema)
-
-    def adjust_schema(self, schema):
-        #ensures correct schema-to-ckan_form_element_name mapping
-        preset_map = {"textbox":"input"}
-        for element in schema["form_fields"]:
-            #Adjust label?
-            if element["preset"] in preset_map:
-                element["preset"] = preset_map[element["preset"]]
-            element["name"] = element.pop("field_name")
-            if element["preset"] == "select":
-                for choice in element["choices"]:
-                    choice["name"] = choice.pop("label")
-                #Currently overriden in the template
-                element["selected"] = element["choices"][0]["value"] if element["choices"] else ""
-            element["required"] = element.pop("required") if "required" in element else False
-        return schema
-
-    def get_csv_sample(self, csv_url, url_type=None):
+        #Compiled schema is cached and only reloaded when form_schema.json changes
+        return load_form_schema(form_schema_path)
+
+    def get_resource_index(self, pkg_dict):
+        """
+            Returns a packages.ResourceIndex for the package dict,
+            only building it once per package dict.
+        """
+        index = getattr(self, "_resource_index", None)
+        if index is None or index.pkg_dict is not pkg_dict:
+            index = packages.resource_index(pkg_dict, self.filename_from_url)
+            self._resource_index = index
+        return index
+
+    def get_csv_sample(self, csv_url, url_type=None, resource=None):
+        """
+            Returns a (status, csv_headers, csv_info) tuple for the CSV file at the URL,
+            see read_csv_sample. Time it takes is counted by its status.
+        """
+        with metrics.stage("csv_sample") as timer:
+            result = self.read_csv_sample(csv_url, url_type, resource)
+            timer.outcome = result[0]
+        return result
+
+    def read_csv_sample(self, csv_url, url_type=None, resource=None):
+        #Uploaded files are read straight from the filestore instead of requesting them from ourselves
+        path = local_upload_path(resource)
+        if path is not None:
+            return self.get_local_csv_sample(csv_url, path)
+
+        #URLs and hosts that keep failing aren't requested again for a while, see failures.allow
+        reason = failures.allow(csv_url)
+        if reason is not None:
+            return reason["status"], [], {"delimiter":"", "encoding":"", "quoteChar":""}
+        try:
+            result = self.download_csv_sample(csv_url, url_type)
+        except fetch.HOST_ERRORS:
+            #Host stopped answering while the file was being read
+            failures.record(csv_url, failures.HOST_FAILURE)
+            raise
+        failures.record(csv_url, result[0])
+        return result
+
+    def download_csv_sample(self, csv_url, url_type=None):
         status = "ok"
         csv_headers = []
         csv_info = {"delimiter":"", "encoding":"", "quoteChar":""}
@@ -93,55 +170,168 @@ class ResourceCSVController(base.BaseController):
         elif url_type is not None:
             log.warning("Unknown resource URL type: {}".format(csv_url))
 
+        #If we've sniffed this URL before, asking the server to only send it again if it has changed
+        cached = sniff_cache.get(csv_url)
+        if cached is not None:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+
         try:
-            req = requests.get(csv_url, headers=headers, timeout=10, stream=True)
+            #Connecting and waiting for the response headers - where slow remote hosts show up
+            with metrics.stage("csv_connect"):
+                req = fetch.http_get(csv_url, headers=headers, timeout=fetch.csv_timeout, stream=True)
+        except fetch.DeadlinePassed:
+            #Nobody waits for the result anymore, and it says nothing about the file
+            raise
         except:
             status = "url_fail"
         else:
             req.raw.decode_content = True
-            if req.status_code == 200:
-                content = req.raw.read(csv_header_byte_limit+1)
-                if len(content) > csv_header_byte_limit:
-                    pass #Noting that the response is too large
-
-                #CSV encoding can be taken from Response object we get from requests.get
-                #which determines encoding from HTTP response headers
-                encoding = req.encoding
-
-                #Limiting the amount of CSV to be processed and storing it in unicode object
+            #Response is streamed, so it has to be closed to return the connection to the pool
+            if req.status_code != 200:
+                req.close()
+            if req.status_code == 304 and cached is not None:
+                #Resource is unchanged, so is the sniffing result
+                sniff_cache.count("hits")
+                return self.cached_sniff_result(cached)
+            elif req.status_code == 200:
                 try:
-                    if content[:3] == '\xef\xbb\xbf':
-                        content = content[3:]
-                        raise LookupError() #fall-through
-                    elif content[:2] == '\xfe\xff': 
-                        content = content[2:]
-                        raise LookupError() #fall-through
-                    sample = content[:csv_header_byte_limit]
-                except LookupError:
-                    #encoding not found among Python decoders, fallback option is UTF8
-                    #or we fell through due to UTF-16/UTF-8 marker found
-                    sample = content[:csv_header_byte_limit]
-                    encoding = "utf-8"
-
-                #Now trying to deduce, what kind of CSV is this and if it's CSV at all
-                sniffer = csv.Sniffer()
-                try:
-                    dialect = sniffer.sniff(sample)
-                except csv.Error:
-                    #Whatever we got, Python CSV module heuristics don't recognize it as CSV
-                    status = "not_csv"
-                else:
-                    #Reading one line from sample
-                    csv_headers_str = sample.splitlines()[0].strip()
-                    delimiter = str(dialect.delimiter)
-                    quotechar = str(dialect.quotechar)
-                    csv_headers = csv.reader(StringIO(csv_headers_str), delimiter=delimiter, quotechar=quotechar, encoding=encoding).next()
-                    csv_info["delimiter"] = delimiter
-                    csv_info["quoteChar"] = quotechar
-                    csv_info["encoding"] = encoding
+                    with metrics.stage("csv_read") as timer:
+                        content = self.read_csv_head(req.raw.read)
+                        timer.bytes = len(content)
+                finally:
+                    req.close()
+
+                #Server doesn't support conditional requests, but the bytes we sniff might still be the same
+                content_hash = hashlib.sha1(content).hexdigest()
+                if cached is not None and cached["content_hash"] == content_hash:
+                    sniff_cache.count("hits")
+                    validators = {"etag": req.headers.get("ETag"), "last_modified": req.headers.get("Last-Modified")}
+                    if (validators["etag"], validators["last_modified"]) != (cached["etag"], cached["last_modified"]):
+                        #New validators, so that next time the server can answer 304 again
+                        cached = dict(cached, **validators)
+                        sniff_cache.set(csv_url, cached)
+                    return self.cached_sniff_result(cached)
+
+                sniff_cache.count("misses")
+                status, csv_headers, csv_info = self.sniff_csv_sample(content, req.encoding)
+                sniff_cache.set(csv_url, {"etag": req.headers.get("ETag"),
+                                          "last_modified": req.headers.get("Last-Modified"),
+                                          "content_hash": content_hash,
+                                          "status": status,
+                                          "csv_headers": csv_headers,
+                                          "csv_info": csv_info})
+                #Cache keeps references to what we stored, handing out copies
+                return status, list(csv_headers), dict(csv_info)
             else:
                 status = "http_error_{}".format(req.status_code)
 
+        return status, csv_headers, csv_info
+
+    def get_local_csv_sample(self, csv_url, path):
+        """
+            get_csv_sample counterpart for files in the local CKAN filestore.
+            Only the header bytes are read, and not even those if the file
+            hasn't changed since it was last sniffed.
+        """
+        stamp = list(file_stamp(path))
+        cached = sniff_cache.get(csv_url)
+        if cached is not None and cached.get("file_stamp") == stamp:
+            sniff_cache.count("hits")
+            return self.cached_sniff_result(cached)
+
+        try:
+            with metrics.stage("csv_read_local") as timer, open(path, "rb") as f:
+                content = self.read_csv_head(f.read)
+                timer.bytes = len(content)
+        except IOError as e:
+            log.warning("Can't read uploaded CSV file {}: {}".format(path, repr(e)))
+            return "url_fail", [], {"delimiter":"", "encoding":"", "quoteChar":""}
+
+        sniff_cache.count("misses")
+        #There's no declared encoding for files in the filestore, it's detected from their bytes
+        status, csv_headers, csv_info = self.sniff_csv_sample(content, None)
+        sniff_cache.set(csv_url, {"etag": None,
+                                  "last_modified": None,
+                                  "file_stamp": stamp,
+                                  "content_hash": hashlib.sha1(content).hexdigest(),
+                                  "status": status,
+                                  "csv_headers": csv_headers,
+                                  "csv_info": csv_info})
+        return status, list(csv_headers), dict(csv_info)
+
+    def read_csv_head(self, read):
+        """
+            Reads enough of a CSV file to get its header and a few data rows.
+            Narrow files take a single csv_header_byte_limit sized read,
+            wide ones are read further, but no further than csv_sample_byte_limit.
+        """
+        return read_csv_head(read, csv_header_byte_limit, csv_sample_byte_limit, csv_sample_rows + 1)
+
+    def cached_sniff_result(self, cached):
+        """
+            Returns a (status, csv_headers, csv_info) tuple from a sniff cache entry.
+            Cached entries are shared, so the caller gets copies it can modify.
+        """
+        return cached["status"], list(cached["csv_headers"]), dict(cached["csv_info"])
+
+    def sniff_csv_sample(self, content, encoding):
+        """
+            Determines CSV dialect, encoding and headers from the first bytes of a file.
+            encoding is the one the server declared, if any, see detect_encoding.
+            Returns a (status, csv_headers, csv_info) tuple.
+        """
+        with metrics.stage("sniff") as timer:
+            result = self.sniff_csv_content(content, encoding)
+            timer.outcome = result[0]
+            timer.bytes = len(content)
+        return result
+
+    def sniff_csv_content(self, content, encoding):
+        status = "ok"
+        csv_headers = []
+        csv_info = {"delimiter":"", "encoding":"", "quoteChar":""}
+
+        #Encoding is detected once here and stored in CSVW, so that readers of the file don't have to guess again
+        encoding, bom_length = detect_encoding(content, encoding)
+        sample = content[bom_length:]
+        header_encoding = encoding
+        if not ascii_compatible(encoding):
+            #Sniffer and CSV module only work with ASCII compatible bytes, UTF-16 sample is read as UTF-8
+            sample = transcode(sample, encoding, final=False)
+            header_encoding = "utf-8"
+
+        #Sniffer only gets complete records - header and a few data rows, if we have them
+        #A line that's cut off at the end of the sample can throw its heuristics off
+        sniff_end = records_end(sample, csv_sample_rows + 1)
+        if sniff_end is None:
+            for sniff_end in record_ends(sample):
+                pass
+        sniff_sample = sample[:sniff_end] if sniff_end else sample
+
+        #Now trying to deduce, what kind of CSV is this and if it's CSV at all
+        sniffer = csv.Sniffer()
+        try:
+            dialect = sniffer.sniff(sniff_sample)
+            #Reading the first record from sample, it can span several lines if header values are quoted
+            delimiter = str(dialect.delimiter)
+            quotechar = str(dialect.quotechar)
+            csv_headers = next(csv.reader(StringIO(sample), delimiter=delimiter, quotechar=quotechar,
+                                          encoding=header_encoding, errors="replace"), None)
+            if not csv_headers:
+                raise csv.Error("No header record")
+        except csv.Error:
+            #Whatever we got, Python CSV module heuristics don't recognize it as CSV,
+            #or its first record can't be read (NUL bytes, a quote that isn't closed in the sample)
+            status = "not_csv"
+            csv_headers = []
+        else:
+            csv_info["delimiter"] = delimiter
+            csv_info["quoteChar"] = quotechar
+            csv_info["encoding"] = encoding
+
         #Autogenerating CSV header fields in case  some of them are empty
         for i, header in enumerate(csv_headers):
             if not header:
@@ -149,20 +339,134 @@ class ResourceCSVController(base.BaseController):
 
         return status, csv_headers, csv_info
 
-    def fetch_json_return_values(self, json_url, url_type):
+    def open_csv_stream(self, csv_url, url_type=None, resource=None):
+        """
+            Opens a CSV file for reading from the beginning, from the local filestore
+            if possible, otherwise over HTTP. Returns a file-like object
+            with read() and close() methods.
+        """
+        path = local_upload_path(resource)
+        if path is not None:
+            return open(path, "rb")
+
+        headers = {}
+        if url_type == "upload":
+            headers["Authorization"] = ckan_api_key
+        req = fetch.http_get(csv_url, headers=headers, timeout=fetch.csv_timeout, stream=True)
+        if req.status_code != 200:
+            req.close()
+            raise IOError("HTTP error {} while downloading {}".format(req.status_code, csv_url))
+        return fetch.ResponseStream(req)
+
+    def open_csv_source(self, csv_url, url_type=None, resource=None):
+        """
+            Returns a ranges.FileSource for a CSV file in the local filestore,
+            otherwise a ranges.HTTPSource, for reading parts of the file.
+        """
+        headers = {}
+        if url_type == "upload":
+            headers["Authorization"] = ckan_api_key
+        return ranges.open_source(csv_url, headers, local_upload_path(resource))
+
+    def profile_windows(self, csv_url, url_type, resource, csv_headers, csv_info):
+        """
+            Profiles rows from byte windows spread over the whole CSV file,
+            so that suggestions for a large file aren't based on its beginning alone.
+            Falls back to reading the beginning of the file if the server
+            doesn't support range requests. Returns a TableProfile.
+        """
+        sample = ranges.sample_rows(self.open_csv_source(csv_url, url_type, resource), csv_info, len(csv_headers))
+        profile = profile_rows(sample.rows, csv_headers, time_budget=profile_time_budget)
+        profile.complete = profile.complete and sample.complete
+        profile.bytes_read = sample.bytes_read
+        return profile
+
+    def get_column_suggestions(self, csv_url, url_type, resource, csv_headers, csv_info):
+        """
+            Profiles the CSV file (as much of it as profile_byte_budget and
+            profile_time_budget allow) and returns suggested datatype, length,
+            required and primaryKey values for the CSV metadata form,
+            in the same format as csvw_to_form.
+            Suggestions are cached until the sniffed beginning of the file changes.
+        """
+        cached_sniff = sniff_cache.get(csv_url)
+        content_hash = cached_sniff["content_hash"] if cached_sniff is not None else None
+        cached = suggestion_cache.get(csv_url)
+        if cached is not None and content_hash and cached["content_hash"] == content_hash:
+            suggestion_cache.count("hits")
+            return dict(cached["values"])
+
+        suggestion_cache.count("misses")
+        try:
+            with metrics.stage("suggestions") as timer:
+                if profile_sampling == "windows":
+                    profile = self.profile_windows(csv_url, url_type, resource, csv_headers, csv_info)
+                else:
+                    profile = profile_csv(lambda: self.open_csv_stream(csv_url, url_type, resource),
+                                          csv_headers, csv_info,
+                                          backend=profile_backend,
+                                          byte_budget=profile_byte_budget,
+                                          time_budget=profile_time_budget,
+                                          reservoir_size=profile_reservoir_size)
+                timer.bytes = profile.bytes_read
+        except Exception as e:
+            #Suggestions are nice to have, the form works without them
+            log.warning("Can't profile CSV {}: {}".format(csv_url, repr(e)))
+            return {}
+
+        values = profile.suggestions()
+        if content_hash:
+            suggestion_cache.set(csv_url, {"content_hash": content_hash, "values": values})
+        return dict(values)
+
+    def fetch_json_return_values(self, json_url, url_type, json_resource_id=None):
         """
             Downloads saved JSON with metadata, parses it as JSON and
             returns an object that contains the parsed JSON - in our
             case, it's 99.999% likely to be a dictionary
         """
+        with metrics.stage("fetch_json") as timer:
+            return self.read_json(json_url, url_type, json_resource_id, timer)
+
+    def read_json(self, json_url, url_type, json_resource_id, timer):
+        if url_type == "upload" and json_resource_id:
+            path = local_upload_path({"id": json_resource_id, "url": json_url, "url_type": url_type})
+            if path is not None:
+                with open(path, "r") as f:
+                    content = f.read()
+                timer.bytes = len(content)
+                return json.loads(content)
+
+        reason = failures.allow(json_url)
+        if reason is not None:
+            timer.outcome = "short_circuit"
+            raise failures.Unavailable(json_url, reason)
+        try:
+            json_dict = self.download_json(json_url, url_type, timer)
+        except fetch.DeadlinePassed:
+            raise
+        except fetch.HOST_ERRORS:
+            failures.record(json_url, failures.HOST_FAILURE)
+            raise
+        except Exception:
+            #Error page or a file that isn't JSON, timer.outcome tells which
+            failures.record(json_url, timer.outcome)
+            raise
+        failures.record(json_url, timer.outcome)
+        return json_dict
+
+    def download_json(self, json_url, url_type, timer):
         headers = {}
         if url_type == "upload":
             headers["Authorization"] = ckan_api_key
             logging.info("JSON is stored in CKAN storage!")
         elif url_type is not None:
-            log.warning("Unknown resource URL type: {}".format(csv_url))
+            log.warning("Unknown resource URL type: {}".format(json_url))
 
-        req = requests.get(json_url, headers=headers, timeout=3)
+        req = fetch.http_get(json_url, headers=headers, timeout=fetch.json_timeout)
+        timer.bytes = len(req.content)
+        if req.status_code != 200:
+            timer.outcome = "http_error_{}".format(req.status_code)
         json_dict = json.loads(req.text)
         return json_dict
 
@@ -188,40 +492,83 @@ class ResourceCSVController(base.BaseController):
 
         column_info = csvw_dict["tableSchema"]["columns"]
         for i, column in enumerate(column_info):
+            prefix = "{}-".format(i)
             #Datatype is a separate dict inside, processing it
             datatype = column["datatype"]["dc:title"] or column["datatype"]["base"]
-            length = column["datatype"]["length"]
-            column.pop("datatype")
-            form_values["{}-datatype".format(i)] = datatype
-            form_values["{}-length".format(i)] = length
-            #foreignKeys is also a separate dict
-            if "foreignKeys" in column and column["foreignKeys"]:
-                form_values["{}-foreignKeys".format(i)] = True
-                foreignKeys = column.pop("foreignKeys")
-                resource = foreignKeys[0]["reference"]["resource"]
-                columnReference = foreignKeys[0]["reference"]["columnReference"]
-                form_values["{}-resource".format(i)] = resource
-                form_values["{}-columnReference".format(i)] = columnReference
-            #All the other keys are mapped directly to the dictionary
-            for key in column.keys():
-                if column[key] is False:
+            form_values[prefix + "datatype"] = datatype
+            form_values[prefix + "length"] = column["datatype"]["length"]
+            for key, value in column.items():
+                if key == "datatype":
+                    continue
+                elif key == "foreignKeys" and value:
+                    #foreignKeys is also a separate dict
+                    form_values[prefix + "foreignKeys"] = True
+                    form_values[prefix + "resource"] = value[0]["reference"]["resource"]
+                    form_values[prefix + "columnReference"] = value[0]["reference"]["columnReference"]
+                elif value is False:
                     #This is a checkbox value
                     #It's better left unset to conform to HTML form POST format
-                    column.pop(key)
+                    continue
                 else:
-                    #Any other values, can be processed in template
-                    form_values["{}-{}".format(i, key)] = column[key]
+                    #All the other keys are mapped directly, values can be processed in template
+                    form_values[prefix + key] = value
         return form_values            
 
-    def form_to_csvw(self, form_data):
+    def values_to_form(self, csv_headers, csv_info, values):
+        """
+            Builds the data that the CSV metadata form would POST for the given
+            pre-filled form values (as returned by csvw_to_form or get_column_suggestions),
+            so that form_to_csvw can be used without the form, like in bulk generation.
+            Fields without a value get the same defaults the form shows.
+        """
+        form_data = {"csv_headers": repr(csv_headers),
+                     "csv_info": repr(csv_info),
+                     "csv_has_headers": ""}
+        form_schema = self.get_form_schema()
+        for i, csv_header in enumerate(csv_headers):
+            for field_name in form_schema.field_names:
+                key = "{}-{}".format(i, field_name)
+                value = values.get(key)
+                if field_name in form_schema.checkbox_ids:
+                    #Set checkboxes are POSTed with an empty value, unset ones aren't POSTed at all
+                    if value:
+                        form_data[key] = ""
+                elif value is not None:
+                    form_data[key] = value
+                elif field_name == "name":
+                    form_data[key] = csv_header
+                elif field_name == "datatype":
+                    form_data[key] = "string"
+                else:
+                    form_data[key] = ""
+        return form_data
+
+    def complete_form(self, form_data, csv_headers, csv_info, base_values, submitted):
+        """
+            Adds fields of the columns that weren't submitted to the form data,
+            with their values from base_values.
+        """
+        for key, value in self.values_to_form(csv_headers, csv_info, base_values).items():
+            column, separator, field_name = key.partition("-")
+            if separator and column.isdigit() and int(column) not in submitted:
+                form_data[key] = value
+
+    def form_to_csvw(self, form_data, pkg_dict=None, resource=None, base_values=None):
         """
            Converts data from CSV metadata form values to CSVW dictionary.
            The form data comes as HTML form data through a POST request
            so there is POST-specific processing, too.
+           The form may only have some of the columns, when the page hasn't
+           loaded all of them - the rest are described with base_values, form values
+           like csvw_to_form returns, by default those the page was rendered with.
         """
-        #Assumes info about current resource is in tk.c.pkg_dict
-        #and info about current package is in tk.c.resource
+        #Unless given, assumes info about current package is in tk.c.pkg_dict
+        #and info about current resource is in tk.c.resource
         #The info is placed there by resource_csv controller (in this same class)
+        if pkg_dict is None:
+            pkg_dict = tk.c.pkg_dict
+        if resource is None:
+            resource = tk.c.resource
 
         #csv headers and csv info dict are passed along with form data, removing them from the form data
         csv_info = self.eval_remove_from_form(form_data, "csv_info")
@@ -230,7 +577,7 @@ class ResourceCSVController(base.BaseController):
         form_data.pop("csv_has_headers")
 
         #getting data about organization
-        org_data = tk.c.pkg_dict["organization"]
+        org_data = pkg_dict["organization"]
         if ckan_root_path is not None:
             org_url = "{}/{}/organization/{}".format(ckan_site_url, ckan_root_path, org_data["name"])
         else:
@@ -240,83 +587,51 @@ class ResourceCSVController(base.BaseController):
         csvw_json_data = OrderedDict()
         csvw_json_data["@context"] = ["http://www.w3.org/ns/csvw", {"@language":"lv"}]
         #csvw_json_data["@type"] = "Table"
-        csvw_json_data["url"] = tk.c.resource["url"]
+        csvw_json_data["url"] = resource["url"]
         csvw_json_data["dialect"] = csv_info
-        csvw_json_data["dc:title"] = tk.c.pkg_dict["title"]
-        csvw_json_data["dcat:keyword"] = [tag["name"] for tag in tk.c.pkg_dict["tags"]] if "tags" in tk.c.pkg_dict else []
+        csvw_json_data["dc:title"] = pkg_dict["title"]
+        csvw_json_data["dcat:keyword"] = [tag["name"] for tag in pkg_dict["tags"]] if "tags" in pkg_dict else []
         csvw_json_data["dc:publisher"] = OrderedDict( (("schema:name", org_data["title"]),
                                           ( "schema:url", org_url)) )
-        csvw_json_data["dc:license"] = {"@id":tk.c.pkg_dict["license_url"]}
-        csvw_json_data["dc:issued"] = OrderedDict( (("@value", tk.c.resource["created"].split("T")[0]), ("@type", "xsd:date")) )
-        if tk.c.resource["last_modified"]:
-            modified_date = tk.c.resource["last_modified"].split("T")[0]
+        csvw_json_data["dc:license"] = {"@id":pkg_dict["license_url"]}
+        csvw_json_data["dc:issued"] = OrderedDict( (("@value", resource["created"].split("T")[0]), ("@type", "xsd:date")) )
+        if resource["last_modified"]:
+            modified_date = resource["last_modified"].split("T")[0]
         else:
             modified_date = csvw_json_data["dc:issued"]["@value"]
         csvw_json_data["dc:modified"] = OrderedDict( (("@value", modified_date), ("@type", "xsd:date")) )
         
-        #Creating a dictionary for each CSV header so that we can stuff data from form to those dictionaries
-        schema = {"columns":[OrderedDict() for i in range(len(csv_headers))]}
-
-        #form field names come in "{header_num}-{form_field_name}"
-        form_elements = form_data.keys()
-        form_elements.sort()
-        for key in form_elements:
-            try:
-                header_num_str, form_field_name = key.split("-", 1)
-                header_num = int(header_num_str)
-            except:
-                log.info("Error while parsing key {}".format(key))
-            else:
-                schema["columns"][header_num][form_field_name] = form_data[key]
-        
-        #Working around checkboxes - they'll be in the form data if set, but as '"checkbox_name":""' instead of '"checkbox_name"=True'
+        #Collecting form fields into a dictionary for each CSV header, in a single pass over the form data
         form_schema = self.get_form_schema()
-        checkbox_ids = [element["name"] for element in form_schema["form_fields"] if element["preset"] == "checkbox"]
-        for column in schema["columns"]:
-            for checkbox_id in checkbox_ids:
-                if checkbox_id in column.keys():
-                    column[checkbox_id] = True 
-
-        #Now, re-formatting the resulting schema dictionary to conform with the specification
-        for column in schema["columns"]:
+        submitted = form_schema.submitted_columns(form_data, len(csv_headers))
+        if len(submitted) < len(csv_headers):
+            if base_values is None:
+                base_values = self.get_cached_page_data(resource, pkg_dict)[3]
+            self.complete_form(form_data, csv_headers, csv_info, base_values, submitted)
+        columns = form_schema.decode_form(form_data, len(csv_headers))
+
+        #Now, re-formatting the resulting column dictionaries to conform with the specification
+        for column in columns:
             #dict is passed by reference, so we don't have to replace it after changing its contents
             base = column.pop("datatype")
             length = column.pop("length")
-            #column["datatype"] = {"base":base, "length":length, "dc:title":base}
             column["datatype"] = OrderedDict( (("dc:title", base), ("base", base), ("length", length)) )
 
-            # lat/long processing
-            if(base == "latitude"):
-                column["datatype"]["base"] = "decimal"
-                column["datatype"]["minimum"] = "-90"
-                column["datatype"]["maximum"] = "90"
-            elif (base == "longitude"):
-                column["datatype"]["base"] = "decimal"
-                column["datatype"]["minimum"] = "-180"
-                column["datatype"]["maximum"] = "180"
-            elif (base == "X"):
-                column["datatype"]["base"] = "decimal"
-                column["datatype"]["minimum"] = "160000"
-                column["datatype"]["maximum"] = "450000"
-            elif (base == "Y"):
-                column["datatype"]["base"] = "decimal"
-                column["datatype"]["minimum"] = "300000"
-                column["datatype"]["maximum"] = "780000"
+            # lat/long and LKS-92 X/Y are decimals within known bounds
+            if base in DATATYPE_BOUNDS:
+                bounded_base, minimum, maximum = DATATYPE_BOUNDS[base]
+                column["datatype"]["base"] = bounded_base
+                column["datatype"]["minimum"] = minimum
+                column["datatype"]["maximum"] = maximum
 
             #Now need to process primary and secondary keys
             resource = column.pop("resource")
             columnReference = column.pop("columnReference")
             if "foreignKeys" in column:
-                column.pop("foreignKeys")
                 column["foreignKeys"] = [{ "reference" : OrderedDict((("resource", resource), ("columnReference", columnReference)))}]
-            else:
-                pass 
 
-        #Sorting schema fields to make the column secription human-readable
-        order = [u'name', u'titles', u'dc:description', u'datatype', u'length', u'required', u'primaryKey', u'foreignKeys']
-        cmp = lambda x,y: 1 if x in order and y in order and order.index(x) > order.index(y) else -1
-        for i, column in enumerate(schema["columns"]):
-            schema["columns"][i] = OrderedDict(sorted(column.items(), cmp=cmp, key=lambda x:x[0]))
+        #Sorting schema fields to make the column description human-readable
+        schema = {"columns": [form_schema.order_column(column) for column in columns]}
 
         #Adding created schema to CSVW dictionary
         csvw_json_data["tableSchema"] = schema
@@ -325,7 +640,14 @@ class ResourceCSVController(base.BaseController):
         return csvw_json_string_data
 
     def link_json_to_csv(self, csv_resource, json_resource):
-        ckan_api.action.resource_update(id=csv_resource["id"], url=csv_resource["url"], conformsTo=json_resource["url"])
+        if csv_resource.get("conformsTo") == json_resource["url"]:
+            #Already linked - the usual case when an existing CSVW file is replaced, no need for another update
+            return
+        _own_updates.active = True
+        try:
+            ckan_api.action.resource_patch(id=csv_resource["id"], conformsTo=json_resource["url"])
+        finally:
+            _own_updates.active = False
 
     def find_existing_json_for_resource(self, resource, pkg_dict):
         """ 
@@ -338,26 +660,17 @@ class ResourceCSVController(base.BaseController):
             for given resource would.
             If CSVW exists, returns URL to download it, URL type and CSVW file resource ID. Otherwise, returns None, None and None.
         """
-        json_url = None
-        json_res_id = None
-        url_type = None
-
-        json_resources = [r for r in pkg_dict["resources"] if r["format"] == "JSON"]
-
-        #Check doesn't work when there's an external CSVW file linked
-        #if not json_resources: 
-        #    log.debug("No CSVW found for JSON!")
-        #    return None, None, None
+        #JSON resources of the package, indexed by URL and by filename
+        index = self.get_resource_index(pkg_dict)
 
         if "conformsTo" in resource and resource["conformsTo"]:
             #the "conformsTo" field stores metadata JSON URL
             json_url = resource["conformsTo"]
-            for res in json_resources:
-                if res["url"] == json_url:
-                    #Found a fitting JSON resource!
-                    json_res_id = res["id"]
-                    url_type = res["url_type"] if "url_type" in res else None
-                    return json_url, url_type, json_res_id
+            res = index.json_by_url.get(json_url)
+            if res is not None:
+                #Found a fitting JSON resource!
+                url_type = res["url_type"] if "url_type" in res else None
+                return json_url, url_type, res["id"]
             #Now, the json_url is set in the resource description, but it doesn't belong to a resource.
             #So, we return its URL, but indicate it has no resource associated
             #So next time the CSVW is regenerated, it'll be saved as a new resource
@@ -369,14 +682,11 @@ class ResourceCSVController(base.BaseController):
         log.info("CSV file has no conformsTo field - falling back on filename-based detection")
         resource_filename = self.filename_from_url(resource["url"])
         json_filename = self.make_json_filename(resource_filename)
-        for res in json_resources:
-            #Going through resources to see if JSON with same filename exists
-            #If there are multiple versions with same filenames, selecting the first one we find
-            if self.filename_from_url(res["url"]) == json_filename:
-                json_url = res["url"]
-                json_res_id = res["id"]
-                url_type = res["url_type"] if "url_type" in res else None
-                return json_url, url_type, json_res_id
+        #If there are multiple versions with same filenames, the index has the first one
+        res = index.json_by_filename.get(json_filename)
+        if res is not None:
+            url_type = res["url_type"] if "url_type" in res else None
+            return res["url"], url_type, res["id"]
 
         #It seems we didn't find anything
         log.debug("No CSVW found for JSON!")
@@ -405,56 +715,80 @@ class ResourceCSVController(base.BaseController):
         """
             Controller for "CSV metadata" page 
         """
+        metrics.begin_request()
+        try:
+            with metrics.stage("page") as timer:
+                try:
+                    return self.resource_csv_page(id, resource_id, timer)
+                except Exception as e:
+                    #Redirects and aborts are exceptions too
+                    if getattr(e, "code", None):
+                        timer.outcome = "http_{}".format(e.code)
+                    raise
+        finally:
+            timings = metrics.end_request()
+            if metrics.server_timing and timings:
+                tk.response.headers["Server-Timing"] = metrics.server_timing_header(timings)
+
+    def resource_csv_page(self, id, resource_id, timer):
+        """
+            Does what resource_csv says, telling how it went in the page timer's outcome
+        """
         #Getting information about the package and resource
         #It's necessary for the base template to render, and we can also use the data ourselves
-        try:
-            tk.c.pkg_dict = tk.get_action('package_show')(None, {'id': id})
-            tk.c.resource = tk.get_action('resource_show')(None, {'id': resource_id})
-        except (logic.NotFound, logic.NotAuthorized):
+        context = {'model': model, 'session': model.Session,
+                   'user': tk.c.user, 'auth_user_obj': tk.c.userobj}
+        with metrics.stage("package"):
+            try:
+                tk.c.pkg_dict = packages.show_package(context, id)
+            except (logic.NotFound, logic.NotAuthorized):
+                base.abort(404, _('Resource not found'))
+            #Package dict already has all its resources, no need for a separate resource_show
+            tk.c.resource = self.get_resource_index(tk.c.pkg_dict).by_id.get(resource_id)
+        if tk.c.resource is None:
             base.abort(404, _('Resource not found'))
 
         if str(tk.c.resource["format"]) != "CSV":
+            timer.outcome = "not_csv"
             return base.render('csvmetadata/resource_csv.html',
                            extra_vars={'status':'not_csv'})
 
         #getting form schema to pass to template
-        form_schema = self.get_form_schema()
+        with metrics.stage("form_schema"):
+            form_schema = self.get_form_schema()
         
         #getting resource url, checking if it's good
         resource_url = tk.c.resource["url"] if "url" in tk.c.resource else ""
         if not resource_url:
             #No URL shown or empty URL, failing early
+            timer.outcome = "url_fail"
             return base.render('csvmetadata/resource_csv.html',
                            extra_vars={'status':'url_fail'})
 
         resource_filename = self.filename_from_url(resource_url)
-        #Info about other resources - for JSON file lookup
-        other_resources = [resource for resource in tk.c.pkg_dict["resources"] if resource["id"] != resource_id]
-        
+
         #Checking if we're in a POST request - 
         #then we need to create JSON from received data and upload it
         if tk.request.method == 'POST':
             #Loading data from form
             form_data = tk.request.POST
-            csvw_string = self.form_to_csvw(form_data)
-            io_object = StringIO(csvw_string)
-            
+            with metrics.stage("form_to_csvw"):
+                csvw_string = self.form_to_csvw(form_data)
             filename = self.make_json_filename(resource_filename)
-            #monkeypatching because ckanapi gets filename from descriptor
-            io_object.name = filename
 
-            resource_name = filename
-            
-            x, x, json_resource_id = self.find_existing_json_for_resource(tk.c.resource, tk.c.pkg_dict)
-            if json_resource_id:
-                log.info("Updating CSVW resource")
-                json_resource = ckan_api.action.resource_update(id=json_resource_id, url="", upload=io_object)
-            else:
-                log.info("Creating a new CSVW resource")
-                json_resource = ckan_api.action.resource_create(package_id=id, name=resource_name, url="", upload=io_object)
-
-            self.link_json_to_csv(tk.c.resource, json_resource)
-                            
+            #Background jobs look the package up themselves, it might change by the time they run
+            pkg_dict = tk.c.pkg_dict if jobs.async_mode == "off" else None
+            jobs.enqueue(save_csvw, (id, resource_id, csvw_string, filename, pkg_dict), resource_id,
+                         title="Save CSVW for resource {}".format(resource_id))
+
+            if jobs.async_mode != "off":
+                #Saving continues in the background, the metadata page shows how it's going
+                core_helpers.redirect_to(
+                    controller='ckanext.csvmetadata.plugin:ResourceCSVController',
+                    action='resource_csv',
+                    id=id,
+                    resource_id=resource_id
+                )
             #Successfully uploaded, now redirecting to the package contents page to show that JSON file was created successfully
             core_helpers.redirect_to(
                 controller='package',
@@ -463,28 +797,354 @@ class ResourceCSVController(base.BaseController):
             )
 
         #POST request processing code didn't continue, assuming GET method
-        json_url, url_type, x = self.find_existing_json_for_resource(tk.c.resource, tk.c.pkg_dict)
+        #A background job might have gathered the page data already, right after the resource was saved
+        page_data = self.get_prewarmed_page_data(tk.c.resource, tk.c.pkg_dict)
+        if page_data is None:
+            page_data = self.get_page_data(tk.c.resource, tk.c.pkg_dict)
+            self.cache_page_data(tk.c.resource, tk.c.pkg_dict, page_data)
+        status, csv_headers, csv_info, values, json_url = page_data
+        #If the file or its host is held back after failing, the page says until when and offers to retry now
+        fetch_failure = failures.blocked(resource_url) if status != "ok" else None
+
+        timer.outcome = status
+        with metrics.stage("render"):
+            return base.render('csvmetadata/resource_csv.html',
+                               extra_vars={'status':status, 
+                                           'csv_headers':csv_headers, 
+                                           'form_fields':csvmetadata_form_fields(form_schema),
+                                           'values':values,
+                                           'column_window':form_column_window,
+                                           'csv_info':repr(csv_info),
+                                           'job_status':jobs.get_status(resource_id),
+                                           'has_csvw':bool(json_url),
+                                           'fetch_failure':fetch_failure,
+                                           'now':time.time(),
+                                           'validation_status':jobs.get_status("validate:" + resource_id),
+                                           'validation_report':validation.validation_reports.get(resource_id)})
+
+    def get_page_data(self, resource, pkg_dict):
+        """
+            Gathers what the CSV metadata form is rendered from: the CSV sample and
+            the form values from the existing CSVW file, or suggestions from the data.
+            Returns a (status, csv_headers, csv_info, values, json_url) tuple.
+        """
+        with metrics.stage("find_json"):
+            json_url, json_url_type, json_resource_id = self.find_existing_json_for_resource(resource, pkg_dict)
+        resource_url = resource["url"]
+        url_type = resource["url_type"] if "url_type" in resource else None
+
+        #Columns of resources that are in the DataStore come from their table,
+        #only the others have their CSV file downloaded and sniffed
+        datastore_result = self.get_datastore_columns(resource)
+
+        #Fetching CSV sample and existing CSVW at the same time, the page waits for the slower one
+        #Whichever doesn't finish before the deadline is left out
+        calls = []
+        if datastore_result is None:
+            calls.append((self.get_csv_sample, (resource_url, url_type, resource)))
+        if json_url:
+            calls.append((self.fetch_json_return_values, (json_url, json_url_type, json_resource_id)))
+        results = fetch.run_concurrently(calls, page_fetch_deadline)
+        json_dict, json_exception = results.pop() if json_url else (None, None)
+
+        if datastore_result is not None:
+            status = "ok"
+            csv_headers, datastore_values = datastore_result
+            csv_info = self.known_dialect(resource_url, json_dict)
+        else:
+            csv_sample, csv_exception = results[0]
+            if csv_exception is None:
+                status, csv_headers, csv_info = csv_sample
+            else:
+                logging.warning("Exception while getting CSV sample:")
+                logging.warning(repr(csv_exception))
+                status, csv_headers, csv_info = "url_fail", [], {"delimiter":"", "encoding":"", "quoteChar":""}
+
         values = {}
         if json_url:
-            #Some kind of JSON URL is found, let's fetch it and get CSV header descriptions
+            #Some kind of JSON URL is found, let's get CSV header descriptions from it
             try:
-                json_dict = self.fetch_json_return_values(json_url, url_type)
+                if json_exception is not None:
+                    raise json_exception
                 values = self.csvw_to_form(json_dict)
             except Exception as e:
                 logging.warning("Exception while getting JSON:")
                 logging.warning(repr(e))
                 pass #JSON is either unfetchable or badly constructed, so we won't use it
-        
-        url_type = tk.c.resource["url_type"] if "url_type" in tk.c.resource else None
-        #Getting CSV from the resource url
-        status, csv_headers, csv_info = self.get_csv_sample(resource_url, url_type)
 
-        return base.render('csvmetadata/resource_csv.html',
-                           extra_vars={'status':status, 
-                                       'csv_headers':csv_headers, 
-                                       'schema':form_schema, 
-                                       'values':values,
-                                       'csv_info':repr(csv_info)})
+        if not values and datastore_result is not None:
+            values = datastore_values
+        elif not values and status == "ok" and profile_suggestions:
+            #No CSVW to pre-fill the form from, suggesting what we can from the data itself
+            values = self.get_column_suggestions(resource_url, url_type, resource, csv_headers, csv_info)
+        return status, csv_headers, csv_info, values, json_url
+
+    def get_datastore_columns(self, resource):
+        """
+            For a resource that is in the DataStore, returns a (csv_headers, values)
+            tuple with its column names and form values with their datatypes,
+            taken from the DataStore table with a single datastore_search call.
+            Returns None if the resource has no DataStore table.
+        """
+        if not datastore.datastore_columns or not resource.get("datastore_active"):
+            return None
+        with metrics.stage("datastore") as timer:
+            fields = datastore.datastore_fields(ckan_api, resource["id"])
+            if fields is None:
+                timer.outcome = "no_table"
+                return None
+        return [name for name, pg_type in fields], datastore.field_values(fields)
+
+    def known_dialect(self, csv_url, csvw_dict=None):
+        """
+            CSV dialect of a file that isn't downloaded: the one it was sniffed
+            with last time, if that's cached, or the one its existing CSVW describes,
+            or the CSVW default dialect.
+        """
+        cached = sniff_cache.get(csv_url)
+        if cached is not None and cached["status"] == "ok":
+            return dict(cached["csv_info"])
+        dialect = csvw_dict.get("dialect") if isinstance(csvw_dict, dict) else None
+        if dialect and dialect.get("delimiter") and dialect.get("quoteChar"):
+            return {"delimiter": dialect["delimiter"],
+                    "encoding": dialect.get("encoding") or datastore.DEFAULT_DIALECT["encoding"],
+                    "quoteChar": dialect["quoteChar"]}
+        return dict(datastore.DEFAULT_DIALECT)
+
+    def page_data_stamp(self, resource, pkg_dict):
+        #Page data depends on the CSV file and on the package's CSVW resources
+        return [resource["url"], pkg_dict.get("metadata_modified")]
+
+    def cache_page_data(self, resource, pkg_dict, page_data, prewarmed=False):
+        page_cache.set(resource["id"], {"stamp": self.page_data_stamp(resource, pkg_dict),
+                                        "cached": time.time(),
+                                        "prewarmed": prewarmed,
+                                        "page_data": list(page_data)})
+
+    def get_prewarmed_page_data(self, resource, pkg_dict):
+        """
+            get_page_data result gathered by a background job after the resource
+            was created or updated (see prewarm_resources), if neither the CSV URL
+            nor the package has changed since and it isn't older than prewarm_ttl.
+            Otherwise None. Data of files that couldn't be downloaded isn't reused,
+            failures.allow decides when they are tried again.
+        """
+        cached = page_cache.get(resource["id"])
+        if (cached is not None and cached.get("prewarmed") and cached["page_data"][0] == "ok"
+                and cached["stamp"] == self.page_data_stamp(resource, pkg_dict)
+                and time.time() - cached["cached"] < prewarm_ttl):
+            page_cache.count("hits")
+            return tuple(cached["page_data"])
+        return None
+
+    def get_cached_page_data(self, resource, pkg_dict):
+        """
+            get_page_data result the page was rendered from, if it was rendered
+            recently and neither the CSV URL nor the package has changed since.
+            Otherwise gets it again.
+        """
+        cached = page_cache.get(resource["id"])
+        if (cached is not None and cached["stamp"] == self.page_data_stamp(resource, pkg_dict)
+                and time.time() - cached["cached"] < page_cache_ttl):
+            page_cache.count("hits")
+            return tuple(cached["page_data"])
+        page_cache.count("misses")
+        page_data = self.get_page_data(resource, pkg_dict)
+        self.cache_page_data(resource, pkg_dict, page_data)
+        return page_data
+
+    def resource_csv_columns(self, id, resource_id):
+        """
+            Controller for column chunks of the "CSV metadata" page: JSON with form
+            fields of columns from the `start` parameter, at most `count` of them,
+            as HTML, and their pre-filled form values
+        """
+        context = {'model': model, 'session': model.Session,
+                   'user': tk.c.user, 'auth_user_obj': tk.c.userobj}
+        try:
+            pkg_dict = packages.show_package(context, id)
+        except (logic.NotFound, logic.NotAuthorized):
+            base.abort(404, _('Resource not found'))
+        resource = self.get_resource_index(pkg_dict).by_id.get(resource_id)
+        if resource is None or not resource.get("url"):
+            base.abort(404, _('Resource not found'))
+        try:
+            start = max(int(tk.request.params.get("start", 0)), 0)
+            count = min(max(int(tk.request.params.get("count", form_column_window)), 1), form_column_chunk_limit)
+        except ValueError:
+            base.abort(400, _('Bad request'))
+
+        with metrics.stage("columns"):
+            status, csv_headers, csv_info, values, json_url = self.get_cached_page_data(resource, pkg_dict)
+            end = min(start + count, len(csv_headers))
+            prefixes = tuple("{}-".format(i) for i in range(start, end))
+            chunk_values = dict((key, value) for key, value in values.items() if key.startswith(prefixes))
+            html = tk.render_snippet('csvmetadata/snippets/columns.html',
+                                     {'csv_headers': csv_headers, 'start': start, 'end': end,
+                                      'form_fields': csvmetadata_form_fields(self.get_form_schema()),
+                                      'values': chunk_values})
+        tk.response.headers["Content-Type"] = "application/json;charset=utf-8"
+        return json.dumps({"status": status, "start": start, "end": end, "total": len(csv_headers),
+                           "values": chunk_values, "html": html})
+
+    def package_csvw(self, id):
+        """
+            Controller for the CSVW TableGroup of a package: one JSON-LD document
+            with the CSVW descriptions of all its CSV resources (see catalog.get_table_group).
+            CSVW files are fetched within page_fetch_deadline, like on the CSV metadata page.
+            Answers conditional requests with 304 Not Modified.
+        """
+        context = {'model': model, 'session': model.Session,
+                   'user': tk.c.user, 'auth_user_obj': tk.c.userobj}
+        try:
+            pkg_dict = packages.show_package(context, id)
+        except (logic.NotFound, logic.NotAuthorized):
+            base.abort(404, _('Dataset not found'))
+
+        with metrics.stage("catalog"):
+            table_group = catalog.get_table_group(self, pkg_dict, page_fetch_deadline)
+        tk.response.headers["ETag"] = str(table_group["etag"])
+        tk.response.headers["Last-Modified"] = catalog.http_date(table_group["last_modified"])
+        if table_group.get("complete", True):
+            #Clients may keep the document, but have to ask whether it has changed before using it
+            tk.response.headers["Cache-Control"] = "no-cache"
+        else:
+            #Some tables are missing, the next request might get them
+            tk.response.headers["Cache-Control"] = "no-store"
+        if catalog.not_modified(tk.request.headers, table_group["etag"], table_group["last_modified"]):
+            tk.response.status_int = 304
+            return ""
+        tk.response.headers["Content-Type"] = "application/csvm+json;charset=utf-8"
+        return table_group["document"]
+
+    def csvmetadata_metrics(self):
+        """
+            Prometheus text format metrics of this process, if csvmetadata.metrics_endpoint is on
+        """
+        if not metrics.metrics_endpoint:
+            base.abort(404, _('Not found'))
+        tk.response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+        return metrics.render_prometheus({"sniff": sniff_cache,
+                                          "suggestions": suggestion_cache,
+                                          "pages": page_cache,
+                                          "catalogs": catalog.catalog_cache,
+                                          "packages": packages.package_cache})
+
+    def resource_csv_retry(self, id, resource_id):
+        """
+            Controller for the "Retry now" button on the "CSV metadata" page: forgets
+            the failures of the CSV file and its host (see failures.reset), so that
+            the page downloads it again right away.
+        """
+        context = {'model': model, 'session': model.Session,
+                   'user': tk.c.user, 'auth_user_obj': tk.c.userobj}
+        try:
+            tk.check_access('resource_update', context, {'id': resource_id})
+            pkg_dict = packages.show_package(context, id)
+        except logic.NotAuthorized:
+            base.abort(403, _('Unauthorized to update resource'))
+        except logic.NotFound:
+            base.abort(404, _('Resource not found'))
+        resource = self.get_resource_index(pkg_dict).by_id.get(resource_id)
+        if resource is None:
+            base.abort(404, _('Resource not found'))
+        if resource.get("url"):
+            failures.reset(resource["url"])
+        page_cache.delete(resource_id)
+        core_helpers.redirect_to(
+            controller='ckanext.csvmetadata.plugin:ResourceCSVController',
+            action='resource_csv',
+            id=id,
+            resource_id=resource_id
+        )
+
+    def resource_csv_validate(self, id, resource_id):
+        """
+            Controller for the "Validate data" button on the "CSV metadata" page
+        """
+        context = {'model': model, 'session': model.Session,
+                   'user': tk.c.user, 'auth_user_obj': tk.c.userobj}
+        try:
+            tk.get_action('csvmetadata_validate')(context, {'resource_id': resource_id})
+        except logic.NotAuthorized:
+            base.abort(403, _('Unauthorized to validate resource'))
+        except logic.NotFound:
+            base.abort(404, _('Resource not found'))
+        except Exception as e:
+            #In "off" async mode validation runs right here, and the page shows why it failed
+            log.warning("Validation of resource {} failed: {}".format(resource_id, repr(e)))
+            jobs.set_status("validate:" + resource_id, "failed", repr(e))
+        core_helpers.redirect_to(
+            controller='ckanext.csvmetadata.plugin:ResourceCSVController',
+            action='resource_csv',
+            id=id,
+            resource_id=resource_id
+        )
+
+
+def save_csvw(package_id, resource_id, csvw_string, filename, pkg_dict=None, link=True):
+    """
+        Uploads CSVW JSON for a CSV resource, either as a new resource or
+        in place of the resource's existing CSVW file, and links it to the CSV resource.
+        Runs either in the request or as a background job, see jobs.async_mode.
+        With link=False, linking is left to the caller, for example to link
+        many resources with a single package update.
+    """
+    controller = ResourceCSVController()
+    if pkg_dict is None:
+        pkg_dict = ckan_api.action.package_show(id=package_id)
+    csv_resource = [resource for resource in pkg_dict["resources"] if resource["id"] == resource_id][0]
+
+    io_object = StringIO(csvw_string)
+    #monkeypatching because ckanapi gets filename from descriptor
+    io_object.name = filename
+
+    x, x, json_resource_id = controller.find_existing_json_for_resource(csv_resource, pkg_dict)
+    if json_resource_id:
+        log.info("Updating CSVW resource")
+        with metrics.stage("resource_update") as timer:
+            timer.bytes = len(csvw_string)
+            json_resource = ckan_api.action.resource_patch(id=json_resource_id, url="", upload=io_object)
+    else:
+        log.info("Creating a new CSVW resource")
+        with metrics.stage("resource_create") as timer:
+            timer.bytes = len(csvw_string)
+            json_resource = ckan_api.action.resource_create(package_id=package_id, name=filename, url="",
+                                                            upload=io_object)
+
+    if link:
+        with metrics.stage("link_json_to_csv"):
+            controller.link_json_to_csv(csv_resource, json_resource)
+    return json_resource
+
+
+def forget_resource_data(resource):
+    """
+        Drops what's cached about a resource's CSV file: its sniffing result,
+        column suggestions, download failures and the page data gathered from them.
+    """
+    if resource.get("url"):
+        sniff_cache.delete(resource["url"])
+        suggestion_cache.delete(resource["url"])
+        failures.failure_cache.delete(resource["url"])
+    if resource.get("id"):
+        page_cache.delete(resource["id"])
+
+
+def prewarm_resources(resources):
+    """
+        Queues background jobs that gather the CSV metadata page data of CSV resources
+        (see actions.prewarm_page), so that it's ready by the time someone opens the page.
+        Does nothing in "off" async mode, where the job would hold up the request that saved the resource,
+        and for updates the extension makes itself (see link_json_to_csv).
+    """
+    if not prewarm_pages or jobs.async_mode == "off" or getattr(_own_updates, "active", False):
+        return
+    for resource in resources:
+        if str(resource.get("format")) != "CSV" or not resource.get("url") or not resource.get("id"):
+            continue
+        jobs.enqueue(actions.prewarm_page, (resource["id"],), "prewarm:" + resource["id"],
+                     title="Prepare CSV metadata page for resource {}".format(resource["id"]))
 
 
 class CSVMetadataPlugin(p.SingletonPlugin, DefaultTranslation):
@@ -493,6 +1153,9 @@ class CSVMetadataPlugin(p.SingletonPlugin, DefaultTranslation):
     p.implements(p.IRoutes, inherit=True)
     p.implements(p.ITemplateHelpers)
     p.implements(p.ITranslation)
+    p.implements(p.IActions)
+    p.implements(p.IPackageController, inherit=True)
+    p.implements(p.IResourceController, inherit=True)
 
     #IConfigurer
     def update_config(self, config):
@@ -519,18 +1182,124 @@ class CSVMetadataPlugin(p.SingletonPlugin, DefaultTranslation):
 
         plugin_path = os.path.dirname(__file__)
         self.form_schema_path = os.path.join(plugin_path, "form_schema.json")
-        check_json_file(self.form_schema_path) #Will try to open and validate file at the path
+        load_form_schema(self.form_schema_path) #Will try to open, validate and compile file at the path
         global form_schema_path
         form_schema_path = self.form_schema_path
 
+        global page_fetch_deadline, prewarm_pages, prewarm_ttl
+        page_fetch_deadline = float(config.get('csvmetadata.page_fetch_deadline', page_fetch_deadline))
+        prewarm_pages = tk.asbool(config.get('csvmetadata.prewarm_pages', prewarm_pages))
+        prewarm_ttl = float(config.get('csvmetadata.prewarm_ttl', prewarm_ttl))
+        fetch.configure(config)
+        jobs.configure(config)
+        packages.configure(config)
+        validation.configure(config)
+        refindex.configure(config)
+        ranges.configure(config)
+        datastore.configure(config)
+        catalog.configure(config)
+        failures.configure(config)
+        metrics.configure(config)
+        if prewarm_pages and jobs.async_mode == "ckan" and not config.get('csvmetadata.sniff_cache_path'):
+            #Job workers would keep the page data in their own memory, where web server processes never see it
+            log.warning("Pre-warming CSV metadata pages is disabled: with `csvmetadata.async_mode = ckan` "
+                        "it needs `csvmetadata.sniff_cache_path` to be set")
+            prewarm_pages = False
+
+        global csv_header_byte_limit, csv_sample_byte_limit, csv_sample_rows
+        csv_header_byte_limit = int(config.get('csvmetadata.csv_header_byte_limit', csv_header_byte_limit))
+        csv_sample_byte_limit = max(int(config.get('csvmetadata.csv_sample_byte_limit', csv_sample_byte_limit)),
+                                    csv_header_byte_limit)
+        csv_sample_rows = int(config.get('csvmetadata.csv_sample_rows', csv_sample_rows))
+
+        global sniff_cache, suggestion_cache, page_cache
+        sniff_cache = make_cache(max_size=int(config.get('csvmetadata.sniff_cache_size', 512)),
+                                 path=config.get('csvmetadata.sniff_cache_path'))
+        page_cache = make_cache(max_size=int(config.get('csvmetadata.sniff_cache_size', 512)),
+                                path=config.get('csvmetadata.sniff_cache_path'),
+                                table="pages")
+        suggestion_cache = make_cache(max_size=int(config.get('csvmetadata.sniff_cache_size', 512)),
+                                      path=config.get('csvmetadata.sniff_cache_path'),
+                                      table="suggestions")
+
+        global profile_suggestions, profile_byte_budget, profile_time_budget, profile_reservoir_size, profile_backend
+        profile_suggestions = tk.asbool(config.get('csvmetadata.profile_suggestions', profile_suggestions))
+        profile_byte_budget = int(config.get('csvmetadata.profile_byte_budget', profile_byte_budget))
+        profile_time_budget = float(config.get('csvmetadata.profile_time_budget', profile_time_budget))
+        if config.get('csvmetadata.profile_reservoir_size'):
+            profile_reservoir_size = int(config.get('csvmetadata.profile_reservoir_size'))
+        profile_backend = config.get('csvmetadata.profile_backend', profile_backend)
+        global profile_sampling
+        profile_sampling = config.get('csvmetadata.profile_sampling', profile_sampling)
+
+        global form_column_window, form_column_chunk_limit
+        form_column_window = max(int(config.get('csvmetadata.form_column_window', form_column_window)), 1)
+        form_column_chunk_limit = max(int(config.get('csvmetadata.form_column_chunk_limit', form_column_chunk_limit)),
+                                      form_column_window)
+
     #IRoutes
     def before_map(self, m):
         m.connect(
             'resource_csv', '/dataset/{id}/resource_csv/{resource_id}',
             controller='ckanext.csvmetadata.plugin:ResourceCSVController',
             action='resource_csv', ckan_icon='table')
+        m.connect(
+            'resource_csv_validate', '/dataset/{id}/resource_csv/{resource_id}/validate',
+            controller='ckanext.csvmetadata.plugin:ResourceCSVController',
+            action='resource_csv_validate', conditions=dict(method=['POST']))
+        m.connect(
+            'resource_csv_retry', '/dataset/{id}/resource_csv/{resource_id}/retry',
+            controller='ckanext.csvmetadata.plugin:ResourceCSVController',
+            action='resource_csv_retry', conditions=dict(method=['POST']))
+        m.connect(
+            'resource_csv_columns', '/dataset/{id}/resource_csv/{resource_id}/columns',
+            controller='ckanext.csvmetadata.plugin:ResourceCSVController',
+            action='resource_csv_columns')
+        m.connect(
+            'package_csvw', '/dataset/{id}/csvw',
+            controller='ckanext.csvmetadata.plugin:ResourceCSVController',
+            action='package_csvw')
+        m.connect(
+            'csvmetadata_metrics', '/csvmetadata/metrics',
+            controller='ckanext.csvmetadata.plugin:ResourceCSVController',
+            action='csvmetadata_metrics')
         return m
 
     #ITemplateHelpers
     def get_helpers(self):
-        return {'csvmetadata_language_text': csvmetadata_language_text}
+        return {'csvmetadata_language_text': csvmetadata_language_text,
+                'csvmetadata_form_fields': csvmetadata_form_fields}
+
+    #IActions
+    def get_actions(self):
+        return {'csvmetadata_bulk_generate': actions.csvmetadata_bulk_generate,
+                'csvmetadata_bulk_generate_status': actions.csvmetadata_bulk_generate_status,
+                'csvmetadata_validate': actions.csvmetadata_validate,
+                'csvmetadata_validation_report': actions.csvmetadata_validation_report,
+                'csvmetadata_datastore_load': actions.csvmetadata_datastore_load,
+                'csvmetadata_datastore_load_status': actions.csvmetadata_datastore_load_status}
+
+    #IPackageController and IResourceController
+    #Both interfaces have these hooks, called with a package dict, a resource dict or,
+    #after a resource is deleted, the list of package's remaining resources
+    def after_create(self, context, data):
+        packages.forget(data)
+        #Resources created along with their package don't get resource hooks called
+        prewarm_resources([data] if "package_id" in data else data.get("resources") or [])
+
+    def after_update(self, context, data):
+        packages.forget(data)
+        #Package updates leave resources to their own hooks
+        if "package_id" in data:
+            prewarm_resources([data])
+
+    #IResourceController
+    def before_update(self, context, current, resource):
+        #A new URL or a new uploaded file (which can keep the URL) makes what's cached about the old one stale
+        upload = resource.get("upload")
+        new_upload = upload is not None and not isinstance(upload, basestring)
+        if current.get("url") != resource.get("url") or new_upload:
+            forget_resource_data(current)
+
+    def after_delete(self, context, data):
+        packages.forget(data)
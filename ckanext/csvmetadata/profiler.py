@@ -0,0 +1,421 @@
+# encoding: utf-8
+
+import re
+import time
+import random
+import logging
+from itertools import imap
+from csv_unicode import BlockLineReader, CSVStreamReader
+from schema import DATATYPE_BOUNDS
+
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    #Batched profiling backend is optional, pure Python one is used without it
+    np = pd = None
+
+log = logging.getLogger(__name__)
+
+#Datatypes we can recognize from values, most specific first, and regular expressions their values match
+#The names are the datatype choice values in form_schema.json
+TYPE_REGEXES = (
+    ("boolean", r"true|false", re.I),
+    ("decimal", r"[+-]?(\d+(\.\d*)?|\.\d+)", 0),
+    ("double", r"[+-]?((\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?|INF)|NaN", 0),
+    ("date", r"-?\d{4}-\d{2}-\d{2}(Z|[+-]\d{2}:\d{2})?", 0),
+    ("dateTime", r"-?\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:\d{2})?", 0),
+    ("anyURI", r"(https?|ftp)://\S+", re.I),
+)
+TYPE_PATTERNS = tuple((name, re.compile(r"^(?:%s)$" % regex, flags | re.U)) for name, regex, flags in TYPE_REGEXES)
+#Batched backend joins a chunk of values with line breaks and finds the first line that doesn't match in a single search
+LINE_MISMATCH_PATTERNS = dict((name, re.compile(r"^(?!(?:%s)$).*$" % regex, flags | re.U | re.M))
+                              for name, regex, flags in TYPE_REGEXES)
+NUMERIC_TYPES = ("decimal", "double")
+
+#Coordinate datatypes and their bounds, the same ones form_to_csvw writes to CSVW
+COORDINATE_BOUNDS = tuple((name, int(minimum), int(maximum))
+                          for name, (base, minimum, maximum) in DATATYPE_BOUNDS.items())
+
+#Words in column names that make a column a coordinate candidate
+#Numeric range alone isn't enough - lots of ordinary numbers fit between -90 and 90
+COORDINATE_HINTS = {
+    "latitude": frozenset(("lat", "latitude", "platums", "y")),
+    "longitude": frozenset(("lon", "lng", "long", "longitude", "garums", "x")),
+    "X": frozenset(("x", "n", "northing", "lks", "lks92")),
+    "Y": frozenset(("y", "e", "easting", "lks", "lks92")),
+}
+
+#Total number of distinct values remembered for uniqueness checks, shared among all columns
+distinct_value_budget = 1000000
+
+#Rows per chunk for the batched profiling backend
+batch_chunk_size = 50000
+
+_word_split = re.compile(r"[^\w]+|_", re.U)
+
+
+class ColumnProfile(object):
+    """
+        Statistics about one column, gathered one value at a time.
+        Memory use doesn't depend on the number of rows, except for
+        the set of distinct value hashes, which is capped at max_distinct.
+    """
+    __slots__ = ("count", "nulls", "min_length", "max_length", "candidates",
+                 "minimum", "maximum", "fractional", "distinct", "max_distinct", "unique")
+
+    def __init__(self, max_distinct):
+        self.count = 0
+        self.nulls = 0
+        self.min_length = None
+        self.max_length = 0
+        self.candidates = list(TYPE_PATTERNS)
+        self.minimum = None
+        self.maximum = None
+        self.fractional = False
+        self.distinct = set()
+        self.max_distinct = max_distinct
+        #None means "we don't know" - too many distinct values to keep track of
+        self.unique = True
+
+    def add(self, value):
+        if not value or value.isspace():
+            self.nulls += 1
+            return
+        self.count += 1
+        length = len(value)
+        if length > self.max_length:
+            self.max_length = length
+        if self.min_length is None or length < self.min_length:
+            self.min_length = length
+
+        if self.candidates:
+            self.candidates = [(name, pattern) for name, pattern in self.candidates if pattern.match(value)]
+            if any(name in NUMERIC_TYPES for name, pattern in self.candidates):
+                self.add_number(value)
+
+        if self.unique:
+            key = hash(value)
+            if key in self.distinct:
+                self.unique = False
+                self.distinct = None
+            elif len(self.distinct) >= self.max_distinct:
+                self.unique = None
+                self.distinct = None
+            else:
+                self.distinct.add(key)
+
+    def add_number(self, value):
+        try:
+            number = float(value)
+        except ValueError:
+            return
+        if number != number or number in (float("inf"), float("-inf")):
+            return
+        if self.minimum is None or number < self.minimum:
+            self.minimum = number
+        if self.maximum is None or number > self.maximum:
+            self.maximum = number
+        if not self.fractional and number != int(number):
+            self.fractional = True
+
+    @property
+    def null_ratio(self):
+        total = self.count + self.nulls
+        return float(self.nulls) / total if total else 0.0
+
+    def datatype(self, header=""):
+        """
+            Returns the best fitting datatype choice value for the column.
+        """
+        if not self.count or not self.candidates:
+            return "string"
+        datatype = self.candidates[0][0]
+        if datatype in NUMERIC_TYPES:
+            return self.coordinate_type(header) or datatype
+        return datatype
+
+    def coordinate_type(self, header):
+        if self.minimum is None:
+            return None
+        words = frozenset(word for word in _word_split.split(header.lower()) if word)
+        fitting = [name for name, minimum, maximum in COORDINATE_BOUNDS
+                   if minimum <= self.minimum and self.maximum <= maximum and words & COORDINATE_HINTS[name]]
+        if not self.fractional:
+            #Degrees are rarely whole numbers
+            fitting = [name for name in fitting if name not in ("latitude", "longitude")]
+        if len(fitting) > 1:
+            #Column name hints at several candidates (LKS-92 X and Y ranges overlap),
+            #keeping the ones with a hint that only they have
+            fitting = [name for name in fitting
+                       if words & (COORDINATE_HINTS[name] - frozenset().union(*[COORDINATE_HINTS[other]
+                                                                                for other in fitting if other != name]))]
+        return fitting[0] if len(fitting) == 1 else None
+
+
+class TableProfile(object):
+    """
+        Profiling result for a whole CSV file.
+        complete is True if every row of the file has been looked at.
+    """
+    def __init__(self, headers):
+        self.headers = list(headers)
+        max_distinct = max(distinct_value_budget // max(len(self.headers), 1), 1000)
+        self.columns = [ColumnProfile(max_distinct) for header in self.headers]
+        self.rows_read = 0
+        self.rows_profiled = 0
+        self.bytes_read = 0
+        self.complete = False
+
+    def add_row(self, row):
+        self.rows_profiled += 1
+        columns = self.columns
+        for i in range(len(columns)):
+            columns[i].add(row[i] if i < len(row) else u"")
+
+    def suggestions(self):
+        """
+            Returns profiling results as CSV metadata form values,
+            in the same format csvw_to_form returns them.
+        """
+        form_values = {}
+        primary_key_found = False
+        for i, (header, column) in enumerate(zip(self.headers, self.columns)):
+            datatype = column.datatype(header)
+            form_values["{}-datatype".format(i)] = datatype
+            #CSVW "length" is the exact length of every value, so it's only suggested for fixed-width columns,
+            #and only for strings - numbers and dates of the same width in a sample are a coincidence
+            if column.count and column.min_length == column.max_length and datatype == "string":
+                form_values["{}-length".format(i)] = unicode(column.max_length)
+            if column.count and not column.nulls:
+                form_values["{}-required".format(i)] = True
+                #Primary key candidate is the first column with unique values
+                if column.unique and not primary_key_found and self.rows_profiled > 1:
+                    form_values["{}-primaryKey".format(i)] = True
+                    primary_key_found = True
+        return form_values
+
+    def summary(self):
+        return [{"name": header,
+                 "datatype": column.datatype(header),
+                 "max_length": column.max_length,
+                 "null_ratio": column.null_ratio,
+                 "unique": column.unique,
+                 "minimum": column.minimum,
+                 "maximum": column.maximum}
+                for header, column in zip(self.headers, self.columns)]
+
+
+def profile_rows(rows, headers, byte_counter=None, byte_budget=None, time_budget=None,
+                 sample_every=1, reservoir_size=None, skip_header=True):
+    """
+        Profiles CSV rows in a single pass.
+
+        rows - iterable of rows (lists of unicode values)
+        headers - column names
+        byte_counter - callable returning the number of bytes read so far, for byte_budget
+        byte_budget - stop reading after this many bytes
+        time_budget - stop reading after this many seconds
+        sample_every - profile only every n-th row, the rest are just read
+        reservoir_size - instead of profiling rows as they come, keep a uniformly
+            random sample of this many rows and profile it at the end, so that
+            the profile isn't biased towards the beginning of the file when a budget cuts reading short
+
+        Returns a TableProfile.
+    """
+    profile = TableProfile(headers)
+    started = time.time()
+    reservoir = []
+    sample_every = max(int(sample_every), 1)
+    rows = iter(rows)
+    if skip_header:
+        next(rows, None)
+
+    profile.complete = True
+    for row in rows:
+        profile.rows_read += 1
+        if profile.rows_read % sample_every == 0:
+            if reservoir_size:
+                sampled = profile.rows_read // sample_every
+                if len(reservoir) < reservoir_size:
+                    reservoir.append(row)
+                else:
+                    j = random.randint(0, sampled - 1)
+                    if j < reservoir_size:
+                        reservoir[j] = row
+            else:
+                profile.add_row(row)
+        #Checking the clock for every row would cost more than some of the checks
+        if profile.rows_read % 256 == 0:
+            if byte_budget is not None and byte_counter is not None and byte_counter() >= byte_budget:
+                profile.complete = False
+                break
+            if time_budget is not None and time.time() - started >= time_budget:
+                profile.complete = False
+                break
+
+    for row in reservoir:
+        profile.add_row(row)
+    if byte_counter is not None:
+        profile.bytes_read = byte_counter()
+    log.debug("Profiled {} of {} rows in {:.3f}s".format(profile.rows_profiled, profile.rows_read, time.time() - started))
+    return profile
+
+
+class BudgetedReader(object):
+    """
+        File-like wrapper around a read(size) callable that reports end of file
+        once byte_budget bytes are read. Data is cut at the last line break
+        before the budget runs out, so that the last row isn't cut in half.
+    """
+    def __init__(self, read, byte_budget=None):
+        self._read = read
+        self.byte_budget = byte_budget
+        self.bytes_read = 0
+        self.truncated = False
+
+    def read(self, size=65536):
+        if self.truncated:
+            return b""
+        if size is None or size < 0:
+            size = 65536
+        if self.byte_budget is not None:
+            size = min(size, max(self.byte_budget - self.bytes_read, 0))
+        block = self._read(size) if size else b""
+        self.bytes_read += len(block)
+        if self.byte_budget is not None and self.bytes_read >= self.byte_budget:
+            self.truncated = True
+            block = block[:block.rfind(b"\n") + 1]
+        return block
+
+    def __iter__(self):
+        return iter(BlockLineReader(self.read))
+
+
+def profile_column_batch(column, values):
+    """
+        Updates a ColumnProfile with a whole chunk of values at once.
+        values is a NumPy array of unicode strings. Gathers the same statistics
+        as ColumnProfile.add, but each check runs once over the whole chunk
+        inside NumPy, pandas or the regular expression engine instead of
+        once per value in Python.
+    """
+    stripped_lengths = np.fromiter(imap(len, imap(unicode.strip, values)), dtype=np.int64, count=len(values))
+    present_mask = stripped_lengths > 0
+    column.nulls += int(len(values) - present_mask.sum())
+    present = values[present_mask]
+    if not len(present):
+        return
+    column.count += len(present)
+    lengths = np.fromiter(imap(len, present), dtype=np.int64, count=len(present))
+    column.max_length = max(column.max_length, int(lengths.max()))
+    column.min_length = int(lengths.min()) if column.min_length is None else min(column.min_length, int(lengths.min()))
+
+    if column.candidates:
+        joined = u"\n".join(present)
+        if joined.count(u"\n") != len(present) - 1:
+            #Some values have line breaks in them, so lines aren't values - checking them one by one
+            candidates = column.candidates
+            for value in present:
+                candidates = [(name, pattern) for name, pattern in candidates if pattern.match(value)]
+                if not candidates:
+                    break
+        else:
+            candidates = [(name, pattern) for name, pattern in column.candidates
+                          if LINE_MISMATCH_PATTERNS[name].search(joined) is None]
+        column.candidates = candidates
+
+        if any(name in NUMERIC_TYPES for name, pattern in candidates):
+            #Values passed the pattern check, so they all convert (INF and NaN included)
+            numbers = present.astype(np.float64)
+            finite = numbers[np.isfinite(numbers)]
+            if len(finite):
+                column.minimum = float(finite.min()) if column.minimum is None else min(column.minimum, float(finite.min()))
+                column.maximum = float(finite.max()) if column.maximum is None else max(column.maximum, float(finite.max()))
+                column.fractional = column.fractional or bool((finite != np.floor(finite)).any())
+
+    if column.unique:
+        hashes = pd.util.hash_array(present)
+        seen = column.distinct if column.distinct is not None and len(column.distinct) else np.empty(0, dtype=hashes.dtype)
+        if len(np.unique(hashes)) < len(hashes) or np.isin(hashes, seen).any():
+            column.unique = False
+            column.distinct = None
+        elif len(seen) + len(hashes) > column.max_distinct:
+            column.unique = None
+            column.distinct = None
+        else:
+            column.distinct = np.concatenate((seen, hashes))
+
+
+def profile_csv_batched(read, headers, csv_info, byte_budget=None, time_budget=None, chunk_size=None):
+    """
+        Batched profiling backend: parses the CSV in chunks of rows with
+        the pandas C parser, using the dialect and encoding from csv_info,
+        and profiles each chunk column by column. Needs pandas and NumPy.
+        Returns a TableProfile, like profile_rows.
+    """
+    profile = TableProfile(headers)
+    started = time.time()
+    stream = BudgetedReader(read, byte_budget)
+    column_ids = list(range(len(headers)))
+    chunks = pd.read_csv(stream, sep=csv_info["delimiter"], quotechar=csv_info["quoteChar"] or '"',
+                         encoding=csv_info["encoding"] or "utf-8", header=None, skiprows=1,
+                         names=column_ids, usecols=column_ids, dtype=object,
+                         na_filter=False, keep_default_na=False, skip_blank_lines=False,
+                         chunksize=chunk_size or batch_chunk_size, engine="c")
+    profile.complete = True
+    for chunk in chunks:
+        profile.rows_read += len(chunk)
+        profile.rows_profiled += len(chunk)
+        for i, column in enumerate(profile.columns):
+            values = chunk[i]
+            if values.hasnans:
+                #Short rows get NaN for missing values, profiling them as empty
+                values = values.fillna(u"")
+            profile_column_batch(column, values.values)
+        if time_budget is not None and time.time() - started >= time_budget:
+            profile.complete = False
+            break
+    if stream.truncated:
+        profile.complete = False
+    profile.bytes_read = stream.bytes_read
+    log.debug("Profiled {} rows in {:.3f}s (batched)".format(profile.rows_profiled, time.time() - started))
+    return profile
+
+
+def profile_csv(open_stream, headers, csv_info, backend="auto", byte_budget=None, time_budget=None,
+                reservoir_size=None):
+    """
+        Profiles a CSV file using the dialect and encoding get_csv_sample detected.
+
+        open_stream - callable that opens the file from the beginning, returning
+            a file-like object with read() and close()
+        backend - "python", "batch" (needs pandas) or "auto" - batched one if
+            pandas is installed, unless reservoir sampling is requested, which only
+            the Python one does. If the batched backend fails to parse the file,
+            it's profiled again with the Python one.
+
+        Returns a TableProfile.
+    """
+    if backend == "batch" and pd is None:
+        raise ImportError("Batched CSV profiling backend needs pandas and NumPy")
+    if backend == "batch" or (backend == "auto" and pd is not None and not reservoir_size):
+        stream = open_stream()
+        try:
+            return profile_csv_batched(stream.read, headers, csv_info, byte_budget, time_budget)
+        except Exception as e:
+            log.info("Batched profiling failed, falling back to Python profiler: {}".format(repr(e)))
+        finally:
+            stream.close()
+
+    stream = open_stream()
+    try:
+        rows = CSVStreamReader(stream.read, csv_info["delimiter"], csv_info["quoteChar"] or '"',
+                               encoding=csv_info["encoding"])
+        return profile_rows(iter(rows), headers,
+                            byte_counter=lambda: rows.bytes_read,
+                            byte_budget=byte_budget,
+                            time_budget=time_budget,
+                            reservoir_size=reservoir_size)
+    finally:
+        stream.close()
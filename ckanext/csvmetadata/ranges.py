@@ -0,0 +1,236 @@
+# encoding: utf-8
+
+import os
+import logging
+from io import BytesIO
+
+import fetch
+from csv_unicode import CSVStreamReader, ascii_compatible
+from sniffing import record_ends
+
+log = logging.getLogger(__name__)
+
+#Number of byte windows read when a file is sampled in parts: one at the beginning,
+#one at the end and the rest spread evenly in between
+sample_windows = 8
+
+#Size of each window, in bytes
+sample_window_size = 65536
+
+
+def configure(config):
+    global sample_windows, sample_window_size
+    sample_windows = max(int(config.get('csvmetadata.sample_windows', sample_windows)), 1)
+    sample_window_size = int(config.get('csvmetadata.sample_window_size', sample_window_size))
+
+
+class FileSource(object):
+    """
+        A CSV file in the local filestore. Its stamp changes whenever the file does.
+    """
+    ranges = True
+
+    def __init__(self, path):
+        self.path = path
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.stamp = "{}:{}:{}".format(stat.st_ino, stat.st_mtime, stat.st_size)
+
+    def read_range(self, start, end):
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def open(self, start=0):
+        f = open(self.path, "rb")
+        f.seek(start)
+        return f
+
+
+class HTTPSource(object):
+    """
+        A CSV file on a web server. If the server supports range requests,
+        parts of the file can be read without downloading all of it.
+        Support is probed with a request for the first byte: servers that
+        support ranges answer with 206 and the file size in Content-Range,
+        others (whatever their Accept-Ranges header says) send the whole file.
+        The stamp is the file's ETag, or its Last-Modified time if the server
+        sends no ETag, or None if it sends neither.
+    """
+    def __init__(self, url, headers=None):
+        self.url = url
+        self.headers = dict(headers or {})
+        req = self._get(0, 1)
+        self.stamp = req.headers.get("ETag") or req.headers.get("Last-Modified")
+        try:
+            if req.status_code == 206 and req.headers.get("Content-Range", "").rsplit("/", 1)[-1].isdigit():
+                self.ranges = True
+                self.size = int(req.headers["Content-Range"].rsplit("/", 1)[1])
+                #Reading the byte returns the connection to the pool instead of dropping it
+                req.content
+            elif req.status_code == 200:
+                #No range support, so the whole file has to be read every time
+                self.ranges = False
+                self.size = None
+            else:
+                raise IOError("HTTP error {} while downloading {}".format(req.status_code, self.url))
+        finally:
+            req.close()
+
+    def _get(self, start, end=None):
+        headers = dict(self.headers)
+        headers["Range"] = "bytes={}-{}".format(start, end - 1 if end is not None else "")
+        return fetch.http_get(self.url, headers=headers, timeout=fetch.csv_timeout, stream=True)
+
+    def read_range(self, start, end):
+        req = self._get(start, end)
+        try:
+            if req.status_code != 206:
+                raise IOError("Server didn't return the requested part of {}".format(self.url))
+            return req.content
+        finally:
+            req.close()
+
+    def open(self, start=0):
+        req = self._get(start) if start else fetch.http_get(self.url, headers=self.headers,
+                                                           timeout=fetch.csv_timeout, stream=True)
+        if req.status_code not in (200, 206) or (start and req.status_code != 206):
+            req.close()
+            raise IOError("HTTP error {} while downloading {}".format(req.status_code, self.url))
+        return fetch.ResponseStream(req)
+
+
+def open_source(url, headers=None, path=None):
+    """
+        FileSource if the file is in the local filestore (path isn't None), HTTPSource otherwise.
+    """
+    if path is not None:
+        return FileSource(path)
+    return HTTPSource(url, headers)
+
+
+def window_ranges(size, windows, window_size):
+    """
+        Returns [start, end) byte ranges of windows spread evenly over a file
+        of the given size, the first one at its beginning and the last one at its end.
+        If the windows wouldn't fit without overlapping, returns the whole file as one range.
+    """
+    if windows < 2 or size <= windows * window_size:
+        return [(0, size)]
+    step = float(size - window_size) / (windows - 1)
+    return [(int(i * step), int(i * step) + window_size) for i in range(windows)]
+
+
+def parse_rows(content, dialect):
+    return list(CSVStreamReader(BytesIO(content).read, dialect["delimiter"], dialect["quoteChar"] or '"',
+                                encoding=dialect["encoding"]))
+
+
+def realign(content, dialect, column_count, at_start=False, at_end=False):
+    """
+        Parses the whole records in a window of bytes cut from a CSV file.
+        The partial record at the beginning of the window is skipped, unless
+        the window is at the start of the file, and so is the partial record
+        at its end, unless the window is at the end of the file.
+
+        Whether the window starts inside a quoted value (with line breaks in it)
+        can't be told from the window alone, so both cases are tried. When the
+        guess is wrong, quotes get paired up across records, and the CSV parser
+        splits the data into a different number of records than counting quotes
+        on each line does. The case where the two agree, and more records
+        have column_count values, wins.
+
+        Returns a list of rows.
+    """
+    quotechar = str(dialect["quoteChar"] or '"')
+    best_rows, best_score = [], None
+    for in_quotes in ((False,) if at_start else (False, True)):
+        ends = list(record_ends(content, quotechar, 0, in_quotes))
+        if at_start:
+            start = 0
+        elif ends:
+            start = ends[0]
+        else:
+            continue
+        end = len(content) if at_end else (ends[-1] if ends else 0)
+        if end <= start:
+            continue
+        records = len([record_end for record_end in ends if start < record_end <= end])
+        if end > (ends[-1] if ends else start):
+            #The last record of the file doesn't end with a line break
+            records += 1
+        rows = parse_rows(content[start:end], dialect)
+        width = sum(1 for row in rows if len(row) == column_count)
+        score = (len(rows) == records, width)
+        if best_score is None or score > best_score:
+            best_rows, best_score = rows, score
+        if score == (True, len(rows)):
+            #Every record is the right width, no need to try the other case
+            break
+    return best_rows
+
+
+class Sample(object):
+    """
+        Rows read from a CSV file by sample_rows. The first row is the header.
+        complete is True if the rows are the whole file, ranged is True if they
+        were read with range requests, bytes_read is the number of bytes transferred.
+    """
+    def __init__(self):
+        self.rows = []
+        self.bytes_read = 0
+        self.complete = False
+        self.ranged = False
+
+
+def sample_rows(source, dialect, column_count, windows=None, window_size=None):
+    """
+        Reads rows from windows spread over a CSV file - its head, its tail and
+        evenly spaced offsets in between - transferring only about
+        windows * window_size bytes however large the file is.
+        dialect is a dictionary with the delimiter, quoteChar and encoding
+        of the file, like get_csv_sample returns.
+
+        Windows are read with keep-alive connections of the shared session, and
+        realigned to record boundaries (see realign). Line breaks
+        are found in bytes, so files in encodings that aren't ASCII compatible
+        (UTF-16) are read from the beginning instead, like those on servers
+        that don't support range requests, until as many bytes are read.
+
+        Returns a Sample.
+    """
+    windows = windows or sample_windows
+    window_size = window_size or sample_window_size
+    sample = Sample()
+    budget = windows * window_size
+    if source.ranges and ascii_compatible(dialect["encoding"]) and source.size > budget:
+        ranges = window_ranges(source.size, windows, window_size)
+        #Windows are read one after another over the pooled session: this often runs in a fetch
+        #pool thread already, and the pool is for the page fetches of other requests too
+        read_range = source.read_range
+        if fetch.current_deadline() is None:
+            #Together they get as long as downloading a sample does
+            read_range = fetch.bind_deadline(read_range, fetch.Deadline(fetch.csv_timeout))
+        for start, end in ranges:
+            content = read_range(start, end)
+            sample.bytes_read += len(content)
+            sample.rows.extend(realign(content, dialect, column_count, at_start=start == 0, at_end=end >= source.size))
+        sample.ranged = True
+        log.debug("Sampled {} rows in {} windows of {} ({} bytes)".format(
+            len(sample.rows), len(ranges), getattr(source, "url", getattr(source, "path", None)), sample.bytes_read))
+        return sample
+
+    stream = source.open()
+    try:
+        rows = CSVStreamReader(stream.read, dialect["delimiter"], dialect["quoteChar"] or '"',
+                               encoding=dialect["encoding"])
+        for row in rows:
+            sample.rows.append(row)
+            if rows.bytes_read >= budget:
+                break
+        else:
+            sample.complete = True
+        sample.bytes_read = rows.bytes_read
+    finally:
+        stream.close()
+    return sample
@@ -0,0 +1,226 @@
+# encoding: utf-8
+
+import os
+import json
+import struct
+import bisect
+import hashlib
+import logging
+import tempfile
+import threading
+from array import array
+
+from cache import LRUCache
+from csv_unicode import CSVStreamReader
+
+log = logging.getLogger(__name__)
+
+#Directory where reference indexes are stored, shared by all processes on the host
+reference_index_path = os.path.join(tempfile.gettempdir(), "csvmetadata-references")
+
+#Value hashes are kept in arrays of 64-bit integers where the platform has them ("q" is Python 3 only),
+#otherwise in doubles, which hold 52-bit integers exactly
+if array("l").itemsize == 8:
+    KEY_TYPECODE, KEY_MASK = "l", None
+else:
+    KEY_TYPECODE, KEY_MASK = "d", (1 << 52) - 1
+
+#Number of loaded key files kept in memory by each process
+loaded_keys_size = 8
+
+#A global that stores loaded key files, keyed by path, each entry is a (file stamp, keys) tuple
+_loaded_keys = LRUCache(loaded_keys_size)
+_build_lock = threading.Lock()
+
+
+def configure(config):
+    global reference_index_path, loaded_keys_size, _loaded_keys
+    reference_index_path = config.get('csvmetadata.reference_index_path', reference_index_path)
+    loaded_keys_size = int(config.get('csvmetadata.reference_cache_size', loaded_keys_size))
+    _loaded_keys = LRUCache(loaded_keys_size)
+
+
+def key_hash(values):
+    """
+        64-bit (or 52-bit, see KEY_TYPECODE) hash of a key value, the same in every process.
+        Takes a list of values, so that composite keys can be hashed too.
+    """
+    digest = hashlib.md5(u"\x00".join(values).encode("utf-8")).digest()
+    key = struct.unpack("<q", digest[:8])[0]
+    return key & KEY_MASK if KEY_MASK else key
+
+
+def sorted_keys(keys):
+    """
+        Returns the keys as a sorted array without repeated values.
+    """
+    result = array(KEY_TYPECODE)
+    previous = None
+    for key in sorted(keys):
+        if key != previous:
+            result.append(key)
+            previous = key
+    return result
+
+
+def contains(keys, key):
+    """
+        Membership probe on a sorted key array.
+    """
+    i = bisect.bisect_left(keys, key)
+    return i < len(keys) and keys[i] == key
+
+
+def load_keys(path):
+    """
+        Returns the sorted key array stored at the path. Arrays are kept
+        in memory until the file changes, as the same reference is
+        usually probed by many chunks and many validations.
+    """
+    stamp = os.stat(path)
+    stamp = (stamp.st_ino, stamp.st_mtime, stamp.st_size)
+    cached = _loaded_keys.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    keys = array(KEY_TYPECODE)
+    with open(path, "rb") as f:
+        keys.fromstring(f.read())
+    _loaded_keys.set(path, (stamp, keys))
+    return keys
+
+
+class IdentityReader(object):
+    """
+        read(size) wrapper that remembers what it needs to describe
+        the data it has read: its size, SHA-1 hash and last byte.
+    """
+    def __init__(self, read):
+        self._read = read
+        self.size = 0
+        self.hash = hashlib.sha1()
+        self.last = b""
+
+    def read(self, size=65536):
+        block = self._read(size)
+        self.size += len(block)
+        self.hash.update(block)
+        if block:
+            self.last = block[-1:]
+        return block
+
+    def read_until(self, size):
+        """
+            Reads until size bytes have been read in total, or the data ends.
+        """
+        while self.size < size and self.read(min(size - self.size, 1048576)):
+            pass
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def index_file_path(url, column):
+    """
+        Reference index files are named after the referenced URL and column.
+        Which version of the file an index is for is in its metadata.
+    """
+    name = hashlib.sha1(u"{}\x00{}".format(url, column).encode("utf-8")).hexdigest()
+    return os.path.join(reference_index_path, name)
+
+
+def read_values(read, dialect, column, column_index=None):
+    """
+        Reads CSV rows with read(size), returning hashes of the values in the
+        column and the column's position. If column_index is None, the first row
+        is the header and the column is found by name, otherwise there's no header.
+    """
+    rows = iter(CSVStreamReader(read, dialect["delimiter"], dialect["quoteChar"], encoding=dialect.get("encoding")))
+    if column_index is None:
+        header = next(rows, [])
+        if column not in header:
+            raise Exception("Column {} not found in referenced resource".format(column))
+        column_index = header.index(column)
+    keys = [key_hash([row[column_index]]) for row in rows if column_index < len(row) and row[column_index]]
+    return keys, column_index
+
+
+def write_index(path, keys, meta):
+    """
+        Saves the key array (unless it's None, when only the metadata has changed)
+        and its metadata. Files are replaced atomically, so other processes
+        never see half-written indexes.
+    """
+    if not os.path.isdir(reference_index_path):
+        os.makedirs(reference_index_path)
+    files = [(".json", lambda f: f.write(json.dumps(meta)))]
+    if keys is not None:
+        #Keys are replaced first, so that the metadata never describes keys that aren't there yet
+        files.insert(0, (".keys", lambda f: keys.tofile(f)))
+    for suffix, write in files:
+        fd, temp_path = tempfile.mkstemp(dir=reference_index_path)
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.rename(temp_path, path + suffix)
+
+
+def get_reference_index(url, column, dialect, source):
+    """
+        Returns the path to the sorted key array of values in the column
+        of the referenced CSV file, building or updating it if needed.
+        An index is reused without reading the file while the file's stamp
+        (see ranges.FileSource and ranges.HTTPSource) and size stay the same.
+        Otherwise the file is read again and compared with the indexed data by
+        its hash: if it's the same, or if rows have only been appended to it,
+        only the new rows are parsed.
+    """
+    path = index_file_path(url, column)
+    with _build_lock:
+        try:
+            with open(path + ".json", "r") as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            meta = None
+
+        if meta is not None and meta.get("content_hash"):
+            if source.stamp is not None and meta.get("stamp") == source.stamp and meta["size"] == source.size:
+                return path + ".keys"
+            if source.size is None or meta["size"] <= source.size:
+                stream = source.open(0)
+                try:
+                    reader = IdentityReader(stream.read)
+                    reader.read_until(meta["size"])
+                    new_keys = None
+                    if reader.hexdigest() == meta["content_hash"]:
+                        #A new row can only start where the indexed data ended with a line break
+                        if reader.last == b"\n":
+                            new_keys, column_index = read_values(reader.read, dialect, column, meta["column_index"])
+                        elif not reader.read(1):
+                            new_keys = []
+                finally:
+                    stream.close()
+                if new_keys is not None:
+                    keys = None
+                    if reader.size > meta["size"]:
+                        log.info("Adding rows appended to {} to its reference index".format(url))
+                        keys = sorted_keys(load_keys(path + ".keys").tolist() + new_keys)
+                        meta["values"] = len(keys)
+                    meta.update({"size": reader.size, "content_hash": reader.hexdigest(), "stamp": source.stamp})
+                    write_index(path, keys, meta)
+                    return path + ".keys"
+
+        log.info("Building reference index for column {} of {}".format(column, url))
+        stream = source.open(0)
+        try:
+            reader = IdentityReader(stream.read)
+            keys, column_index = read_values(reader.read, dialect, column)
+        finally:
+            stream.close()
+        keys = sorted_keys(keys)
+        write_index(path, keys, {"url": url,
+                                 "column": column,
+                                 "column_index": column_index,
+                                 "size": reader.size,
+                                 "content_hash": reader.hexdigest(),
+                                 "stamp": source.stamp,
+                                 "values": len(keys)})
+        return path + ".keys"
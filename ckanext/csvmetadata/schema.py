@@ -0,0 +1,205 @@
+# encoding: utf-8
+
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+#Datatypes the form offers that are saved to CSVW as a base datatype with bounds
+#Form value -> (base datatype, minimum, maximum)
+DATATYPE_BOUNDS = OrderedDict((
+    ("latitude", ("decimal", "-90", "90")),
+    ("longitude", ("decimal", "-180", "180")),
+    ("X", ("decimal", "160000", "450000")),
+    ("Y", ("decimal", "300000", "780000")),
+))
+
+
+#Compiled form schemas, keyed by schema file path
+#Each entry is a (file stamp, FormSchema) tuple
+_schema_cache = {}
+_schema_cache_lock = threading.Lock()
+
+
+class FrozenDict(dict):
+    """
+        A dictionary that refuses to be changed after it's created.
+        The compiled form schema is shared between all requests (and threads),
+        so any accidental modification in a controller or template
+        would leak into every page rendered afterwards.
+    """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("{} is read-only".format(self.__class__.__name__))
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def freeze(obj):
+    """
+        Recursively turns dictionaries into FrozenDicts and lists into tuples.
+    """
+    if isinstance(obj, dict):
+        return FrozenDict((key, freeze(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(item) for item in obj)
+    return obj
+
+
+def load_json_file(path, file_desc="CSVMetadata table config file"):
+    if not os.path.isfile(path):
+        raise Exception(
+             '{} not found at {}'
+             .format(file_desc, path))
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+         raise Exception(
+            "Error while checking {} at {}: \n Error details: {}"
+            .format(file_desc, path, repr(e)))
+
+
+def adjust_schema(schema):
+    #ensures correct schema-to-ckan_form_element_name mapping
+    preset_map = {"textbox":"input"}
+    for element in schema["form_fields"]:
+        #Adjust label?
+        if element["preset"] in preset_map:
+            element["preset"] = preset_map[element["preset"]]
+        element["name"] = element.pop("field_name")
+        if element["preset"] == "select":
+            for choice in element["choices"]:
+                choice["name"] = choice.pop("label")
+            #Currently overriden in the template
+            element["selected"] = element["choices"][0]["value"] if element["choices"] else ""
+        element["required"] = element.pop("required") if "required" in element else False
+    return schema
+
+
+class FormSchema(object):
+    """
+        Form schema that has already been adjusted for CKAN form macros,
+        together with lookup tables derived from it.
+        Instances are shared between requests and must be treated as read-only.
+    """
+    def __init__(self, raw_schema):
+        self.schema = freeze(adjust_schema(raw_schema))
+        self.form_fields = self.schema["form_fields"]
+        self.field_names = tuple(element["name"] for element in self.form_fields)
+        self.checkbox_ids = frozenset(element["name"] for element in self.form_fields
+                                      if element["preset"] == "checkbox")
+        #CSVW column keys are ordered like the form fields, keys the form doesn't have go last
+        self.key_rank = dict((name, rank) for rank, name in enumerate(self.field_names))
+        self.value_field_names = tuple(name for name in self.field_names if name not in self.checkbox_ids)
+        #Form fields with labels in one language, keyed by language, see localized_fields
+        self._localized = {}
+        self._localized_lock = threading.Lock()
+
+    def localized_fields(self, language, translate):
+        """
+            Returns form fields with "label" and "help_text" already translated
+            with translate(text) and choices that have their "text" to show,
+            compiled once for each language.
+        """
+        fields = self._localized.get(language)
+        if fields is None:
+            with self._localized_lock:
+                fields = self._localized.get(language)
+                if fields is None:
+                    fields = freeze([self._localize_field(element, translate) for element in self.form_fields])
+                    self._localized[language] = fields
+        return fields
+
+    def _localize_field(self, element, translate):
+        field = dict(element)
+        field["label"] = translate(element.get("label"))
+        field["help_text"] = translate(element.get("help_text"))
+        if "choices" in element:
+            field["choices"] = [{"value": choice["value"], "text": translate(choice.get("name")) or choice["value"]}
+                                for choice in element["choices"]]
+        return field
+
+    def decode_form(self, form_data, column_count):
+        """
+            Collects "{header_num}-{form_field_name}" values of the form data
+            into a dictionary for each of column_count columns, in a single pass.
+            Checkboxes are only POSTed when they're set, with an empty value,
+            so those become True. Other keys are ignored.
+        """
+        columns = [{} for i in range(column_count)]
+        checkbox_ids = self.checkbox_ids
+        for key, value in form_data.items():
+            header_num_str, separator, form_field_name = key.partition("-")
+            if not separator or not header_num_str.isdigit():
+                log.info("Error while parsing key {}".format(key))
+                continue
+            header_num = int(header_num_str)
+            if header_num >= column_count:
+                log.info("Form field {} is for a column the CSV doesn't have".format(key))
+                continue
+            columns[header_num][form_field_name] = True if form_field_name in checkbox_ids else value
+        return columns
+
+    def submitted_columns(self, form_data, column_count):
+        """
+            Returns the set of column numbers the form data has fields of.
+            Text fields and selects are always POSTed, so a column that has
+            none of them wasn't in the form.
+        """
+        return set(i for i in range(column_count)
+                   if any("{}-{}".format(i, name) in form_data for name in self.value_field_names))
+
+    def order_column(self, column):
+        """
+            Returns the column's CSVW description as an OrderedDict with keys
+            in the same order as the form fields, which makes it human-readable.
+        """
+        rank = self.key_rank
+        last = len(rank)
+        return OrderedDict(sorted(column.items(), key=lambda item: rank.get(item[0], last)))
+
+
+def file_stamp(path):
+    """
+        Returns a value that changes whenever the file at the path is replaced or modified.
+    """
+    st = os.stat(path)
+    return (st.st_ino, st.st_mtime, st.st_size)
+
+
+def load_form_schema(path):
+    """
+        Returns a compiled FormSchema for the schema file at the path.
+        The file is only read and parsed again when it has changed on disk,
+        so editing form_schema.json still takes effect without a restart.
+    """
+    try:
+        stamp = file_stamp(path)
+    except OSError:
+        stamp = None
+    cached = _schema_cache.get(path)
+    if stamp is not None and cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    with _schema_cache_lock:
+        #Another thread might have loaded the schema while we waited for the lock
+        cached = _schema_cache.get(path)
+        if stamp is not None and cached is not None and cached[0] == stamp:
+            return cached[1]
+        #Raises an exception with a descriptive message if the file is missing or broken
+        form_schema = FormSchema(load_json_file(path))
+        _schema_cache[path] = (stamp, form_schema)
+        return form_schema
@@ -0,0 +1,56 @@
+# encoding: utf-8
+
+
+def record_ends(content, quotechar='"', start=0, in_quotes=False):
+    """
+        Yields offsets right after each complete CSV record in the content,
+        starting from the start offset. Line breaks inside quoted values don't
+        end a record. Doubled (escaped) quote characters don't change
+        whether we're inside a quoted value, so counting quote characters
+        on each line is enough to tell. If the start offset is inside
+        a quoted value, in_quotes has to be True.
+    """
+    newline = '\n' if '\n' in content else '\r'
+    pos = start
+    while True:
+        line_end = content.find(newline, pos)
+        if line_end == -1:
+            return
+        if content.count(quotechar, pos, line_end) % 2:
+            in_quotes = not in_quotes
+        pos = line_end + 1
+        if not in_quotes:
+            yield pos
+
+
+def records_end(content, record_count, quotechar='"'):
+    """
+        Returns offset right after the record_count-th complete record
+        in the content, or None if the content doesn't have that many.
+    """
+    if record_count < 1:
+        return 0
+    for i, end in enumerate(record_ends(content, quotechar), 1):
+        if i == record_count:
+            return end
+    return None
+
+
+def read_csv_head(read, initial_size, max_size, min_records):
+    """
+        Reads the beginning of a CSV file using the read(size) callable.
+        First reads initial_size bytes, like a simple fixed-size read would.
+        Only if those don't hold min_records complete records (for example,
+        the file has a very wide header), keeps reading in chunks that double
+        in size until there are enough records, the file ends, or max_size bytes are read.
+        Returns the bytes read.
+    """
+    content = read(initial_size)
+    chunk_size = initial_size
+    while len(content) < max_size and records_end(content, min_records) is None:
+        chunk = read(min(chunk_size, max_size - len(content)))
+        if not chunk:
+            break #End of file
+        content += chunk
+        chunk_size *= 2
+    return content
@@ -0,0 +1,33 @@
+# encoding: utf-8
+
+import os
+import logging
+
+try:
+    from ckan.lib.uploader import get_resource_uploader
+except ImportError:
+    #CKAN < 2.7 doesn't have IUploader plugins, so there's only one uploader class
+    from ckan.lib.uploader import ResourceUpload as get_resource_uploader
+
+log = logging.getLogger(__name__)
+
+
+def local_upload_path(resource):
+    """
+        Returns filesystem path to an uploaded resource's file, if the
+        file is stored in the local CKAN filestore. Otherwise (link resources,
+        uploaders that store files elsewhere, missing files) returns None,
+        and the caller should download the resource by its URL instead.
+    """
+    if not resource or resource.get("url_type") != "upload" or not resource.get("id"):
+        return None
+    try:
+        #Uploader pops some keys out of the resource dictionary, passing a copy
+        upload = get_resource_uploader(dict(resource))
+        path = upload.get_path(resource["id"])
+    except Exception as e:
+        log.debug("Can't get filestore path for resource {}: {}".format(resource["id"], repr(e)))
+        return None
+    if path and os.path.isfile(path):
+        return path
+    return None
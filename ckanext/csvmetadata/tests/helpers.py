@@ -0,0 +1,59 @@
+# encoding: utf-8
+"""
+    A local stand-in for the web servers CSV and CSVW files are downloaded from.
+"""
+
+import threading
+import SocketServer
+import BaseHTTPServer
+
+
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        status, headers, body = self.server.respond(self)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+        Answers GET requests with respond(request handler), which returns
+        a (status, headers, body) tuple, and keeps (path, headers) of every request:
+
+            with StandinServer(lambda request: (200, {}, "a,b\\n1,2\\n")) as server:
+                url = server.url("/file.csv")
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, respond):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StandinHandler)
+        self.respond = respond
+        self.requests = []
+
+    def handle_error(self, request, client_address):
+        #Clients hang up as soon as they have what they need
+        pass
+
+    def url(self, path):
+        return "http://{}:{}{}".format(self.server_address[0], self.server_address[1], path)
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,55 @@
+# encoding: utf-8
+
+import threading
+
+import nose.tools as nt
+
+from ckanext.csvmetadata import actions, fetch
+
+
+class StandinModel(object):
+    """
+        ckan.model with a Session that records which threads removed it.
+    """
+    def __init__(self):
+        self.Session = self
+        self.removed = []
+
+    def remove(self):
+        self.removed.append(threading.current_thread())
+
+
+class TestBulkSessions(object):
+
+    def setup(self):
+        self.settings = actions.model, actions.prepare_csvw
+        actions.model = StandinModel()
+
+        def prepare_csvw(controller, pkg_dict, resource):
+            if resource.get("broken"):
+                raise Exception("url_fail")
+            return resource["id"]
+        actions.prepare_csvw = prepare_csvw
+
+    def teardown(self):
+        actions.model, actions.prepare_csvw = self.settings
+
+    def prepare(self, resources):
+        caller = threading.current_thread()
+        return fetch.run_concurrently([(actions.prepare_csvw_in_pool, (None, {}, resource, caller))
+                                       for resource in resources], 5, pool="bulk")
+
+    def test_pool_threads_remove_their_session_after_each_call(self):
+        results = self.prepare([{"id": "a"}, {"id": "b", "broken": True}])
+
+        nt.assert_equal(results[0], ("a", None))
+        nt.assert_equal(str(results[1][1]), "url_fail")
+        nt.assert_equal(len(actions.model.removed), 2)
+        nt.assert_not_in(threading.current_thread(), actions.model.removed)
+
+    def test_calls_inline_in_the_caller_keep_its_session(self):
+        #A bulk pool thread that prepares resources runs them in itself
+        [(results, error)] = fetch.run_concurrently([(self.prepare, ([{"id": "a"}],))], 5, pool="bulk")
+
+        nt.assert_equal(results, [("a", None)])
+        nt.assert_equal(actions.model.removed, [])
@@ -0,0 +1,93 @@
+# encoding: utf-8
+
+import os
+import shutil
+import tempfile
+
+import nose.tools as nt
+
+from ckanext.csvmetadata import plugin
+from ckanext.csvmetadata.cache import SQLiteCache, make_cache
+from ckanext.csvmetadata.tests.helpers import StandinServer
+
+
+class TestSQLiteCache(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = SQLiteCache(os.path.join(self.directory, "cache.db"), max_size=2)
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        self.cache.set("a", [1])
+        self.cache.set("b", [2])
+        self.cache.get("a")
+        self.cache.set("c", [3])
+
+        nt.assert_equal(self.cache.get("a"), [1])
+        nt.assert_equal(self.cache.get("b"), None)
+        nt.assert_equal(len(self.cache), 2)
+
+    def test_forked_process_opens_its_own_connection(self):
+        #Caches are created before a preforking server forks its workers
+        self.cache.set("parent", 1)
+        parent_connection = self.cache._conn
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self.cache.set("child", 2)
+                ok = self.cache.get("parent") == 1 and self.cache._conn is not parent_connection
+            finally:
+                os._exit(0 if ok else 1)
+        nt.assert_equal(os.waitpid(pid, 0)[1], 0)
+        nt.assert_equal(self.cache.get("child"), 2)
+        nt.assert_true(self.cache._conn is parent_connection)
+
+    def test_broken_cache_file_only_makes_it_empty(self):
+        with open(self.cache.path, "wb") as f:
+            f.write(b"not an SQLite database" * 100)
+
+        self.cache.set("a", [1])
+        self.cache.delete("a")
+        self.cache.clear()
+
+        nt.assert_is_none(self.cache.get("a"))
+        nt.assert_equal(len(self.cache), 0)
+        nt.assert_equal(self.cache.stats()["size"], 0)
+
+
+
+class TestSniffCacheRevalidation(object):
+
+    def setup(self):
+        self.sniff_cache = plugin.sniff_cache
+        plugin.sniff_cache = make_cache()
+
+    def teardown(self):
+        plugin.sniff_cache = self.sniff_cache
+
+    def test_new_validators_of_unchanged_content_are_stored(self):
+        #Server that gives the same file a new ETag, like after it was re-uploaded unchanged
+        state = {"etag": '"1"'}
+
+        def respond(request):
+            if request.headers.get("If-None-Match") == state["etag"]:
+                return 304, {"ETag": state["etag"]}, ""
+            return 200, {"ETag": state["etag"], "Content-Type": "text/csv"}, "a,b\r\n1,2\r\n3,4\r\n"
+
+        controller = plugin.ResourceCSVController()
+        with StandinServer(respond) as server:
+            url = server.url("/data.csv")
+            first = controller.download_csv_sample(url)
+            state["etag"] = '"2"'
+            second = controller.download_csv_sample(url)
+            third = controller.download_csv_sample(url)
+            sent = [request[1].get("if-none-match") for request in server.requests]
+
+        nt.assert_equal(first[1], ["a", "b"])
+        nt.assert_equal(second, first)
+        nt.assert_equal(third, first)
+        nt.assert_equal(sent, [None, '"1"', '"2"'])
+        nt.assert_equal(plugin.sniff_cache.get(url)["etag"], '"2"')
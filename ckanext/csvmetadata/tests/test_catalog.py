@@ -0,0 +1,62 @@
+# encoding: utf-8
+
+import json
+import time
+
+import nose.tools as nt
+
+from ckanext.csvmetadata import catalog
+from ckanext.csvmetadata.cache import LRUCache
+from ckanext.csvmetadata.packages import ResourceIndex
+
+
+class Controller(object):
+    """
+        The parts of ResourceCSVController get_table_group uses, with CSVW
+        files that take as many seconds to fetch as their URL says.
+    """
+    def get_resource_index(self, pkg_dict):
+        return ResourceIndex(pkg_dict, lambda url: url.rsplit("/", 1)[-1])
+
+    def find_existing_json_for_resource(self, resource, pkg_dict):
+        return resource["url"] + ".json", None, None
+
+    def fetch_json_return_values(self, json_url, url_type, json_resource_id):
+        time.sleep(float(json_url.split("/")[-2]))
+        return {"@context": "http://www.w3.org/ns/csvw", "url": json_url[:-len(".json")]}
+
+
+def package(*delays):
+    return {"id": "package", "title": "Package", "metadata_modified": "2020-01-01T00:00:00",
+            "resources": [{"id": "resource-{}".format(i), "format": "CSV",
+                           "url": "http://example.com/{}/data.csv".format(delay)}
+                          for i, delay in enumerate(delays)]}
+
+
+class TestTableGroup(object):
+
+    def setup(self):
+        self.cache = catalog.catalog_cache
+        catalog.catalog_cache = LRUCache()
+
+    def teardown(self):
+        catalog.catalog_cache = self.cache
+
+    def test_tables_that_miss_the_deadline_are_left_out(self):
+        started = time.time()
+        group = catalog.get_table_group(Controller(), package(0, 3), deadline=0.5)
+
+        nt.assert_less(time.time() - started, 2)
+        nt.assert_false(group["complete"])
+        tables = json.loads(group["document"])["tables"]
+        nt.assert_equal([table["url"] for table in tables], ["http://example.com/0/data.csv"])
+
+    def test_incomplete_group_is_built_again(self):
+        controller = Controller()
+        catalog.get_table_group(controller, package(0, 0.3), deadline=0.1)
+        #The table left out is fetched again on the next request
+        time.sleep(0.3)
+        group = catalog.get_table_group(controller, package(0, 0.3), deadline=1)
+
+        nt.assert_true(group["complete"])
+        nt.assert_equal(len(json.loads(group["document"])["tables"]), 2)
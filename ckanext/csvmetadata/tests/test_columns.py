@@ -0,0 +1,111 @@
+# encoding: utf-8
+
+import os
+import json
+import time
+
+import nose.tools as nt
+
+import ckan.plugins.toolkit as tk
+
+from ckanext.csvmetadata import packages, plugin
+from ckanext.csvmetadata.cache import LRUCache
+
+COLUMN_COUNT = 2000
+
+RESOURCE = {"id": "csv", "format": "CSV", "url": "http://example.com/wide.csv"}
+PKG_DICT = {"id": "package", "metadata_modified": "2020-01-01T00:00:00", "resources": [RESOURCE]}
+
+
+class Aborted(Exception):
+    pass
+
+
+class StandinBase(object):
+    """
+        ckan.lib.base, whose abort raises the HTTP status code.
+    """
+    @staticmethod
+    def abort(status, message=None):
+        raise Aborted(status)
+
+
+class Standin(object):
+    """
+        Pylons request, response and template context, with just the attributes given.
+    """
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class TestColumnChunks(object):
+
+    def setup(self):
+        self.settings = (plugin.base, plugin.page_cache, plugin.form_schema_path, plugin.form_column_window,
+                         plugin.form_column_chunk_limit, plugin.csvmetadata_form_fields, packages.show_package)
+        self.toolkit = dict((name, getattr(tk, name, None)) for name in ("c", "request", "response", "render_snippet"))
+        plugin.base = StandinBase
+        plugin.page_cache = LRUCache()
+        plugin.form_schema_path = os.path.join(os.path.dirname(plugin.__file__), "form_schema.json")
+        plugin.form_column_window = 50
+        plugin.form_column_chunk_limit = 500
+        plugin.csvmetadata_form_fields = lambda form_schema: []
+        packages.show_package = lambda context, package_id: PKG_DICT
+        tk.c = Standin(user="user", userobj=None)
+        tk.response = Standin(headers={})
+        #The snippet is "rendered" as the range of columns it got
+        tk.render_snippet = lambda template, extra_vars: "{start}:{end}".format(**extra_vars)
+
+        self.controller = plugin.ResourceCSVController()
+        headers = [u"kolonna {}".format(i) for i in range(COLUMN_COUNT)]
+        values = dict(("{}-titles".format(i), u"Kolonna {}".format(i)) for i in range(COLUMN_COUNT))
+        plugin.page_cache.set(RESOURCE["id"], {"stamp": self.controller.page_data_stamp(RESOURCE, PKG_DICT),
+                                               "cached": time.time(),
+                                               "page_data": ("ok", headers, {}, values, None)})
+
+    def teardown(self):
+        (plugin.base, plugin.page_cache, plugin.form_schema_path, plugin.form_column_window,
+         plugin.form_column_chunk_limit, plugin.csvmetadata_form_fields, packages.show_package) = self.settings
+        for name, value in self.toolkit.items():
+            if value is not None:
+                setattr(tk, name, value)
+            elif hasattr(tk, name):
+                delattr(tk, name)
+
+    def columns(self, resource_id="csv", **params):
+        tk.request = Standin(params=params)
+        return json.loads(self.controller.resource_csv_columns("package", resource_id))
+
+    def test_chunk_has_values_of_its_own_columns(self):
+        chunk = self.columns(start="100", count="50")
+
+        nt.assert_equal((chunk["start"], chunk["end"], chunk["total"]), (100, 150, COLUMN_COUNT))
+        nt.assert_equal(chunk["html"], "100:150")
+        nt.assert_equal(sorted(chunk["values"]), sorted("{}-titles".format(i) for i in range(100, 150)))
+        nt.assert_equal(tk.response.headers["Content-Type"], "application/json;charset=utf-8")
+
+    def test_default_window_from_the_start(self):
+        chunk = self.columns()
+
+        nt.assert_equal((chunk["start"], chunk["end"]), (0, 50))
+
+    def test_count_is_limited(self):
+        nt.assert_equal(self.columns(start="0", count="100000")["end"], 500)
+        nt.assert_equal(self.columns(start="10", count="0")["end"], 11)
+        nt.assert_equal(self.columns(start="-5", count="3")["start"], 0)
+
+    def test_last_chunk_ends_with_the_table(self):
+        chunk = self.columns(start="1990", count="50")
+        nt.assert_equal((chunk["start"], chunk["end"], len(chunk["values"])), (1990, COLUMN_COUNT, 10))
+
+        chunk = self.columns(start="5000", count="50")
+        nt.assert_equal(chunk["values"], {})
+        nt.assert_equal(chunk["end"], COLUMN_COUNT)
+
+    def test_bad_parameters_and_unknown_resources(self):
+        with nt.assert_raises(Aborted) as context:
+            self.columns(start="x")
+        nt.assert_equal(context.exception.args, (400,))
+        with nt.assert_raises(Aborted) as context:
+            self.columns(resource_id="other")
+        nt.assert_equal(context.exception.args, (404,))
@@ -0,0 +1,106 @@
+# encoding: utf-8
+
+import codecs
+from io import BytesIO
+
+import nose.tools as nt
+
+from ckanext.csvmetadata import plugin
+from ckanext.csvmetadata.csv_unicode import detect_encoding, CSVStreamReader
+
+TEXT = u"Nosaukums;Adrese;Ābele\r\n" + u"Āraiši;„Āres”, Rīga;Ūdensrozes\r\n" * 20
+
+
+class TestDetectEncoding(object):
+
+    def test_byte_order_marks(self):
+        for bom, encoding in ((codecs.BOM_UTF8, "utf-8"), (codecs.BOM_UTF16_LE, "utf-16le"),
+                              (codecs.BOM_UTF16_BE, "utf-16be"), (codecs.BOM_UTF32_LE, "utf-32le")):
+            nt.assert_equal(detect_encoding(bom + TEXT.encode(encoding)), (encoding, len(bom)))
+
+    def test_utf16_without_bom(self):
+        nt.assert_equal(detect_encoding(TEXT.encode("utf-16le")), ("utf-16le", 0))
+        nt.assert_equal(detect_encoding(TEXT.encode("utf-16be")), ("utf-16be", 0))
+
+    def test_ascii_utf16_without_bom(self):
+        text = u"id;name;value\r\n1;Riga;10\r\n2;Cesis;20\r\n"
+
+        nt.assert_equal(detect_encoding(text.encode("utf-16le")), ("utf-16le", 0))
+        nt.assert_equal(detect_encoding(text.encode("utf-16be")), ("utf-16be", 0))
+
+    def test_utf32_without_bom_is_not_utf16(self):
+        text = u"id;name;value\r\n1;Riga;10\r\n"
+
+        nt.assert_not_in(detect_encoding(text.encode("utf-32le"))[0], ("utf-16le", "utf-16be"))
+        nt.assert_not_in(detect_encoding(text.encode("utf-32be"))[0], ("utf-16le", "utf-16be"))
+
+    def test_utf16_with_many_capital_a_with_macron(self):
+        #U+0100 has a zero low byte, like ASCII characters have a zero high byte
+        text = u"Ā;Ā\r\nĀĀ;ĀĀ\r\n"
+
+        nt.assert_equal(detect_encoding(text.encode("utf-16le")), ("utf-16le", 0))
+        nt.assert_equal(detect_encoding(text.encode("utf-16be")), ("utf-16be", 0))
+
+    def test_utf8(self):
+        nt.assert_equal(detect_encoding(TEXT.encode("utf-8")), ("utf-8", 0))
+        nt.assert_equal(detect_encoding(b"id,name\r\n1,x\r\n"), ("utf-8", 0))
+
+    def test_default_declarations_are_ignored(self):
+        nt.assert_equal(detect_encoding(TEXT.encode("utf-8"), "ISO-8859-1"), ("utf-8", 0))
+        nt.assert_equal(detect_encoding(TEXT.encode("windows-1257"), "iso-8859-4"), ("iso-8859-4", 0))
+
+    def test_latvian_8bit_encodings(self):
+        nt.assert_equal(detect_encoding(TEXT.encode("windows-1257")), ("windows-1257", 0))
+        nt.assert_equal(detect_encoding(TEXT.encode("iso-8859-13")), ("iso-8859-13", 0))
+
+
+class TestSniffing(object):
+
+    def setup(self):
+        self.controller = plugin.ResourceCSVController()
+
+    def sniff(self, content):
+        return self.controller.sniff_csv_content(content, None)
+
+    def test_semicolons_in_utf16(self):
+        status, headers, info = self.sniff(codecs.BOM_UTF16_LE + TEXT.encode("utf-16le"))
+
+        nt.assert_equal(status, "ok")
+        nt.assert_equal(headers, [u"Nosaukums", u"Adrese", u"Ābele"])
+        nt.assert_equal(info, {"delimiter": ";", "quoteChar": '"', "encoding": "utf-16le"})
+
+    def test_ascii_utf16_without_bom(self):
+        status, headers, info = self.sniff(u"id;name;value\r\n1;Riga;10\r\n2;Cesis;20\r\n".encode("utf-16le"))
+
+        nt.assert_equal(status, "ok")
+        nt.assert_equal(headers, [u"id", u"name", u"value"])
+        nt.assert_equal(info["encoding"], "utf-16le")
+
+    def test_quoted_multiline_header(self):
+        content = u'"Nr.";"Adrese\nlīdz 2020";"Platība"\r\n1;"Rīga";2,5\r\n2;"Cēsis";3\r\n'.encode("windows-1257")
+        status, headers, info = self.sniff(content)
+
+        nt.assert_equal(status, "ok")
+        nt.assert_equal(headers, [u"Nr.", u"Adrese\nlīdz 2020", u"Platība"])
+        nt.assert_equal(info["encoding"], "windows-1257")
+
+    def test_unreadable_header_is_not_csv(self):
+        status, headers, info = self.sniff(b"a;b\x00;c\r\n1;2;3\r\n4;5;6\r\n")
+
+        nt.assert_equal(status, "not_csv")
+        nt.assert_equal(headers, [])
+
+    def test_empty_first_record_is_not_csv(self):
+        status, headers, info = self.sniff(b"\r\na;b;c\r\n1;2;3\r\n")
+
+        nt.assert_equal(status, "not_csv")
+        nt.assert_equal(headers, [])
+
+    def test_rows_read_with_the_sniffed_dialect(self):
+        content = TEXT.encode("utf-16le")
+        status, headers, info = self.sniff(content)
+        rows = list(CSVStreamReader(BytesIO(content).read, info["delimiter"], info["quoteChar"],
+                                    encoding=info["encoding"]))
+
+        nt.assert_equal(len(rows), 21)
+        nt.assert_equal(rows[1], [u"Āraiši", u"„Āres”, Rīga", u"Ūdensrozes"])
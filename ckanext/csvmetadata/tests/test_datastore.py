@@ -0,0 +1,202 @@
+# encoding: utf-8
+"""
+    Tests of DataStore columns and of loading rows into the DataStore with COPY.
+    Loading needs the Postgres database that ckan.datastore.write_url in test.ini
+    points to, and is skipped without it.
+"""
+
+import nose.tools as nt
+from nose.plugins.skip import SkipTest
+
+import ckan.plugins.toolkit as tk
+
+from ckanext.csvmetadata import datastore
+
+TABLE = u"csvmetadata-test-load"
+LOG_TABLE = u"csvmetadata-test-log"
+TRIGGER = u"csvmetadata_test_trigger"
+
+FIELDS = [{"id": u"nosaukums", "type": "text"},
+          {"id": u"skaits", "type": "numeric"},
+          {"id": u"datums", "type": "date"},
+          {"id": u"ir", "type": "bool"}]
+
+
+class StandinAPI(object):
+    """
+        ckanapi-like object whose datastore_search returns the given fields,
+        or raises if there are none, like the DataStore does for resources without a table.
+    """
+    def __init__(self, fields=None):
+        self.fields = fields
+        self.calls = []
+        self.action = self
+
+    def datastore_search(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.fields is None:
+            raise Exception("Resource not found")
+        return {"fields": self.fields, "records": []}
+
+
+class TestDatastoreColumns(object):
+
+    def test_fields_without_id(self):
+        api = StandinAPI([{"id": "_id", "type": "int"}, {"id": u"nosaukums", "type": "text"},
+                          {"id": u"skaits", "type": "int4"}, {"id": u"vieta"}])
+
+        nt.assert_equal(datastore.datastore_fields(api, "resource"),
+                        [(u"nosaukums", "text"), (u"skaits", "int4"), (u"vieta", "text")])
+        #Only the fields are asked for, not the rows
+        nt.assert_equal(api.calls, [{"resource_id": "resource", "limit": 0}])
+
+    def test_no_table(self):
+        nt.assert_is_none(datastore.datastore_fields(StandinAPI(), "resource"))
+        nt.assert_is_none(datastore.datastore_fields(StandinAPI([{"id": "_id", "type": "int"}]), "resource"))
+
+    def test_form_datatypes(self):
+        fields = [(u"a", "text"), (u"b", "numeric"), (u"c", "float8"), (u"d", "timestamp"),
+                  (u"e", "BOOL"), (u"f", "json")]
+
+        nt.assert_equal(datastore.field_values(fields),
+                        {"0-datatype": "string", "1-datatype": "decimal", "2-datatype": "double",
+                         "3-datatype": "dateTime", "4-datatype": "boolean", "5-datatype": "string"})
+
+    def test_csvw_columns_get_types_back(self):
+        csvw_dict = {"tableSchema": {"columns": [{"name": u"a", "datatype": {"base": "decimal"}},
+                                                 {"name": u"b", "datatype": "date"},
+                                                 {"name": u"c", "datatype": {"base": "anyURI"}},
+                                                 {"name": u"d"}]}}
+
+        nt.assert_equal(datastore.csvw_fields(csvw_dict),
+                        [{"id": u"a", "type": "numeric"}, {"id": u"b", "type": "date"},
+                         {"id": u"c", "type": "text"}, {"id": u"d", "type": "text"}])
+
+
+class TestReplaceRows(object):
+
+    @classmethod
+    def setup_class(cls):
+        try:
+            #The DataStore's own engine, from ckan.datastore.write_url of test.ini
+            cls.engine = datastore.get_write_engine()
+        except ImportError:
+            #The datastore plugin isn't installed, but its database might still be there
+            try:
+                import sqlalchemy
+            except ImportError:
+                raise SkipTest("No DataStore plugin or SQLAlchemy")
+            cls.engine = sqlalchemy.create_engine(tk.config["ckan.datastore.write_url"])
+        except Exception as e:
+            raise SkipTest("No DataStore database: {}".format(repr(e)))
+        try:
+            cls.engine.connect().close()
+        except Exception as e:
+            raise SkipTest("No DataStore database: {}".format(repr(e)))
+        cls.get_write_engine = datastore.get_write_engine
+        datastore.get_write_engine = lambda: cls.engine
+
+    @classmethod
+    def teardown_class(cls):
+        datastore.get_write_engine = cls.get_write_engine
+
+    def setup(self):
+        #An existing DataStore table, the way the DataStore creates it,
+        #with a trigger like the ones datastore_create sets that logs what it sees
+        with self.engine.begin() as connection:
+            self.drop(connection)
+            connection.execute(u'CREATE TABLE "{}" (_id serial PRIMARY KEY, _full_text tsvector, '
+                               u'"vecais" text)'.format(TABLE))
+            connection.execute(u'CREATE INDEX "{0}_idx" ON "{0}" USING gist (_full_text)'.format(TABLE))
+            connection.execute(u'CREATE TABLE "{}" (operation text, nosaukums text)'.format(LOG_TABLE))
+            connection.execute(u'CREATE FUNCTION "{}"() RETURNS trigger AS $$ BEGIN '
+                               u'INSERT INTO "{}" VALUES (TG_OP, to_json(NEW)->>\'nosaukums\'); RETURN NEW; '
+                               u'END; $$ LANGUAGE plpgsql'.format(TRIGGER, LOG_TABLE))
+            connection.execute(u'CREATE TRIGGER "{0}" BEFORE INSERT OR UPDATE ON "{1}" '
+                               u'FOR EACH ROW EXECUTE PROCEDURE "{0}"()'.format(TRIGGER, TABLE))
+            connection.execute(u'INSERT INTO "{}" ("vecais") VALUES (\'old row\')'.format(TABLE))
+            connection.execute(u'DELETE FROM "{}"'.format(LOG_TABLE))
+
+    def teardown(self):
+        with self.engine.begin() as connection:
+            self.drop(connection)
+
+    def drop(self, connection):
+        connection.execute(u'DROP TABLE IF EXISTS "{}"'.format(TABLE))
+        connection.execute(u'DROP TABLE IF EXISTS "{}"'.format(LOG_TABLE))
+        connection.execute(u'DROP FUNCTION IF EXISTS "{}"()'.format(TRIGGER))
+
+    def select(self, sql):
+        with self.engine.connect() as connection:
+            return [tuple(row) for row in connection.execute(sql.format(u'"{}"'.format(TABLE)))]
+
+    def comments(self):
+        """
+            Data columns of the table with their comments, in table order.
+        """
+        return self.select(u"SELECT attname, col_description(attrelid, attnum) FROM pg_attribute "
+                           u"WHERE attrelid = '{}'::regclass AND attnum > 0 AND NOT attisdropped "
+                           u"AND attname NOT IN ('_id', '_full_text') ORDER BY attnum".format(u'"{}"'.format(TABLE)))
+
+    def test_rows_are_loaded_with_types(self):
+        progress = []
+        rows = [[u"Rīga", u"1.5", u"2020-02-01", u"true"],
+                [u"Liepāja", u"", u"", u""],
+                [u"Ventspils", u"3"]]
+        loaded = datastore.replace_rows(TABLE, FIELDS, rows, chunk_rows=2, progress=progress.append)
+
+        nt.assert_equal(loaded, 3)
+        nt.assert_equal(progress, [2, 3])
+        result = self.select(u"SELECT nosaukums, skaits::text, datums::text, ir FROM {} ORDER BY _id")
+        nt.assert_equal(result, [(u"Rīga", u"1.5", u"2020-02-01", True),
+                                 (u"Liepāja", None, None, None),
+                                 (u"Ventspils", u"3", None, None)])
+        #Full text search works on the new rows
+        nt.assert_equal(self.select(u"SELECT count(*) FROM {} WHERE _full_text @@ to_tsquery('ventspils')"),
+                        [(1,)])
+
+    def test_failed_load_keeps_old_table(self):
+        #Latvian date format doesn't fit a date column
+        rows = [[u"Rīga", u"1", u"2020-02-01", u"true"]] * 3 + [[u"Cēsis", u"2", u"01.02.2020", u"false"]]
+        with nt.assert_raises(Exception):
+            datastore.replace_rows(TABLE, FIELDS, rows, chunk_rows=2)
+
+        nt.assert_equal(self.select(u"SELECT vecais FROM {}"), [(u"old row",)])
+
+    def test_load_can_be_repeated(self):
+        datastore.replace_rows(TABLE, FIELDS, [[u"a", u"1", u"", u""]])
+        datastore.replace_rows(TABLE, FIELDS, [[u"b", u"2", u"", u""], [u"c", u"3", u"", u""]])
+
+        nt.assert_equal(self.select(u"SELECT nosaukums FROM {} ORDER BY _id"), [(u"b",), (u"c",)])
+
+    def test_data_dictionary_triggers_and_indexes_are_kept(self):
+        datastore.replace_rows(TABLE, FIELDS, [[u"a", u"1", u"", u""]])
+        with self.engine.begin() as connection:
+            connection.execute(u'COMMENT ON COLUMN "{}".nosaukums IS \'{{"label": "Nosaukums"}}\''.format(TABLE))
+            connection.execute(u'CREATE INDEX "{0}_skaits" ON "{0}" (skaits)'.format(TABLE))
+            connection.execute(u'DELETE FROM "{}"'.format(LOG_TABLE))
+        #Type of a column changes
+        fields = [dict(field, type="float8") if field["id"] == u"skaits" else field for field in FIELDS]
+
+        datastore.replace_rows(TABLE, fields, [[u"b", u"2.5", u"", u""], [u"c", u"3", u"", u""]])
+
+        nt.assert_equal(self.comments()[0], (u"nosaukums", u'{"label": "Nosaukums"}'))
+        nt.assert_equal(self.select(u"SELECT skaits FROM {} ORDER BY _id"), [(2.5,), (3.0,)])
+        indexes = self.select(u"SELECT indexname FROM pg_indexes WHERE tablename = '{}' ORDER BY indexname".format(
+            TABLE))
+        nt.assert_equal(indexes, [(TABLE + u"_idx",), (TABLE + u"_pkey",), (TABLE + u"_skaits",)])
+        #The trigger saw each row as it was copied, and again when full text was filled in
+        with self.engine.connect() as connection:
+            log = [tuple(row) for row in connection.execute(u'SELECT * FROM "{}"'.format(LOG_TABLE))]
+        nt.assert_equal(sorted(log), [(u"INSERT", u"b"), (u"INSERT", u"c"), (u"UPDATE", u"b"), (u"UPDATE", u"c")])
+
+    def test_comments_of_remaining_columns_are_kept_when_columns_change(self):
+        datastore.replace_rows(TABLE, FIELDS, [[u"a", u"1", u"", u""]])
+        with self.engine.begin() as connection:
+            connection.execute(u'COMMENT ON COLUMN "{}".ir IS \'{{"label": "Ir"}}\''.format(TABLE))
+
+        datastore.replace_rows(TABLE, FIELDS[::-1], [[u"false", u"", u"2", u"b"]])
+
+        nt.assert_equal(self.comments(), [(u"ir", u'{"label": "Ir"}'), (u"datums", None), (u"skaits", None),
+                                  (u"nosaukums", None)])
+        nt.assert_equal(self.select(u"SELECT nosaukums, ir FROM {}"), [(u"b", False)])
@@ -0,0 +1,142 @@
+# encoding: utf-8
+
+import time
+
+import nose.tools as nt
+
+from ckanext.csvmetadata import failures
+from ckanext.csvmetadata.cache import LRUCache
+
+URL = "http://slow.example.com/data.csv"
+OTHER_URL = "http://slow.example.com/other.csv"
+
+
+class TestBreaker(object):
+
+    def setup(self):
+        self.settings = (failures.failure_cache, failures.breaker_cache, failures.failure_backoff,
+                         failures.breaker_threshold, failures.breaker_cooldown)
+        failures.failure_cache = LRUCache()
+        failures.breaker_cache = LRUCache()
+        #Backoff of single URLs is tested separately, here only the host's breaker holds requests back
+        failures.failure_backoff = 0
+        failures.breaker_threshold = 3
+        failures.breaker_cooldown = 60
+
+    def teardown(self):
+        (failures.failure_cache, failures.breaker_cache, failures.failure_backoff,
+         failures.breaker_threshold, failures.breaker_cooldown) = self.settings
+
+    def state(self):
+        breaker = failures.breaker_cache.get("slow.example.com")
+        return breaker["state"] if breaker is not None else "closed"
+
+    def cool_down(self):
+        breaker = failures.breaker_cache.get("slow.example.com")
+        failures.breaker_cache.set("slow.example.com", dict(breaker, retry_at=time.time() - 1))
+
+    def open_breaker(self):
+        for i in range(failures.breaker_threshold):
+            failures.record(URL, failures.HOST_FAILURE)
+
+    def test_opens_after_threshold_failures_in_a_row(self):
+        failures.record(URL, failures.HOST_FAILURE)
+        failures.record(URL, failures.HOST_FAILURE)
+        nt.assert_equal(self.state(), "closed")
+        nt.assert_is_none(failures.allow(URL))
+
+        failures.record(URL, failures.HOST_FAILURE)
+
+        nt.assert_equal(self.state(), "open")
+        reason = failures.allow(OTHER_URL)
+        nt.assert_equal(reason["reason"], "breaker")
+        nt.assert_equal(reason["failures"], 3)
+
+    def test_answers_reset_the_count(self):
+        failures.record(URL, failures.HOST_FAILURE)
+        failures.record(URL, failures.HOST_FAILURE)
+        #An error page is still an answer
+        failures.record(URL, "http_error_500")
+        failures.record(URL, failures.HOST_FAILURE)
+
+        nt.assert_equal(self.state(), "closed")
+        nt.assert_is_none(failures.allow(URL))
+
+    def test_single_trial_after_cooldown(self):
+        self.open_breaker()
+        self.cool_down()
+
+        nt.assert_is_none(failures.allow(URL))
+        nt.assert_equal(self.state(), "half_open")
+        #Other requests wait for the trial
+        nt.assert_equal(failures.allow(OTHER_URL)["reason"], "breaker")
+
+    def test_successful_trial_closes(self):
+        self.open_breaker()
+        self.cool_down()
+        failures.allow(URL)
+
+        failures.record(URL, "ok")
+
+        nt.assert_is_none(failures.breaker_cache.get("slow.example.com"))
+        nt.assert_is_none(failures.allow(OTHER_URL))
+
+    def test_failed_trial_opens_again(self):
+        self.open_breaker()
+        self.cool_down()
+        failures.allow(URL)
+
+        failures.record(URL, failures.HOST_FAILURE)
+
+        nt.assert_equal(self.state(), "open")
+        nt.assert_equal(failures.allow(URL)["failures"], 4)
+
+    def test_reset_closes(self):
+        self.open_breaker()
+
+        failures.reset(URL)
+
+        nt.assert_is_none(failures.allow(URL))
+
+    def test_zero_threshold_never_opens(self):
+        failures.breaker_threshold = 0
+        for i in range(10):
+            failures.record(URL, failures.HOST_FAILURE)
+
+        nt.assert_is_none(failures.allow(URL))
+
+
+class TestBackoff(object):
+
+    def setup(self):
+        self.settings = (failures.failure_cache, failures.breaker_cache, failures.failure_backoff,
+                         failures.failure_backoff_max, failures.breaker_threshold)
+        failures.failure_cache = LRUCache()
+        failures.breaker_cache = LRUCache()
+        failures.failure_backoff = 30
+        failures.failure_backoff_max = 100
+        failures.breaker_threshold = 0
+
+    def teardown(self):
+        (failures.failure_cache, failures.breaker_cache, failures.failure_backoff,
+         failures.failure_backoff_max, failures.breaker_threshold) = self.settings
+
+    def test_delay_doubles_up_to_the_maximum(self):
+        delays = []
+        for i in range(4):
+            started = time.time()
+            failures.record(URL, "http_error_404")
+            delays.append(round(failures.failure_cache.get(URL)["retry_at"] - started))
+
+        nt.assert_equal(delays, [30, 60, 100, 100])
+        reason = failures.allow(URL)
+        nt.assert_equal((reason["reason"], reason["status"], reason["failures"]), ("backoff", "http_error_404", 4))
+        nt.assert_is_none(failures.allow(OTHER_URL))
+
+    def test_success_forgets_failures(self):
+        failures.record(URL, "http_error_503")
+        failures.failure_cache.set(URL, dict(failures.failure_cache.get(URL), retry_at=time.time() - 1))
+
+        failures.record(URL, "ok")
+
+        nt.assert_is_none(failures.failure_cache.get(URL))
@@ -0,0 +1,113 @@
+# encoding: utf-8
+
+import time
+
+import nose.tools as nt
+
+from ckanext.csvmetadata import fetch
+from ckanext.csvmetadata.tests.helpers import StandinServer
+
+
+def slow(seconds):
+    def respond(request):
+        time.sleep(seconds)
+        return 200, {}, "a,b\r\n"
+    return respond
+
+
+class TestRunConcurrently(object):
+
+    def test_results_keep_the_order_of_calls(self):
+        results = fetch.run_concurrently([(lambda x: x * 2, (i,)) for i in range(10)], 5)
+
+        nt.assert_equal(results, [(i * 2, None) for i in range(10)])
+
+    def test_calls_from_the_pools_own_threads_run_inline(self):
+        def nested(i):
+            #Every pool thread waits for more calls to the same pool
+            return fetch.run_concurrently([(lambda: i, ())], 2)[0][0]
+        calls = [(nested, (i,)) for i in range(fetch.fetch_pool_size)]
+
+        nt.assert_equal(fetch.run_concurrently(calls, 5), [(i, None) for i in range(fetch.fetch_pool_size)])
+
+    def test_bulk_calls_run_in_their_own_pool(self):
+        def pool_name():
+            return fetch._local.pool
+        def fetch_from_bulk():
+            return pool_name(), fetch.run_concurrently([(pool_name, ())], 2)[0][0]
+
+        [(names, error)] = fetch.run_concurrently([(fetch_from_bulk, ())], 5, pool="bulk")
+
+        nt.assert_is_none(error)
+        nt.assert_equal(names, ("bulk", "fetch"))
+
+    def test_leftover_calls_free_the_pool_by_the_deadline(self):
+        with StandinServer(slow(3)) as server:
+            url = server.url("/slow.csv")
+            started = time.time()
+            #More calls than pool threads, so that some of them wait in the queue
+            results = fetch.run_concurrently([(fetch.http_get, (url,))] * (fetch.fetch_pool_size * 2), 0.5)
+            nt.assert_true(all(isinstance(exception, Exception) for result, exception in results))
+
+            #Pool threads don't wait for the slow server after the deadline
+            quick = fetch.run_concurrently([(lambda: "done", ())], 5)
+            nt.assert_equal(quick, [("done", None)])
+            nt.assert_less(time.time() - started, 1.5)
+
+    def test_timeout_cut_by_the_deadline_is_not_a_host_error(self):
+        deadline = fetch.Deadline(0.2)
+        with StandinServer(slow(2)) as server:
+            try:
+                fetch.bind_deadline(fetch.http_get, deadline)(server.url("/slow.csv"), timeout=10)
+            except Exception as e:
+                error = e
+
+        nt.assert_is_instance(error, fetch.DeadlinePassed)
+        nt.assert_false(isinstance(error, fetch.HOST_ERRORS))
+
+    def test_calls_queued_past_the_deadline_do_not_start(self):
+        started = []
+        deadline = fetch.Deadline(0)
+
+        with nt.assert_raises(fetch.DeadlinePassed):
+            fetch.bind_deadline(started.append, deadline)(1)
+        nt.assert_equal(started, [])
+
+
+class TestSession(object):
+
+    def setup(self):
+        self.settings = (fetch.http_pool_maxsize, fetch.http_pool_block, fetch.http_backoff_factor)
+
+    def teardown(self):
+        fetch.http_pool_maxsize, fetch.http_pool_block, fetch.http_backoff_factor = self.settings
+        fetch.set_session(None)
+
+    def test_unclosed_response_does_not_block_the_host(self):
+        fetch.configure({"csvmetadata.http_pool_maxsize": 1})
+        with StandinServer(lambda request: (200, {}, "a,b\r\n" * 100000)) as server:
+            leaked = fetch.http_get(server.url("/big.csv"), timeout=5, stream=True)
+            #In the pool, so that the test fails instead of hanging if the request waits for a connection
+            [(req, error)] = fetch.run_concurrently([(fetch.http_get, (server.url("/big.csv"),))], 2)
+            leaked.close()
+
+            nt.assert_equal(error, None)
+            nt.assert_equal(req.status_code, 200)
+
+    def test_server_errors_are_retried(self):
+        answers = [(503, {}, ""), (200, {}, "ok")]
+        with StandinServer(lambda request: answers.pop(0)) as server:
+            req = fetch.http_get(server.url("/flaky.csv"), timeout=5)
+
+            nt.assert_equal(req.text, "ok")
+            nt.assert_equal(len(server.requests), 2)
+
+    def test_failed_connections_are_not_retried(self):
+        fetch.configure({"csvmetadata.http_backoff_factor": 2})
+        with StandinServer(lambda request: (200, {}, "")) as server:
+            url = server.url("/gone.csv")
+        #The server is gone, its port refuses connections; retries would wait for the backoff
+        started = time.time()
+        with nt.assert_raises(fetch.HOST_ERRORS):
+            fetch.http_get(url, timeout=5)
+        nt.assert_less(time.time() - started, 1)
@@ -0,0 +1,114 @@
+# encoding: utf-8
+
+import os
+import json
+from collections import OrderedDict
+
+import nose.tools as nt
+
+from ckanext.csvmetadata import plugin
+from ckanext.csvmetadata.schema import DATATYPE_BOUNDS
+
+DATATYPES = ("string", "decimal", "date", "latitude", "longitude", "X", "Y", "boolean", "anyURI", "dateTime")
+
+PKG_DICT = {"title": u"Adreses", "tags": [{"name": "adreses"}], "license_url": "http://opendefinition.org/licenses/cc-zero/",
+            "organization": {"name": "vzd", "title": u"Valsts zemes dienests"}}
+RESOURCE = {"url": "http://example.com/adreses.csv", "created": "2020-01-02T10:00:00", "last_modified": None}
+
+
+def make_form(column_count):
+    #More than 10 columns, so that sorting the keys as strings puts "10-" before "2-"
+    headers = [u"kolonna {}".format(i) for i in range(column_count)]
+    form_data = {"csv_headers": repr(headers),
+                 "csv_info": repr({"delimiter": ";", "quoteChar": '"', "encoding": "utf-8"}),
+                 "csv_has_headers": ""}
+    for i in range(column_count):
+        form_data["{}-name".format(i)] = headers[i]
+        form_data["{}-titles".format(i)] = u"Kolonna {}".format(i)
+        form_data["{}-dc:description".format(i)] = u"Apraksts {}".format(i)
+        form_data["{}-datatype".format(i)] = DATATYPES[i % len(DATATYPES)]
+        form_data["{}-length".format(i)] = "2" if i == 1 else ""
+        form_data["{}-resource".format(i)] = "http://example.com/kodi.csv" if i % 3 == 0 else ""
+        form_data["{}-columnReference".format(i)] = "kods" if i % 3 == 0 else ""
+        if i % 2:
+            form_data["{}-required".format(i)] = ""
+        if i == 0:
+            form_data["{}-primaryKey".format(i)] = ""
+        if i % 3 == 0:
+            form_data["{}-foreignKeys".format(i)] = ""
+    return form_data
+
+
+def decode_previous(form_data, column_count, checkbox_ids):
+    """
+        How form_to_csvw built the columns before the form schema was compiled.
+    """
+    columns = [OrderedDict() for i in range(column_count)]
+    for key in sorted(form_data.keys()):
+        try:
+            header_num_str, form_field_name = key.split("-", 1)
+            header_num = int(header_num_str)
+        except ValueError:
+            continue
+        columns[header_num][form_field_name] = form_data[key]
+    for column in columns:
+        for checkbox_id in checkbox_ids:
+            if checkbox_id in column:
+                column[checkbox_id] = True
+        base = column.pop("datatype")
+        length = column.pop("length")
+        column["datatype"] = OrderedDict((("dc:title", base), ("base", base), ("length", length)))
+        if base in DATATYPE_BOUNDS:
+            column["datatype"]["base"], column["datatype"]["minimum"], column["datatype"]["maximum"] = \
+                DATATYPE_BOUNDS[base]
+        resource = column.pop("resource")
+        columnReference = column.pop("columnReference")
+        if "foreignKeys" in column:
+            column.pop("foreignKeys")
+            column["foreignKeys"] = [{"reference": OrderedDict((("resource", resource),
+                                                                ("columnReference", columnReference)))}]
+    order = [u'name', u'titles', u'dc:description', u'datatype', u'length', u'required', u'primaryKey', u'foreignKeys']
+    cmp = lambda x, y: 1 if x in order and y in order and order.index(x) > order.index(y) else -1
+    return [OrderedDict(sorted(column.items(), cmp=cmp, key=lambda x: x[0])) for column in columns]
+
+
+class TestFormToCSVW(object):
+
+    def setup(self):
+        self.settings = plugin.form_schema_path, plugin.ckan_site_url
+        plugin.form_schema_path = os.path.join(os.path.dirname(plugin.__file__), "form_schema.json")
+        plugin.ckan_site_url = "http://data.example.com"
+        self.controller = plugin.ResourceCSVController()
+
+    def teardown(self):
+        plugin.form_schema_path, plugin.ckan_site_url = self.settings
+
+    def form_to_csvw(self, form_data):
+        return self.controller.form_to_csvw(dict(form_data), PKG_DICT, RESOURCE, base_values={})
+
+    def test_columns_are_the_same_as_before(self):
+        form_data = make_form(12)
+        checkbox_ids = self.controller.get_form_schema().checkbox_ids
+        expected = decode_previous(form_data, 12, checkbox_ids)
+
+        columns = json.loads(self.form_to_csvw(form_data), object_pairs_hook=OrderedDict)["tableSchema"]["columns"]
+
+        nt.assert_equal([list(column.items()) for column in columns], [list(column.items()) for column in expected])
+
+    def test_csvw_to_form_and_back(self):
+        csvw_string = self.form_to_csvw(make_form(12))
+        csvw_dict = json.loads(csvw_string)
+        values = self.controller.csvw_to_form(csvw_dict)
+        form_data = self.controller.values_to_form([column["name"] for column in csvw_dict["tableSchema"]["columns"]],
+                                                   csvw_dict["dialect"], values)
+
+        nt.assert_equal(self.form_to_csvw(form_data), csvw_string)
+
+    def test_fields_of_missing_columns_are_ignored(self):
+        form_data = make_form(2)
+        form_data["5-name"] = u"nav"
+        form_data["x-name"] = u"nav"
+
+        columns = json.loads(self.form_to_csvw(form_data))["tableSchema"]["columns"]
+
+        nt.assert_equal([column["name"] for column in columns], [u"kolonna 0", u"kolonna 1"])
@@ -0,0 +1,55 @@
+# encoding: utf-8
+
+import os
+
+import nose.tools as nt
+
+from ckanext.csvmetadata import helpers, plugin
+from ckanext.csvmetadata.schema import FormSchema, load_json_file
+
+SCHEMA_PATH = os.path.join(os.path.dirname(plugin.__file__), "form_schema.json")
+
+
+class TestFormFields(object):
+
+    def setup(self):
+        self.settings = helpers.config, helpers.current_lang
+        helpers.config = {"ckan.locale_default": "lv"}
+        self.user_lang = "en"
+        helpers.current_lang = lambda: self.user_lang
+        #A schema of its own, so that fields cached by other tests don't count
+        self.form_schema = FormSchema(load_json_file(SCHEMA_PATH))
+
+    def teardown(self):
+        helpers.config, helpers.current_lang = self.settings
+
+    def labels(self, fields):
+        return [field["label"] for field in fields[:2]]
+
+    def test_fields_are_compiled_once_per_language(self):
+        fields = helpers.csvmetadata_form_fields(self.form_schema)
+
+        nt.assert_equal(self.labels(fields), [u"Name", u"Title"])
+        nt.assert_true(helpers.csvmetadata_form_fields(self.form_schema) is fields)
+        nt.assert_true(helpers.csvmetadata_form_fields(self.form_schema, "en") is fields)
+        self.user_lang = "lv"
+        nt.assert_equal(self.labels(helpers.csvmetadata_form_fields(self.form_schema)), [u"Nosaukums", u"Virsraksts"])
+        nt.assert_equal(sorted(self.form_schema._localized), [("en", "lv"), ("lv", "lv")])
+
+    def test_default_locale_is_part_of_the_key(self):
+        #No user language - labels are in the default one, which can be changed in the config
+        self.user_lang = None
+        in_latvian = helpers.csvmetadata_form_fields(self.form_schema)
+        helpers.config = {"ckan.locale_default": "en"}
+        in_english = helpers.csvmetadata_form_fields(self.form_schema)
+
+        nt.assert_equal(self.labels(in_latvian), [u"Nosaukums", u"Virsraksts"])
+        nt.assert_equal(self.labels(in_english), [u"Name", u"Title"])
+
+    def test_compiled_fields_are_read_only_and_have_choice_texts(self):
+        fields = helpers.csvmetadata_form_fields(self.form_schema)
+        datatype = [field for field in fields if field["name"] == "datatype"][0]
+
+        nt.assert_equal(datatype["choices"][0], {"value": "string", "text": u"string"})
+        with nt.assert_raises(TypeError):
+            fields[0]["label"] = u"Changed"
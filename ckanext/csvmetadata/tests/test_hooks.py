@@ -0,0 +1,123 @@
+# encoding: utf-8
+
+import time
+
+import nose.tools as nt
+
+from ckanext.csvmetadata import failures, jobs, packages, plugin
+from ckanext.csvmetadata.cache import LRUCache
+
+URL = "http://example.com/dati.csv"
+
+
+def csv_resource(resource_id="csv", url=URL, **extra):
+    return dict({"id": resource_id, "package_id": "package", "format": "CSV", "url": url}, **extra)
+
+
+class StandinUpload(object):
+    """
+        A file uploaded with the resource form, which isn't a string.
+    """
+    filename = "dati.csv"
+
+
+class TestHooks(object):
+
+    def setup(self):
+        self.settings = (jobs.enqueue, jobs.async_mode, plugin.prewarm_pages, plugin.ckan_api, plugin.sniff_cache,
+                         plugin.suggestion_cache, plugin.page_cache, failures.failure_cache, packages.package_cache)
+        self.queued = []
+        jobs.enqueue = lambda function, args, job_key, title=None: self.queued.append(job_key)
+        jobs.async_mode = "local"
+        plugin.prewarm_pages = True
+        plugin.sniff_cache = LRUCache()
+        plugin.suggestion_cache = LRUCache()
+        plugin.page_cache = LRUCache()
+        failures.failure_cache = LRUCache()
+        packages.package_cache = LRUCache()
+        self.plugin = plugin.CSVMetadataPlugin()
+
+    def teardown(self):
+        (jobs.enqueue, jobs.async_mode, plugin.prewarm_pages, plugin.ckan_api, plugin.sniff_cache,
+         plugin.suggestion_cache, plugin.page_cache, failures.failure_cache, packages.package_cache) = self.settings
+
+    def cache_package(self):
+        packages.package_cache.set("package", {"stamp": None, "cached": time.time(), "pkg_dict": {}, "index": None})
+
+    def test_only_csv_resources_are_prewarmed(self):
+        self.plugin.after_create({}, {"id": "package", "resources": [
+            csv_resource("csv-1"),
+            dict(csv_resource("json"), format="JSON"),
+            csv_resource("no-url", url=""),
+            csv_resource("csv-2")]})
+        self.plugin.after_update({}, dict(csv_resource("csv-3"), format="XLSX"))
+
+        nt.assert_equal(self.queued, ["prewarm:csv-1", "prewarm:csv-2"])
+
+    def test_package_updates_leave_resources_to_their_own_hooks(self):
+        self.cache_package()
+
+        self.plugin.after_update({}, {"id": "package", "resources": [csv_resource()]})
+
+        nt.assert_equal(self.queued, [])
+        nt.assert_is_none(packages.package_cache.get("package"))
+
+    def test_nothing_is_prewarmed_in_the_request(self):
+        jobs.async_mode = "off"
+        self.plugin.after_update({}, csv_resource())
+        jobs.async_mode = "local"
+        plugin.prewarm_pages = False
+        self.plugin.after_update({}, csv_resource())
+
+        nt.assert_equal(self.queued, [])
+
+    def test_linking_csvw_does_not_prewarm_again(self):
+        test = self
+
+        class StandinCKAN(object):
+            """
+                resource_patch that calls the hooks like CKAN's resource_update does.
+            """
+            def __init__(self):
+                self.action = self
+
+            def resource_patch(self, **kwargs):
+                resource = csv_resource(**kwargs)
+                test.plugin.before_update({}, csv_resource(), resource)
+                test.plugin.after_update({}, resource)
+                return resource
+
+        plugin.ckan_api = StandinCKAN()
+        self.cache_package()
+
+        plugin.ResourceCSVController().link_json_to_csv(csv_resource(), {"id": "json", "url": URL + ".json"})
+
+        nt.assert_equal(self.queued, [])
+        #The package did change
+        nt.assert_is_none(packages.package_cache.get("package"))
+        #Updates made by others are prewarmed again
+        self.plugin.after_update({}, csv_resource())
+        nt.assert_equal(self.queued, ["prewarm:csv"])
+
+    def test_new_file_drops_cached_data(self):
+        for cache in (plugin.sniff_cache, plugin.suggestion_cache, failures.failure_cache):
+            cache.set(URL, {"status": "ok"})
+        plugin.page_cache.set("csv", {"page_data": []})
+
+        #Only the description changes
+        self.plugin.before_update({}, csv_resource(), csv_resource(description=u"Apraksts", upload=""))
+        nt.assert_equal(plugin.sniff_cache.get(URL), {"status": "ok"})
+        nt.assert_is_not_none(plugin.page_cache.get("csv"))
+
+        #A new file under the same URL
+        self.plugin.before_update({}, csv_resource(), csv_resource(upload=StandinUpload()))
+        nt.assert_equal([cache.get(URL) for cache in (plugin.sniff_cache, plugin.suggestion_cache,
+                                                      failures.failure_cache)], [None, None, None])
+        nt.assert_is_none(plugin.page_cache.get("csv"))
+
+    def test_new_url_drops_cached_data_of_the_old_one(self):
+        plugin.sniff_cache.set(URL, {"status": "ok"})
+
+        self.plugin.before_update({}, csv_resource(), csv_resource(url="http://example.com/jauni.csv"))
+
+        nt.assert_is_none(plugin.sniff_cache.get(URL))
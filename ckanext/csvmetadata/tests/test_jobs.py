@@ -0,0 +1,108 @@
+# encoding: utf-8
+
+import pickle
+
+import nose.tools as nt
+
+import ckan.plugins.toolkit as tk
+
+from ckanext.csvmetadata import jobs, plugin
+from ckanext.csvmetadata.cache import LRUCache
+
+CSVW = u'{"url": "http://example.com/dati.csv"}'
+JSON_URL = "http://example.com/dataset/package/resource/json/download/dati_metadata.json"
+
+
+class StandinCKAN(object):
+    """
+        ckanapi-like object with the package and resource actions save_csvw calls,
+        which keeps (action, arguments) of every call.
+    """
+    def __init__(self, pkg_dict):
+        self.action = self
+        self.pkg_dict = pkg_dict
+        self.calls = []
+
+    def package_show(self, **kwargs):
+        self.calls.append(("package_show", kwargs))
+        return self.pkg_dict
+
+    def resource_create(self, **kwargs):
+        upload = kwargs["upload"]
+        self.calls.append(("resource_create", dict(kwargs, upload=(upload.name, upload.getvalue()))))
+        return {"id": "json", "url": JSON_URL}
+
+    def resource_patch(self, **kwargs):
+        if "upload" in kwargs:
+            upload = kwargs["upload"]
+            kwargs = dict(kwargs, upload=(upload.name, upload.getvalue()))
+        self.calls.append(("resource_patch", kwargs))
+        return {"id": kwargs["id"], "url": JSON_URL}
+
+
+def package(conforms_to=None, json_resource=False):
+    resources = [{"id": "csv", "format": "CSV", "url": "http://example.com/dati.csv", "conformsTo": conforms_to}]
+    if json_resource:
+        resources.append({"id": "json", "format": "JSON", "url_type": "upload",
+                          "url": JSON_URL})
+    return {"id": "package", "resources": resources}
+
+
+class TestSaveCSVW(object):
+
+    def setup(self):
+        self.settings = plugin.ckan_api, jobs.async_mode, jobs.job_status, getattr(tk, "enqueue_job", None)
+        jobs.job_status = LRUCache()
+
+    def teardown(self):
+        plugin.ckan_api, jobs.async_mode, jobs.job_status, enqueue_job = self.settings
+        if enqueue_job is None:
+            if hasattr(tk, "enqueue_job"):
+                del tk.enqueue_job
+        else:
+            tk.enqueue_job = enqueue_job
+
+    def test_new_csvw_is_created_and_linked(self):
+        plugin.ckan_api = StandinCKAN(package())
+
+        plugin.save_csvw("package", "csv", CSVW, "dati_metadata.json")
+
+        nt.assert_equal(plugin.ckan_api.calls, [
+            ("package_show", {"id": "package"}),
+            ("resource_create", {"package_id": "package", "name": "dati_metadata.json", "url": "",
+                                 "upload": ("dati_metadata.json", CSVW)}),
+            ("resource_patch", {"id": "csv", "conformsTo": JSON_URL})])
+
+    def test_replacing_linked_csvw_is_a_single_update(self):
+        pkg_dict = package(JSON_URL, True)
+        plugin.ckan_api = StandinCKAN(pkg_dict)
+
+        plugin.save_csvw("package", "csv", CSVW, "dati_metadata.json", pkg_dict)
+
+        nt.assert_equal(plugin.ckan_api.calls, [
+            ("resource_patch", {"id": "json", "url": "", "upload": ("dati_metadata.json", CSVW)})])
+
+    def test_linking_can_be_left_to_the_caller(self):
+        plugin.ckan_api = StandinCKAN(package())
+
+        json_resource = plugin.save_csvw("package", "csv", CSVW, "dati_metadata.json", link=False)
+
+        nt.assert_equal([action for action, kwargs in plugin.ckan_api.calls], ["package_show", "resource_create"])
+        nt.assert_equal(json_resource["id"], "json")
+
+    def test_queued_job_payload_survives_pickling(self):
+        #CKAN job queue pickles what it's given, a worker process unpickles and runs it
+        queued = []
+        tk.enqueue_job = lambda function, args, title=None: queued.append(pickle.dumps((function, args)))
+        jobs.async_mode = "ckan"
+        #Background jobs look the package up themselves
+        jobs.enqueue(plugin.save_csvw, ("package", "csv", CSVW, "dati_metadata.json", None), "csv")
+
+        nt.assert_equal(jobs.get_status("csv")["status"], "pending")
+        plugin.ckan_api = StandinCKAN(package())
+        function, args = pickle.loads(queued[0])
+        function(*args)
+
+        nt.assert_equal(jobs.get_status("csv")["status"], "done")
+        nt.assert_equal([action for action, kwargs in plugin.ckan_api.calls],
+                        ["package_show", "resource_create", "resource_patch"])
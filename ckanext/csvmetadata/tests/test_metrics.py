@@ -0,0 +1,107 @@
+# encoding: utf-8
+
+import socket
+import threading
+
+import nose.tools as nt
+
+from ckanext.csvmetadata import metrics
+from ckanext.csvmetadata.cache import LRUCache
+
+
+def timed(name):
+    with metrics.stage(name):
+        pass
+
+
+class TestStages(object):
+
+    def setup(self):
+        self.settings = (metrics.metrics_enabled, metrics.statsd_address, metrics.statsd_prefix,
+                         metrics._statsd_socket, metrics._statsd_target)
+        metrics.reset()
+        metrics.end_request()
+
+    def teardown(self):
+        (metrics.metrics_enabled, metrics.statsd_address, metrics.statsd_prefix,
+         metrics._statsd_socket, metrics._statsd_target) = self.settings
+        metrics.reset()
+        metrics.end_request()
+
+    def lines(self, **kwargs):
+        return metrics.render_prometheus(**kwargs).splitlines()
+
+    def test_stage_outcomes_and_bytes_are_counted(self):
+        with metrics.stage("csv_sample") as timer:
+            timer.bytes = 5000
+            timer.outcome = "not_csv"
+        with nt.assert_raises(IOError):
+            with metrics.stage("csv_sample"):
+                raise IOError("Connection refused")
+
+        lines = self.lines()
+        nt.assert_in('csvmetadata_stage_total{outcome="not_csv",stage="csv_sample"} 1', lines)
+        nt.assert_in('csvmetadata_stage_total{outcome="error",stage="csv_sample"} 1', lines)
+        nt.assert_in('csvmetadata_stage_seconds_count{outcome="error",stage="csv_sample"} 1', lines)
+        #Buckets are cumulative
+        nt.assert_in('csvmetadata_stage_bytes_bucket{stage="csv_sample",le="4096.0"} 0', lines)
+        nt.assert_in('csvmetadata_stage_bytes_bucket{stage="csv_sample",le="16384.0"} 1', lines)
+        nt.assert_in('csvmetadata_stage_bytes_bucket{stage="csv_sample",le="+Inf"} 1', lines)
+        nt.assert_in('csvmetadata_stage_bytes_sum{stage="csv_sample"} 5000.0', lines)
+
+    def test_labels_and_cache_counters_are_exported(self):
+        metrics.increment("csvmetadata_short_circuit_total", reason='say "no"\\')
+        cache = LRUCache()
+        cache.count("misses")
+
+        lines = self.lines(caches={"sniff": cache})
+
+        nt.assert_in('csvmetadata_short_circuit_total{reason="say \\"no\\"\\\\"} 1', lines)
+        nt.assert_in('csvmetadata_cache_events_total{cache="sniff",event="misses"} 1', lines)
+        nt.assert_in("# TYPE csvmetadata_stage_seconds histogram", lines)
+
+    def test_disabled_metrics_only_time_the_stage(self):
+        metrics.metrics_enabled = False
+        with metrics.stage("form_schema") as timer:
+            pass
+
+        nt.assert_is_not_none(timer.seconds)
+        nt.assert_false([line for line in self.lines() if not line.startswith("#")])
+
+    def test_server_timing_includes_stages_of_pool_threads(self):
+        metrics.begin_request()
+        with metrics.stage("package_show"):
+            pass
+        thread = threading.Thread(target=metrics.bind(timed), args=("fetch_json",))
+        thread.start()
+        thread.join()
+        #Stages of threads that don't work for the request aren't included
+        other = threading.Thread(target=timed, args=("other",))
+        other.start()
+        other.join()
+
+        header = metrics.server_timing_header(metrics.end_request())
+
+        nt.assert_equal([part.split(";")[0] for part in header.split(", ")], ["package_show", "fetch_json"])
+        nt.assert_true(header.endswith(';desc="ok"'))
+        nt.assert_equal(metrics.end_request(), [])
+
+    def test_statsd_lines(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(5)
+        try:
+            metrics.configure({"csvmetadata.statsd_address": "127.0.0.1:{}".format(receiver.getsockname()[1]),
+                               "csvmetadata.statsd_prefix": "opendata"})
+            with metrics.stage("csv_sample") as timer:
+                timer.bytes = 100
+                timer.outcome = "http_error_404"
+
+            timing = receiver.recv(1024)
+            counter = receiver.recv(1024)
+        finally:
+            receiver.close()
+            metrics._statsd_socket.close()
+
+        nt.assert_regexp_matches(timing, r"^opendata\.csv_sample\.http_error_404:\d+\.\d{3}\|ms$")
+        nt.assert_equal(counter, b"opendata.csv_sample.bytes:100|c")
@@ -0,0 +1,100 @@
+# encoding: utf-8
+
+import time
+
+import nose.tools as nt
+
+from ckanext.csvmetadata import packages, plugin
+from ckanext.csvmetadata.cache import LRUCache
+from ckanext.csvmetadata.packages import ResourceIndex
+
+DOWNLOAD = "http://example.com/dataset/package/resource/{}/download/{}"
+
+
+def json_resource(resource_id, filename, url_type="upload"):
+    return {"id": resource_id, "format": "JSON", "url_type": url_type, "url": DOWNLOAD.format(resource_id, filename)}
+
+
+def package():
+    return {"id": "package", "resources": [
+        {"id": "linked", "format": "CSV", "url": "http://example.com/linked.csv",
+         "conformsTo": DOWNLOAD.format("json-1", "linked_metadata.json")},
+        {"id": "by-name", "format": "CSV", "url": "http://example.com/by-name.csv"},
+        {"id": "gone", "format": "CSV", "url": "http://example.com/gone.csv",
+         "conformsTo": "http://example.com/elsewhere.json"},
+        {"id": "none", "format": "CSV", "url": "http://example.com/none.csv"},
+        json_resource("json-1", "linked_metadata.json"),
+        json_resource("json-2", "by-name_metadata.json", url_type=None),
+        #Older version of the same file, the first one wins like before
+        json_resource("json-3", "by-name_metadata.json"),
+        #Not JSON, even though the filename fits
+        {"id": "text", "format": "TXT", "url": DOWNLOAD.format("text", "none_metadata.json")},
+    ]}
+
+
+class TestResourceIndex(object):
+
+    def setup(self):
+        self.controller = plugin.ResourceCSVController()
+
+    def index(self, pkg_dict):
+        return ResourceIndex(pkg_dict, self.controller.filename_from_url)
+
+    def test_lookups(self):
+        pkg_dict = package()
+        index = self.index(pkg_dict)
+
+        nt.assert_equal(sorted(index.by_id), sorted(resource["id"] for resource in pkg_dict["resources"]))
+        nt.assert_equal(index.by_url["http://example.com/none.csv"]["id"], "none")
+        nt.assert_equal(index.json_by_filename["by-name_metadata.json"]["id"], "json-2")
+        nt.assert_not_in("none_metadata.json", index.json_by_filename)
+        nt.assert_not_in("http://example.com/none.csv", index.json_by_url)
+
+    def test_csvw_files_are_found_for_resources(self):
+        pkg_dict = package()
+        found = dict((resource["id"], self.controller.find_existing_json_for_resource(resource, pkg_dict))
+                     for resource in pkg_dict["resources"] if resource["format"] == "CSV")
+
+        nt.assert_equal(found, {
+            "linked": (DOWNLOAD.format("json-1", "linked_metadata.json"), "upload", "json-1"),
+            "by-name": (DOWNLOAD.format("json-2", "by-name_metadata.json"), None, "json-2"),
+            #Linked to a file that isn't a resource of the package
+            "gone": ("http://example.com/elsewhere.json", None, None),
+            "none": (None, None, None)})
+
+    def test_controller_builds_the_index_once_per_package_dict(self):
+        pkg_dict = package()
+        index = self.controller.get_resource_index(pkg_dict)
+
+        nt.assert_true(self.controller.get_resource_index(pkg_dict) is index)
+        nt.assert_false(self.controller.get_resource_index(package()) is index)
+
+
+class TestCachedPackageIndex(object):
+
+    def setup(self):
+        self.package_cache = packages.package_cache
+        packages.package_cache = LRUCache()
+        self.filename_from_url = plugin.ResourceCSVController().filename_from_url
+
+    def teardown(self):
+        packages.package_cache = self.package_cache
+
+    def test_index_is_kept_with_the_cached_package_dict(self):
+        pkg_dict = package()
+        packages.package_cache.set("package", {"stamp": None, "cached": time.time(), "pkg_dict": pkg_dict,
+                                               "index": None})
+
+        index = packages.resource_index(pkg_dict, self.filename_from_url)
+
+        nt.assert_true(packages.resource_index(pkg_dict, self.filename_from_url) is index)
+        #Another dict of the same package isn't the cached one
+        nt.assert_false(packages.resource_index(package(), self.filename_from_url) is index)
+
+    def test_resource_changes_drop_the_package(self):
+        packages.package_cache.set("package", {"stamp": None, "cached": time.time(), "pkg_dict": package(),
+                                               "index": None})
+
+        packages.forget({"id": "by-name", "package_id": "package", "url": "http://example.com/new.csv"})
+
+        nt.assert_is_none(packages.package_cache.get("package"))
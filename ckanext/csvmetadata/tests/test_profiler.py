@@ -0,0 +1,32 @@
+# encoding: utf-8
+
+import nose.tools as nt
+
+from ckanext.csvmetadata.profiler import profile_rows
+
+HEADERS = [u"kods", u"nosaukums", u"lat", u"datums", u"skaits"]
+
+ROWS = [[u"LV0001", u"Rīga", u"56.946000", u"2020-02-01", u"10"],
+        [u"LV0002", u"Cēsis", u"57.312000", u"2020-02-02", u"12"],
+        [u"LV0003", u"Ogre", u"56.816000", u"2020-02-03", u"14"]]
+
+
+class TestSuggestions(object):
+
+    def setup(self):
+        self.values = profile_rows(ROWS, HEADERS, skip_header=False).suggestions()
+
+    def test_length_is_suggested_for_fixed_width_strings(self):
+        nt.assert_equal(self.values["0-datatype"], "string")
+        nt.assert_equal(self.values["0-length"], u"6")
+        nt.assert_true("1-length" not in self.values)
+
+    def test_length_is_not_suggested_for_other_types(self):
+        nt.assert_equal(self.values["2-datatype"], "latitude")
+        nt.assert_equal(self.values["3-datatype"], "date")
+        for i in (2, 3, 4):
+            nt.assert_true("{}-length".format(i) not in self.values)
+
+    def test_first_unique_column_is_the_primary_key(self):
+        nt.assert_true(self.values["0-primaryKey"])
+        nt.assert_equal([key for key in self.values if key.endswith("-primaryKey")], ["0-primaryKey"])
@@ -0,0 +1,64 @@
+# encoding: utf-8
+
+import os
+import tempfile
+
+import nose.tools as nt
+
+from ckanext.csvmetadata import ranges
+
+DIALECT = {"delimiter": ",", "quoteChar": '"', "encoding": "utf-8"}
+
+
+def record(i):
+    return u'{},"Iela {}\nRīga","x"\n'.format(i, i).encode("utf-8")
+
+
+class TestRealign(object):
+
+    def setup(self):
+        self.content = b"".join(record(i) for i in range(100))
+
+    def test_window_starting_inside_quotes(self):
+        #Cut right after the line break inside the quoted address
+        start = self.content.index(b"\n", len(b"".join(record(i) for i in range(10)))) + 1
+        rows = ranges.realign(self.content[start:start + 500], DIALECT, 3)
+
+        nt.assert_true(rows)
+        nt.assert_true(all(len(row) == 3 for row in rows))
+        nt.assert_equal(rows[0][0], u"11")
+        nt.assert_equal(rows[0][1], u"Iela 11\nRīga")
+
+    def test_window_starting_between_records(self):
+        start = len(b"".join(record(i) for i in range(10)))
+        rows = ranges.realign(self.content[start + 3:start + 500], DIALECT, 3)
+
+        nt.assert_equal([row[0] for row in rows[:2]], [u"11", u"12"])
+
+    def test_windows_at_both_ends_keep_their_records(self):
+        rows = ranges.realign(self.content, DIALECT, 3, at_start=True, at_end=True)
+
+        nt.assert_equal(len(rows), 100)
+
+
+class TestSampleRows(object):
+
+    def setup(self):
+        fd, self.path = tempfile.mkstemp(suffix=".csv")
+        with os.fdopen(fd, "wb") as f:
+            f.write(b'id,address,flag\n')
+            for i in range(20000):
+                f.write(record(i))
+
+    def teardown(self):
+        os.remove(self.path)
+
+    def test_windows_are_read_from_all_over_the_file(self):
+        sample = ranges.sample_rows(ranges.FileSource(self.path), DIALECT, 3, windows=4, window_size=4096)
+
+        nt.assert_true(sample.ranged)
+        nt.assert_false(sample.complete)
+        nt.assert_equal(sample.bytes_read, 4 * 4096)
+        nt.assert_equal(sample.rows[0], [u"id", u"address", u"flag"])
+        nt.assert_true(all(len(row) == 3 for row in sample.rows))
+        nt.assert_equal(sample.rows[-1][0], u"19999")
@@ -0,0 +1,61 @@
+# encoding: utf-8
+
+import os
+import shutil
+import tempfile
+
+import nose.tools as nt
+
+from ckanext.csvmetadata import refindex
+from ckanext.csvmetadata.ranges import FileSource
+
+DIALECT = {"delimiter": ",", "quoteChar": '"', "encoding": "utf-8"}
+URL = "http://example.com/codes.csv"
+
+
+class TestReferenceIndex(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.index_path = refindex.reference_index_path
+        refindex.reference_index_path = os.path.join(self.directory, "references")
+        self.path = os.path.join(self.directory, "codes.csv")
+        #Longer than the 64 KB at each end the index used to compare
+        self.write(["code"] + ["{:06d}".format(i) for i in range(30000)])
+
+    def teardown(self):
+        refindex.reference_index_path = self.index_path
+        shutil.rmtree(self.directory)
+
+    def write(self, lines, mode="wb"):
+        with open(self.path, mode) as f:
+            f.write("".join(line + "\n" for line in lines))
+
+    def keys(self):
+        return refindex.load_keys(refindex.get_reference_index(URL, "code", DIALECT, FileSource(self.path)))
+
+    def has(self, value):
+        return refindex.contains(self.keys(), refindex.key_hash([value]))
+
+    def test_edit_in_the_middle_is_noticed(self):
+        nt.assert_true(self.has(u"015000"))
+        with open(self.path, "r+b") as f:
+            f.seek(len("code\n") + 15000 * 7)
+            f.write("ABCDEF")
+
+        nt.assert_false(self.has(u"015000"))
+        nt.assert_true(self.has(u"ABCDEF"))
+
+    def test_appended_rows_are_added(self):
+        nt.assert_false(self.has(u"X1"))
+        self.write(["X1"], mode="ab")
+
+        nt.assert_true(self.has(u"X1"))
+        nt.assert_true(self.has(u"000001"))
+
+    def test_unchanged_file_is_not_read_again(self):
+        self.keys()
+        source = FileSource(self.path)
+        source.open = None
+
+        refindex.get_reference_index(URL, "code", DIALECT, source)
@@ -0,0 +1,62 @@
+# encoding: utf-8
+
+import os
+import shutil
+import tempfile
+
+import nose.tools as nt
+
+from ckanext.csvmetadata import plugin, schema
+
+
+class TestFormSchemaCache(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "form_schema.json")
+        with open(os.path.join(os.path.dirname(plugin.__file__), "form_schema.json"), "rb") as f:
+            self.content = f.read()
+        self.write(self.content)
+
+    def teardown(self):
+        schema._schema_cache.pop(self.path, None)
+        shutil.rmtree(self.directory)
+
+    def write(self, content, mtime=None):
+        #Written in place, so the inode stays the same
+        with open(self.path, "wb") as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_unchanged_file_is_not_read_again(self):
+        form_schema = schema.load_form_schema(self.path)
+
+        nt.assert_true(schema.load_form_schema(self.path) is form_schema)
+
+    def test_modified_file_is_read_again(self):
+        form_schema = schema.load_form_schema(self.path)
+        #Same size, newer modification time
+        self.write(self.content.replace(b'"en": "Name"', b'"en": "Nome"'), os.stat(self.path).st_mtime + 10)
+
+        reloaded = schema.load_form_schema(self.path)
+
+        nt.assert_false(reloaded is form_schema)
+        nt.assert_equal(reloaded.form_fields[0]["label"]["en"], u"Nome")
+
+    def test_file_of_another_size_is_read_again(self):
+        form_schema = schema.load_form_schema(self.path)
+        mtime = os.stat(self.path).st_mtime
+        #Edited within the same second, which coarse file system timestamps don't tell apart
+        self.write(self.content.replace(b'"en": "Title"', b'"en": "Headline"'), mtime)
+
+        reloaded = schema.load_form_schema(self.path)
+
+        nt.assert_false(reloaded is form_schema)
+        nt.assert_equal(reloaded.form_fields[1]["label"]["en"], u"Headline")
+
+    def test_broken_file_raises_instead_of_serving_the_old_schema(self):
+        schema.load_form_schema(self.path)
+        self.write(self.content[:100], os.stat(self.path).st_mtime + 10)
+
+        nt.assert_raises(Exception, schema.load_form_schema, self.path)
@@ -0,0 +1,92 @@
+# encoding: utf-8
+
+import os
+import shutil
+import tempfile
+
+import nose.tools as nt
+
+from ckanext.csvmetadata import plugin, ranges, storage
+from ckanext.csvmetadata.tests.helpers import StandinServer
+
+CONTENT = b"id;nosaukums\r\n1;R\xc4\xabga\r\n"
+
+
+class StandinUploader(object):
+    """
+        The local filestore uploader, which takes keys out of the resource it's given.
+        Keeps files in directory and url_types of the resources it was made for in calls.
+    """
+    directory = None
+    calls = []
+
+    def __init__(self, resource):
+        self.calls.append(resource.pop("url_type"))
+
+    def get_path(self, resource_id):
+        if resource_id == "broken":
+            raise IOError("No storage path")
+        return os.path.join(self.directory, resource_id[:3], resource_id[3:6], resource_id[6:])
+
+
+class TestLocalUploadPath(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = storage.get_resource_uploader, plugin.ckan_api_key
+        StandinUploader.directory = self.directory
+        StandinUploader.calls = []
+        storage.get_resource_uploader = StandinUploader
+        plugin.ckan_api_key = "api-key"
+        os.makedirs(os.path.join(self.directory, "abc", "def"))
+        with open(os.path.join(self.directory, "abc", "def", "123"), "wb") as f:
+            f.write(CONTENT)
+
+    def teardown(self):
+        storage.get_resource_uploader, plugin.ckan_api_key = self.settings
+        shutil.rmtree(self.directory)
+
+    def resource(self, resource_id, url="http://example.com/dati.csv", url_type="upload"):
+        return {"id": resource_id, "url": url, "url_type": url_type}
+
+    def test_uploaded_file_in_the_filestore(self):
+        resource = self.resource("abcdef123")
+
+        nt.assert_equal(storage.local_upload_path(resource), os.path.join(self.directory, "abc", "def", "123"))
+        #The uploader gets a copy
+        nt.assert_equal(resource["url_type"], "upload")
+
+    def test_link_resources_and_missing_files_have_no_path(self):
+        nt.assert_is_none(storage.local_upload_path(self.resource("abcdef123", url_type="")))
+        nt.assert_is_none(storage.local_upload_path(self.resource("abcdef999")))
+        nt.assert_is_none(storage.local_upload_path(self.resource("broken")))
+        nt.assert_is_none(storage.local_upload_path(None))
+        #Link resources don't even get to the uploader
+        nt.assert_equal(StandinUploader.calls, ["upload", "upload"])
+
+    def test_filestore_file_is_read_without_downloading(self):
+        controller = plugin.ResourceCSVController()
+        resource = self.resource("abcdef123", url="http://127.0.0.1:9/nowhere.csv")
+
+        stream = controller.open_csv_stream(resource["url"], "upload", resource)
+        try:
+            nt.assert_equal(stream.read(), CONTENT)
+        finally:
+            stream.close()
+        nt.assert_true(isinstance(controller.open_csv_source(resource["url"], "upload", resource),
+                                  ranges.FileSource))
+
+    def test_uploaded_file_missing_from_the_filestore_is_downloaded(self):
+        controller = plugin.ResourceCSVController()
+        with StandinServer(lambda request: (200, {"Content-Type": "text/csv"}, CONTENT)) as server:
+            resource = self.resource("abcdef999", url=server.url("/dati.csv"))
+            stream = controller.open_csv_stream(resource["url"], "upload", resource)
+            try:
+                content = stream.read()
+            finally:
+                stream.close()
+            sent = server.requests
+
+        nt.assert_equal(content, CONTENT)
+        #Uploads of private datasets need the API key
+        nt.assert_equal([(path, headers.get("authorization")) for path, headers in sent], [("/dati.csv", "api-key")])
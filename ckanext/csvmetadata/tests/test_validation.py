@@ -0,0 +1,159 @@
+# encoding: utf-8
+
+import os
+import tempfile
+from io import BytesIO
+
+import nose.tools as nt
+
+import ckan.plugins.toolkit as tk
+
+from ckanext.csvmetadata import actions, jobs, plugin, validation
+from ckanext.csvmetadata.cache import LRUCache
+
+CSVW = {"dialect": {"delimiter": ";", "quoteChar": '"', "encoding": "utf-8", "header": True},
+        "tableSchema": {"columns": [
+            {"name": "id", "datatype": {"base": "decimal"}, "primaryKey": True, "required": True},
+            {"name": "code", "datatype": {"base": "string", "length": 2}},
+            {"name": "note", "datatype": {"base": "string"}}]}}
+
+
+class TestValidateFile(object):
+
+    def setup(self):
+        rows = [u"id;code;note"]
+        for i in range(1, 2001):
+            if i % 250 == 0:
+                rows.append(u'{};abc;"Rīga\r\nline two"'.format(i))
+            elif i % 400 == 0:
+                rows.append(u"x{};LV;ok".format(i))
+            else:
+                rows.append(u"{};LV;ok".format(i))
+        #A key that is already used, in the last chunk
+        rows.append(u"7;LV;duplicate")
+        fd, self.path = tempfile.mkstemp(suffix=".csv")
+        with os.fdopen(fd, "wb") as f:
+            f.write(u"\r\n".join(rows).encode("utf-8") + b"\r\n")
+
+    def teardown(self):
+        os.remove(self.path)
+
+    def check(self, report):
+        nt.assert_equal(report["rows"], 2001)
+        nt.assert_true(report["complete"])
+        nt.assert_equal(report["columns"][0]["errors"], {"datatype": 4})
+        nt.assert_equal(report["columns"][1]["errors"], {"length": 8})
+        nt.assert_equal(report["duplicate_keys"], 1)
+        nt.assert_equal(report["errors"], 13)
+
+    def test_chunks_in_process(self):
+        report = validation.validate_file(self.path, CSVW, processes=1, chunk_size=4096)
+
+        nt.assert_greater(report["chunks"], 1)
+        self.check(report)
+
+    def test_chunks_in_worker_processes_give_the_same_report(self):
+        in_process = validation.validate_file(self.path, CSVW, processes=1, chunk_size=4096)
+        parallel = validation.validate_file(self.path, CSVW, processes=3, chunk_size=4096)
+
+        self.check(parallel)
+        del in_process["seconds"], parallel["seconds"]
+        nt.assert_equal(parallel, in_process)
+
+
+class TestValuePatterns(object):
+
+    def check(self, base, valid, invalid):
+        pattern = validation.VALUE_PATTERNS[base]
+        nt.assert_equal([value for value in valid if not pattern.match(value)], [])
+        nt.assert_equal([value for value in invalid if pattern.match(value)], [])
+
+    def test_boolean(self):
+        self.check("boolean", [u"true", u"false", u"1", u"0"], [u"True", u"yes", u"2"])
+
+    def test_double(self):
+        self.check("double", [u"1", u"-1.5E3", u".5", u"INF", u"-INF", u"+INF", u"NaN"],
+                   [u"inf", u"nan", u"1,5", u"e3"])
+        self.check("float", [u"INF", u"1e-3"], [u"INF1"])
+
+    def test_integer_signs(self):
+        self.check("integer", [u"-12", u"+0", u"7"], [u"1.0", u""])
+        self.check("nonNegativeInteger", [u"0", u"+3", u"-0"], [u"-1"])
+        self.check("positiveInteger", [u"1", u"007"], [u"0", u"-1"])
+        self.check("negativeInteger", [u"-1"], [u"0", u"-0"])
+
+    def test_dates(self):
+        self.check("date", [u"2020-02-29", u"2020-01-01Z", u"-0044-03-15+01:00"], [u"2020-13-01", u"20-01-01"])
+        self.check("dateTime", [u"2020-01-01T10:00:00", u"2020-01-01T24:00:00Z", u"2020-01-01T10:00:00.25+02:00"],
+                   [u"2020-01-01 10:00:00", u"2020-01-01T10:00"])
+
+    def test_relative_and_mailto_uris(self):
+        self.check("anyURI", [u"http://example.com/a?b=1#c", u"mailto:info@example.com", u"../dati.csv", u"#c",
+                              u"", u"http://example.com/Rīga"],
+                   [u"http://example.com/a b", u"<http://example.com/>"])
+
+
+class StandinCKAN(object):
+    """
+        The resource_show and package_show actions validate_resource calls.
+    """
+    def __init__(self, resource):
+        self.action = self
+        self.resource = resource
+
+    def resource_show(self, id):
+        return self.resource
+
+    def package_show(self, id):
+        return {"id": "package", "resources": [self.resource]}
+
+
+class TestValidateResourceInRequest(object):
+
+    def setup(self):
+        self.settings = (plugin.ckan_api, jobs.async_mode, validation.validation_sync_max_bytes,
+                         validation.validation_reports)
+        self.methods = dict((name, getattr(plugin.ResourceCSVController, name))
+                            for name in ("find_existing_json_for_resource", "fetch_json_return_values",
+                                         "open_csv_stream"))
+        self.resource = {"id": "resource", "package_id": "package", "url": "http://example.com/data.csv"}
+        plugin.ckan_api = StandinCKAN(self.resource)
+        jobs.async_mode = "off"
+        validation.validation_sync_max_bytes = 1000
+        validation.validation_reports = LRUCache()
+        content = u"id;code;note\r\n".encode("utf-8") + b"".join(
+            u"{};LV;ok\r\n".format(i).encode("utf-8") for i in range(1, 101))
+        plugin.ResourceCSVController.find_existing_json_for_resource = \
+            lambda controller, resource, pkg_dict: ("http://example.com/data.csv.json", None, None)
+        plugin.ResourceCSVController.fetch_json_return_values = lambda controller, url, url_type, json_id: CSVW
+        plugin.ResourceCSVController.open_csv_stream = \
+            lambda controller, url, url_type=None, resource=None: BytesIO(content)
+
+    def teardown(self):
+        (plugin.ckan_api, jobs.async_mode, validation.validation_sync_max_bytes,
+         validation.validation_reports) = self.settings
+        for name, method in self.methods.items():
+            setattr(plugin.ResourceCSVController, name, method)
+
+    def test_remote_file_over_the_limit_is_refused(self):
+        nt.assert_raises(tk.ValidationError, actions.validate_resource, "resource")
+        nt.assert_is_none(validation.validation_reports.get("resource"))
+
+    def test_declared_size_over_the_limit_is_refused_before_downloading(self):
+        self.resource["size"] = 5000
+        plugin.ResourceCSVController.open_csv_stream = None
+
+        nt.assert_raises(tk.ValidationError, actions.validate_resource, "resource")
+
+    def test_remote_file_under_the_limit_is_validated(self):
+        validation.validation_sync_max_bytes = 10000
+
+        report = actions.validate_resource("resource")
+
+        nt.assert_equal(report["rows"], 100)
+        nt.assert_equal(report["errors"], 0)
+
+    def test_no_limit_in_the_background(self):
+        jobs.async_mode = "ckan"
+
+        nt.assert_equal(actions.validate_resource("resource")["rows"], 100)
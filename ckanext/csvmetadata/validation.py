@@ -0,0 +1,416 @@
+# encoding: utf-8
+
+import os
+import re
+import time
+import heapq
+from itertools import islice, izip
+import logging
+import multiprocessing
+from array import array
+
+from cache import make_cache
+from csv_unicode import CSVStreamReader, detect_encoding, ascii_compatible, detection_sample_size
+from sniffing import record_ends
+from profiler import np
+from refindex import key_hash, contains, load_keys, KEY_TYPECODE
+
+log = logging.getLogger(__name__)
+
+#Lexical spaces of XML Schema datatypes, which CSVW base datatypes are
+#Unlike profiler's TYPE_REGEXES, that only guess what a column is, these accept every valid spelling:
+#1 and 0 booleans, INF and NaN doubles, relative and mailto: URIs
+_INTEGER = r"[+-]?\d+"
+_NON_NEGATIVE = r"\+?\d+|-0+"
+_NON_POSITIVE = r"-\d+|\+?0+"
+_DOUBLE = r"[+-]?((\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?|INF)|NaN"
+_DATE = r"-?([1-9]\d{3,}|0\d{3})-(0[1-9]|1[0-2])-(0[1-9]|[12]\d|3[01])"
+_TIME = r"(([01]\d|2[0-3]):[0-5]\d:[0-5]\d(\.\d+)?|24:00:00(\.0+)?)"
+_TIMEZONE = r"(Z|[+-]((0\d|1[0-3]):[0-5]\d|14:00))?"
+XSD_REGEXES = (
+    ("boolean", r"true|false|1|0"),
+    ("decimal", r"[+-]?(\d+(\.\d*)?|\.\d+)"),
+    ("integer", _INTEGER),
+    ("long", _INTEGER),
+    ("int", _INTEGER),
+    ("short", _INTEGER),
+    ("byte", _INTEGER),
+    ("nonNegativeInteger", _NON_NEGATIVE),
+    ("positiveInteger", r"\+?0*[1-9]\d*"),
+    ("nonPositiveInteger", _NON_POSITIVE),
+    ("negativeInteger", r"-0*[1-9]\d*"),
+    ("unsignedLong", _NON_NEGATIVE),
+    ("unsignedInt", _NON_NEGATIVE),
+    ("unsignedShort", _NON_NEGATIVE),
+    ("unsignedByte", _NON_NEGATIVE),
+    ("double", _DOUBLE),
+    ("float", _DOUBLE),
+    ("date", _DATE + _TIMEZONE),
+    ("dateTime", _DATE + "T" + _TIME + _TIMEZONE),
+    ("time", _TIME + _TIMEZONE),
+    ("gYear", r"-?([1-9]\d{3,}|0\d{3})" + _TIMEZONE),
+    #Any URI reference (RFC 3987 IRI), absolute or relative - only characters that have to be escaped are refused
+    ("anyURI", r"[^\s<>\"{}|\\^`]*"),
+    ("base64Binary", r"([A-Za-z0-9+/] ?)*(=( ?=)?)?"),
+)
+#Patterns that values of each CSVW base datatype have to match
+#Datatypes that aren't here (like string) aren't checked
+VALUE_PATTERNS = dict((name, re.compile(r"^(?:%s)$" % regex, re.U)) for name, regex in XSD_REGEXES)
+
+#Number of worker processes, None meaning one for each CPU
+validation_processes = None
+
+#Files are split into chunks of about this many bytes, each validated by a worker process
+validation_chunk_size = 64 * 1048576
+
+#Validation stops once this many errors are found
+validation_max_errors = 1000
+
+#Primary key uniqueness isn't checked for files with more rows than this,
+#as 8 bytes per row have to be kept in memory to check it
+validation_key_limit = 10000000
+
+#Files that aren't in the local filestore are only validated in the request (csvmetadata.async_mode = off)
+#up to this size, larger ones have to be validated in the background. 0 means no limit
+validation_sync_max_bytes = 50 * 1048576
+
+#Number of example errors kept for each column
+examples_per_column = 5
+
+#A global that stores the latest validation report of each resource, keyed by resource ID
+#Like job status, it has to be stored in SQLite for web server processes to see reports made by CKAN job workers
+validation_reports = make_cache()
+
+#Worker processes count errors found so far in this shared counter, so all of them stop early
+_error_counter = None
+
+#Rows between updates of the shared error counter
+_counter_interval = 1000
+
+
+def configure(config):
+    global validation_processes, validation_chunk_size, validation_max_errors, validation_key_limit
+    global validation_sync_max_bytes, validation_reports
+    if config.get('csvmetadata.validation_processes'):
+        validation_processes = max(int(config.get('csvmetadata.validation_processes')), 1)
+    validation_chunk_size = int(config.get('csvmetadata.validation_chunk_size', validation_chunk_size))
+    validation_max_errors = int(config.get('csvmetadata.validation_max_errors', validation_max_errors))
+    validation_key_limit = int(config.get('csvmetadata.validation_key_limit', validation_key_limit))
+    validation_sync_max_bytes = int(config.get('csvmetadata.validation_sync_max_bytes', validation_sync_max_bytes))
+    validation_reports = make_cache(max_size=int(config.get('csvmetadata.sniff_cache_size', 512)),
+                                    path=config.get('csvmetadata.sniff_cache_path'),
+                                    table="validation")
+
+
+def column_rules(csvw_dict):
+    """
+        Turns CSVW tableSchema columns into a list of plain dictionaries with
+        the constraints to check, which can be passed to worker processes.
+    """
+    rules = []
+    for i, column in enumerate(csvw_dict["tableSchema"]["columns"]):
+        datatype = column.get("datatype") or {}
+        base = datatype.get("base") or "string"
+        length = datatype.get("length")
+        reference = None
+        if column.get("foreignKeys"):
+            reference = column["foreignKeys"][0].get("reference") or {}
+            reference = (reference.get("resource"), reference.get("columnReference"))
+            if not all(reference):
+                reference = None
+        rules.append({"index": i,
+                      "name": column.get("name") or "col{}".format(i),
+                      "base": base,
+                      "required": bool(column.get("required")),
+                      "primaryKey": bool(column.get("primaryKey")),
+                      "length": int(length) if length not in (None, "") else None,
+                      "minimum": float(datatype["minimum"]) if datatype.get("minimum") not in (None, "") else None,
+                      "maximum": float(datatype["maximum"]) if datatype.get("maximum") not in (None, "") else None,
+                      "reference": reference,
+                      "reference_keys": None})
+    return rules
+
+
+def foreign_key_references(csvw_dict):
+    """
+        Returns (resource URL, column name) tuples of columns referenced by foreignKeys.
+    """
+    return sorted(set(rule["reference"] for rule in column_rules(csvw_dict) if rule["reference"]))
+
+
+def chunk_offsets(f, size, chunk_size, quotechar='"', block_size=1048576):
+    """
+        Splits a file into byte ranges of about chunk_size bytes that begin
+        and end at record boundaries, so that each can be parsed on its own.
+        Whether a chunk boundary is inside a quoted value depends on the number
+        of quote characters before it, so this is a single pass over the file
+        that only counts them, which is much faster than parsing it.
+        Returns the list of offsets, starting with 0 and ending with the file size.
+    """
+    offsets = [0]
+    quotes = 0
+    pos = 0
+    f.seek(0)
+    while pos + chunk_size < size:
+        target = pos + chunk_size
+        while pos < target:
+            block = f.read(min(block_size, target - pos))
+            if not block:
+                break
+            quotes += block.count(quotechar)
+            pos += len(block)
+        #Finding the first record boundary after the target offset
+        window = b""
+        boundary = None
+        while boundary is None:
+            block = f.read(block_size)
+            if not block:
+                break
+            window += block
+            for end in record_ends(window, quotechar, in_quotes=bool(quotes % 2)):
+                boundary = end
+                break
+        if boundary is None or pos + boundary >= size:
+            #The rest of the file is a single record
+            break
+        quotes += window.count(quotechar, 0, boundary)
+        pos += boundary
+        f.seek(pos)
+        offsets.append(pos)
+    offsets.append(size)
+    return offsets
+
+
+class RangeReader(object):
+    """
+        read(size) over the [start, end) byte range of a file.
+    """
+    def __init__(self, f, start, end):
+        self.f = f
+        self.remaining = end - start
+        f.seek(start)
+
+    def read(self, size=65536):
+        size = min(size, self.remaining)
+        if size <= 0:
+            return b""
+        block = self.f.read(size)
+        self.remaining -= len(block)
+        return block
+
+
+def _init_worker(error_counter):
+    global _error_counter
+    _error_counter = error_counter
+
+
+def validate_chunk(task):
+    """
+        Validates the rows in one byte range of the file. Runs in a worker process.
+        task is a (path, start, end, dialect, rules, max_errors, skip_header) tuple.
+        Returns a dictionary with row count, error counts and examples for each column,
+        sorted primary key hashes (if the table has a primary key) and whether
+        validation stopped early because there were too many errors.
+    """
+    path, start, end, dialect, rules, max_errors, skip_header = task
+    checks = [(rule["index"], rule["required"], VALUE_PATTERNS.get(rule["base"]),
+               rule["length"], rule["minimum"], rule["maximum"],
+               load_keys(rule["reference_keys"]) if rule["reference_keys"] else None) for rule in rules]
+    column_count = len(rules)
+    key_columns = [rule["index"] for rule in rules if rule["primaryKey"]]
+
+    column_errors = [{} for rule in rules]
+    column_examples = [[] for rule in rules]
+    result = {"rows": 0, "errors": 0, "row_errors": {}, "stopped": False,
+              "columns": [{"errors": errors, "examples": examples}
+                          for errors, examples in zip(column_errors, column_examples)]}
+    keys = array(KEY_TYPECODE) if key_columns else None
+
+    def error(i, row_num, rule_name, value):
+        column_errors[i][rule_name] = column_errors[i].get(rule_name, 0) + 1
+        if len(column_examples[i]) < examples_per_column:
+            column_examples[i].append({"row": row_num, "rule": rule_name, "value": value[:100]})
+
+    with open(path, "rb") as f:
+        rows = iter(CSVStreamReader(RangeReader(f, start, end).read, dialect["delimiter"], dialect["quoteChar"],
+                                    encoding=dialect["encoding"]))
+        if skip_header:
+            next(rows, None)
+        errors = 0
+        reported = 0
+        row_num = 0
+        for row in rows:
+            row_num += 1
+            if len(row) != column_count:
+                result["row_errors"]["columns"] = result["row_errors"].get("columns", 0) + 1
+                errors += 1
+            for i, required, pattern, length, minimum, maximum, reference_keys in checks:
+                value = row[i] if i < len(row) else u""
+                if not value:
+                    if required:
+                        error(i, row_num, "required", value)
+                        errors += 1
+                    continue
+                if pattern is not None and pattern.match(value) is None:
+                    error(i, row_num, "datatype", value)
+                    errors += 1
+                    continue
+                if length is not None and len(value) != length:
+                    error(i, row_num, "length", value)
+                    errors += 1
+                if reference_keys is not None and not contains(reference_keys, key_hash([value])):
+                    error(i, row_num, "foreignKey", value)
+                    errors += 1
+                if minimum is not None or maximum is not None:
+                    try:
+                        number = float(value)
+                    except ValueError:
+                        continue
+                    if minimum is not None and number < minimum:
+                        error(i, row_num, "minimum", value)
+                        errors += 1
+                    elif maximum is not None and number > maximum:
+                        error(i, row_num, "maximum", value)
+                        errors += 1
+            if keys is not None:
+                keys.append(key_hash([row[i] if i < len(row) else u"" for i in key_columns]))
+
+            if row_num % _counter_interval == 0 or errors >= max_errors:
+                #Errors found by other workers count too
+                total = errors
+                if _error_counter is not None:
+                    with _error_counter.get_lock():
+                        _error_counter.value += errors - reported
+                        total = _error_counter.value
+                    reported = errors
+                if total >= max_errors:
+                    result["stopped"] = True
+                    break
+
+    result["rows"] = row_num
+    result["errors"] = errors
+    if keys is not None:
+        result["keys"] = array(KEY_TYPECODE, sorted(keys))
+    return result
+
+
+def count_duplicates(key_arrays):
+    """
+        Counts repeated values in sorted arrays of primary key hashes.
+    """
+    if np is not None and key_arrays:
+        #Sorting concatenated sorted runs is about as fast as merging them, and stays in C
+        keys = np.sort(np.concatenate([np.frombuffer(keys, dtype=np.dtype(keys.typecode)) for keys in key_arrays]),
+                       kind="mergesort")
+        return int(np.count_nonzero(keys[1:] == keys[:-1]))
+    if len(key_arrays) == 1:
+        keys = key_arrays[0]
+        return sum(1 for key, next_key in izip(keys, islice(keys, 1, None)) if key == next_key)
+    duplicates = 0
+    previous = None
+    for key in heapq.merge(*key_arrays):
+        if key == previous:
+            duplicates += 1
+        previous = key
+    return duplicates
+
+
+def validate_file(path, csvw_dict, max_errors=None, processes=None, chunk_size=None, references=None):
+    """
+        Validates a local CSV file against its CSVW description: base datatype,
+        length, required, minimum/maximum, primary key uniqueness and,
+        for columns with foreignKeys, that referenced values exist.
+        references maps foreign_key_references tuples to reference index
+        files (see refindex), or to an error message if there's no index.
+        The file is read with the dialect stored in CSVW, and large files are
+        validated in chunks by a pool of worker processes, unless processes is 1:
+        then the chunks are validated one after another in this process.
+        Stops after max_errors errors. Returns a report dictionary.
+    """
+    started = time.time()
+    max_errors = max_errors or validation_max_errors
+    chunk_size = chunk_size or validation_chunk_size
+    dialect = csvw_dict.get("dialect") or {}
+    if not dialect.get("delimiter") or not dialect.get("quoteChar"):
+        raise Exception("CSVW has no CSV dialect to read the file with")
+    rules = column_rules(csvw_dict)
+    reference_errors = []
+    for rule in rules:
+        if rule["reference"]:
+            reference = (references or {}).get(rule["reference"])
+            if reference and os.path.isfile(reference):
+                rule["reference_keys"] = reference
+            else:
+                reference_errors.append({"column": rule["name"],
+                                         "resource": rule["reference"][0],
+                                         "columnReference": rule["reference"][1],
+                                         "error": reference or "Referenced resource wasn't indexed"})
+
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        #Encoding is detected once for the whole file, chunks other than the first can't tell it
+        encoding = detect_encoding(f.read(detection_sample_size), dialect.get("encoding"))[0]
+        dialect = dict(dialect, encoding=encoding)
+        if ascii_compatible(encoding):
+            offsets = chunk_offsets(f, size, chunk_size, str(dialect["quoteChar"]))
+        else:
+            #Chunk boundaries are found by looking for line breaks in bytes, so UTF-16 files are read as a whole
+            offsets = [0, size]
+    tasks = [(path, start, end, dialect, rules, max_errors, i == 0)
+             for i, (start, end) in enumerate(zip(offsets, offsets[1:]))]
+
+    pool = None
+    processes = min(processes or validation_processes or multiprocessing.cpu_count(), len(tasks))
+    if processes > 1:
+        error_counter = multiprocessing.Value("l", 0)
+        pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(error_counter,))
+        results = pool.imap(validate_chunk, tasks)
+    else:
+        results = (validate_chunk(task) for task in tasks)
+
+    report = {"rows": 0, "errors": 0, "row_errors": {}, "complete": True, "chunks": len(tasks),
+              "reference_errors": reference_errors,
+              "columns": [{"name": rule["name"], "errors": {}, "examples": []} for rule in rules]}
+    key_arrays = []
+    key_count = 0
+    check_keys = any(rule["primaryKey"] for rule in rules)
+    try:
+        #Merging chunk results in file order, so that row numbers can be made absolute
+        for result in results:
+            for column, chunk_column in zip(report["columns"], result["columns"]):
+                for rule_name, count in chunk_column["errors"].items():
+                    column["errors"][rule_name] = column["errors"].get(rule_name, 0) + count
+                for example in chunk_column["examples"]:
+                    if len(column["examples"]) < examples_per_column:
+                        example["row"] += report["rows"]
+                        column["examples"].append(example)
+            for rule_name, count in result["row_errors"].items():
+                report["row_errors"][rule_name] = report["row_errors"].get(rule_name, 0) + count
+            report["rows"] += result["rows"]
+            report["errors"] += result["errors"]
+            if check_keys:
+                key_count += len(result["keys"])
+                if key_count <= validation_key_limit:
+                    key_arrays.append(result["keys"])
+                else:
+                    check_keys = False
+                    key_arrays = []
+            if result["stopped"] or report["errors"] >= max_errors:
+                report["complete"] = False
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    if check_keys and report["complete"]:
+        report["duplicate_keys"] = count_duplicates(key_arrays)
+        report["errors"] += report["duplicate_keys"]
+    else:
+        #Not all keys were seen, or too many to keep
+        report["duplicate_keys"] = None
+    report["valid"] = report["complete"] and report["errors"] == 0 and not reference_errors
+    report["seconds"] = round(time.time() - started, 3)
+    log.info("Validated {} rows of {} in {} chunks in {:.1f}s, {} errors".format(
+        report["rows"], path, len(tasks), report["seconds"], report["errors"]))
+    return report
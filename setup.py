@@ -62,6 +62,9 @@ setup(
         [ckan.plugins]
         csvmetadata=ckanext.csvmetadata.plugin:CSVMetadataPlugin
 
+        [paste.paster_command]
+        csvmetadata=ckanext.csvmetadata.commands:CSVMetadataCommand
+
         [babel.extractors]
         ckan = ckan.lib.extract:extract_ckan
     ''',